@@ -0,0 +1,111 @@
+"""Benchmark of views.bikeability_trackwise against the previous per-group lambda implementation.
+
+Builds synthetic sensor datasets and a track store in a temporary directory and times the trackwise
+bikeability of one city, whose cost grows with the number of (box, day) groups.
+
+    python benchmarks/bench_trackwise.py [--boxes 40] [--days 365] [--per-day 20] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "opensensemap_backend.settings")
+import django  # noqa: E402
+django.setup()
+
+from sensebox import views  # noqa: E402
+from sensebox.storage import read_dataset, write_dataset  # noqa: E402
+from sensebox.track_store import TrackStoreWriter, read_track_scores  # noqa: E402
+
+
+def legacy_trackwise_scores(city):
+    """The sensor aggregation of bikeability_trackwise as it was before vectorizing it."""
+    info = views.city_data[city]
+    normalized_sensor_data = pd.DataFrame()
+    for file in info["sensor_files"]:
+        data = read_dataset(file, columns=["value", "timestamp", "box_id"], geometry=False)
+        data["date"] = pd.to_datetime(data["timestamp"]).dt.date
+        data["month"] = pd.to_datetime(data["timestamp"]).dt.month
+        data["value_normalized"] = data.groupby(["box_id", "date"])["value"].transform(
+            lambda x: (x - x.min()) / (x.max() - x.min()) if len(x) > 1 else x
+        )
+        pollutant_name = file.split("/")[-1].replace(".geojson", "")
+        data["weighted_value"] = data["value_normalized"] * info["weights"][pollutant_name]
+        normalized_sensor_data = pd.concat([normalized_sensor_data, data], ignore_index=True)
+    return normalized_sensor_data.groupby(["box_id", "date"]).agg({"weighted_value": "sum"}).reset_index()
+
+
+def make_dataset(city, n_boxes, n_days, per_day, seed=0):
+    rng = np.random.default_rng(seed)
+    boxes = np.array([f"box{i:04d}" for i in range(n_boxes)])
+    days = pd.Timestamp("2024-01-01", tz="UTC") + pd.to_timedelta(np.arange(n_days), unit="D")
+    n = n_boxes * n_days * per_day
+    for file in views.city_data[city]["sensor_files"]:
+        stamps = np.repeat(days, n_boxes * per_day) + pd.to_timedelta(rng.integers(0, 86400, n), unit="s")
+        data = pd.DataFrame({
+            "value": rng.random(n) * 50,
+            "timestamp": stamps.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "box_id": np.tile(np.repeat(boxes, per_day), n_days),
+        })
+        write_dataset(gpd.GeoDataFrame(data, geometry=gpd.points_from_xy(np.full(n, 7.6), np.full(n, 51.9)),
+                                       crs="EPSG:4326"), file)
+
+    # One 50-point segment per box and day in the track store
+    n_segments = n_boxes * n_days
+    with TrackStoreWriter(city) as store:
+        store.add({
+            "geometry": [LineString(np.column_stack([7.6 + np.arange(50) / 1e4, np.full(50, 51.9)]))] * n_segments,
+            "timestamps": [[f"2024-01-01T10:00:{i:02d}Z" for i in range(50)]] * n_segments,
+            "date": np.repeat(days.strftime("%Y-%m-%d"), n_boxes).tolist(),
+            "box_id": np.tile(boxes, n_days).tolist(),
+        })
+    return n
+
+
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--boxes", type=int, default=40)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--per-day", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        n = make_dataset("ms", args.boxes, args.days, args.per_day)
+        print(f"{len(views.city_data['ms']['sensor_files'])} sensor files of {n} measurements, "
+              f"{args.boxes * args.days} (box, day) groups each")
+
+        legacy = timed(lambda: legacy_trackwise_scores("ms"), args.repeat)
+        new = timed(lambda: views.bikeability_trackwise("ms"), args.repeat)
+        for name, (best, mean) in [("legacy aggregation", legacy), ("bikeability_trackwise", new)]:
+            print(f"{name:>22}: best {best * 1000:8.1f} ms  mean {mean * 1000:8.1f} ms")
+        print(f"speedup: {legacy[0] / new[0]:.1f}x (the new time includes linking the scores to the tracks)")
+
+        expected = legacy_trackwise_scores("ms").set_index(["box_id", "date"])["weighted_value"]
+        scores = read_track_scores("ms")
+        scores["date"] = scores["date"].dt.date
+        actual = scores.set_index(["box_id", "date"])["weighted_value"]
+        assert np.allclose(actual, expected.reindex(actual.index), equal_nan=True), "scores differ"
+        print("outputs match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Benchmark of views.calculate_traffic against the previous per-request implementation.
+
+Builds a synthetic normalized street network and ways.csv in a temporary directory and times
+the traffic.csv generation for a route request.
+
+    python benchmarks/bench_traffic.py [--streets 50000] [--edges-per-way 4] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "opensensemap_backend.settings")
+import django  # noqa: E402
+django.setup()
+
+from sensebox import views  # noqa: E402
+
+
+def legacy_calculate_traffic(city, weights, output_filename):
+    """calculate_traffic as it was before the edge table cache."""
+    streets = gpd.read_file(f"./tracks/BI/osm_normalized_{city}.geojson")
+    streets["bikeability_index"] = (
+        streets["safety_score"] * weights["safety"] +
+        streets["infrastructure_score"] * weights["infrastructure_quality"] +
+        streets["environment_score"] * weights["environment_quality"]
+    )
+    streets["way_id"] = streets["id"].str.replace('way/', '')
+    streets["way_id"] = streets["way_id"].astype(int)
+    streets = streets.drop_duplicates(subset=['way_id'])
+    ways_df = pd.read_csv('./sensebox/osrm/ways.csv')
+    merged_df = ways_df.merge(streets, on='way_id')
+    merged_df["speed"] = merged_df["bikeability_index"] * 0.25
+    merged_df[["first_node_id", "second_node_id", "speed"]].to_csv(output_filename, index=False, header=False)
+
+
+def make_dataset(n_streets, edges_per_way, seed=0):
+    rng = np.random.default_rng(seed)
+    way_ids = rng.choice(10 ** 9, n_streets, replace=False)
+    x = 7.5 + rng.random(n_streets) * 0.25
+    y = 51.87 + rng.random(n_streets) * 0.15
+    streets = gpd.GeoDataFrame({
+        "id": [f"way/{way_id}" for way_id in way_ids],
+        "safety_score": rng.random(n_streets),
+        "infrastructure_score": rng.random(n_streets),
+        "environment_score": rng.random(n_streets),
+    }, geometry=[LineString([(a, b), (a + 0.001, b + 0.001)]) for a, b in zip(x, y)], crs="EPSG:4326")
+    os.makedirs("tracks/BI", exist_ok=True)
+    streets.to_file("tracks/BI/osm_normalized_ms.geojson", driver="GeoJSON")
+
+    n_edges = n_streets * edges_per_way
+    os.makedirs("sensebox/osrm/work", exist_ok=True)
+    pd.DataFrame({
+        "way_id": rng.choice(way_ids, n_edges),
+        "first_node_id": rng.integers(10 ** 9, 10 ** 10, n_edges),
+        "second_node_id": rng.integers(10 ** 9, 10 ** 10, n_edges),
+    }).to_csv("sensebox/osrm/ways.csv", index=False)
+    return n_edges
+
+
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streets", type=int, default=50000)
+    parser.add_argument("--edges-per-way", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    weights = {"safety": 50, "infrastructure_quality": 40, "environment_quality": 10}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        n_edges = make_dataset(args.streets, args.edges_per_way)
+        print(f"{args.streets} streets, {n_edges} edges")
+
+        legacy_out, new_out = "sensebox/osrm/work/legacy.csv", "sensebox/osrm/work/traffic.csv"
+        legacy = timed(lambda: legacy_calculate_traffic("ms", weights, legacy_out), args.repeat)
+
+        views._traffic_tables.clear()
+        cold = timed(lambda: (views._traffic_tables.clear(), views.calculate_traffic("ms", weights, new_out)), 1)
+        warm = timed(lambda: views.calculate_traffic("ms", weights, new_out), args.repeat)
+
+        for name, (best, mean) in [("legacy", legacy), ("cached, first call", cold), ("cached, repeat", warm)]:
+            print(f"{name:>20}: best {best * 1000:8.1f} ms  mean {mean * 1000:8.1f} ms")
+        print(f"repeat-call speedup: {legacy[0] / warm[0]:.1f}x")
+
+        expected = pd.read_csv(legacy_out, header=None)
+        actual = pd.read_csv(new_out, header=None)
+        assert expected[[0, 1]].equals(actual[[0, 1]]), "edges differ"
+        assert np.allclose(expected[2], actual[2], atol=5e-4), "speeds differ"
+        print("outputs match")
+
+
+if __name__ == "__main__":
+    main()
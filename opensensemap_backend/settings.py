@@ -126,6 +126,42 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Pre-compressed bikeability responses (sensebox/response_cache.py), shared by all workers.
+# Keys include the pipeline data version, so new output never serves stale entries. Vector tiles
+# are small but numerous, so they get their own cache and cannot evict the GeoJSON responses. It is
+# kept in memory per process: FileBasedCache lists its whole directory on every set once it culls.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'tracks', 'cache', 'responses'),
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {'MAX_ENTRIES': 200},
+    },
+    'tiles': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tiles',
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
+}
+
+# Keeps the file based response cache out of the repository while the tests run
+TEST_RUNNER = 'sensebox.test_runner.TempCacheTestRunner'
+
+# Also write a GeoJSON copy of every intermediate pipeline dataset (sensebox/storage.py), for
+# inspecting them in QGIS or similar; the pipeline itself reads the columnar files.
+PIPELINE_GEOJSON_EXPORT = False
+
+# Write the per-segment track outputs: tracks/tracks/Processed_tracks_<city> (preprocessing_tracks)
+# and tracks/BI/routes_with_bikeability_<city>.geojson (bikeability_trackwise). The pipeline itself
+# reads the track store (sensebox/track_store.py), so turn this off if nothing else reads them;
+# both are rewritten as a whole whenever their tracks or scores change.
+TRACK_EXPORTS = True
+
 CSRF_USE_SESSIONS = True
 CORS_ALLOW_ALL_ORIGINS = True
 
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import BoxTable, SensorTable, SensorDataTable, TracksTable, BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup
+from .models import BoxTable, SensorTable, SensorDataTable, TracksTable, MeasurementTable, BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup, MeasurementTableBackup
 
 @admin.register(BoxTable)
 class BoxTableAdmin(admin.ModelAdmin):
@@ -21,6 +21,12 @@ class  TracksTableAdmin(admin.ModelAdmin):
     list_display = ('box_id', 'timestamp', 'city')
     search_fields = ('box_id__name',)
 
+@admin.register(MeasurementTable)
+class MeasurementTableAdmin(admin.ModelAdmin):
+    list_display = ('box', 'sensor', 'sensor_title', 'timestamp', 'value', 'city')
+    search_fields = ('box__name', 'sensor_title')
+    list_filter = ('city', 'sensor_title')
+
 
 @admin.register(BoxTableBackup)
 class BoxTableBackupAdmin(admin.ModelAdmin):
@@ -41,3 +47,8 @@ class SensorDataTableBackupAdmin(admin.ModelAdmin):
 class TracksTableBackupAdmin(admin.ModelAdmin):
     list_display = ('box_id', 'timestamp', 'city')
     search_fields = ('box_id__name',)
+
+@admin.register(MeasurementTableBackup)
+class MeasurementTableBackupAdmin(admin.ModelAdmin):
+    list_display = ('box_id', 'sensor_id', 'sensor_title', 'timestamp', 'value')
+    search_fields = ('box_id', 'sensor_title')
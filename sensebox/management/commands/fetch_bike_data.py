@@ -1,59 +1,132 @@
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Max
 from sensebox.utils import fetch_and_store_data
-from sensebox.views import preprocessing_tracks, preprocessing_sensors, bikeability_trackwise, calculate_bikeability, expand_weights, merge_cqi, precompute_normalized_data
-from sensebox.snapping_algorithm import process_city
-from datetime import datetime
+from sensebox.views import preprocessing_tracks, preprocessing_sensors, bikeability_trackwise, calculate_bikeability, expand_weights, merge_cqi, precompute_normalized_data, routing_pool, city_data
+from sensebox.snapping_algorithm import process_city, city_data as snapping_city_data
+from sensebox.models import MeasurementTable, TracksTable
+from sensebox.pipeline import Pipeline, PipelineError, Stage
+from sensebox.score_store import DETAIL_LEVELS, normalized_path, version_path
+from sensebox.sensor_data import sensor_file_cache
+from sensebox.track_store import track_index_path, track_scores_path
 import asyncio
 from asgiref.sync import async_to_sync
 import time
-from sqlite3 import OperationalError  # For SQLite-specific error
-# If you're using another DB like Postgres, replace this with the right error type
 
 MAX_RETRIES = 5
+
+
+def tracks_fingerprint(city):
+    return TracksTable.objects.filter(city=city).aggregate(count=Count("id"), last_id=Max("id"), last=Max("timestamp"))
+
+
+def measurements_fingerprint(city):
+    return MeasurementTable.objects.filter(city=city).aggregate(count=Count("id"), last_id=Max("id"))
+
+
+def refresh_pipeline(cities, workers=1, full_refresh=False, prebuild_routes=False, jobs=2, log=print):
+    """The refresh pipeline of one or more cities, from fetching openSenseMap data to the normalized street scores.
+
+    The sensor measurements of all cities are preprocessed in one scan. Trackwise bikeability and street
+    snapping only share the sensor files, so they run concurrently, as do the stages of different cities.
+    """
+    weights = {
+        "safety": 0.4,
+        "infrastructure_quality": 0.5,
+        "environment_quality": 0.1
+    }
+    stages, fingerprints, sensor_files = [], {}, []
+    for city in cities:
+        sensor_files += city_data[city]["sensor_files"]
+        fingerprints[f"db:tracks:{city}"] = lambda city=city: tracks_fingerprint(city)
+        fingerprints[f"db:measurements:{city}"] = lambda city=city: measurements_fingerprint(city)
+    stages.append(Stage("preprocessing_sensors", lambda: preprocessing_sensors(cities),
+                        inputs=[f"db:measurements:{city}" for city in cities], outputs=sensor_files))
+
+    for city in cities:
+        winter_streets = f"./tracks/BI/osm_streets_{city}_winter.geojson"
+        streets = f"./tracks/BI/osm_streets_{city}.geojson"
+        normalized = [normalized_path(city)] + [normalized_path(city, detail) for detail in DETAIL_LEVELS]
+        # Outputs written for other consumers only, see TRACK_EXPORTS in settings
+        exports = getattr(settings, "TRACK_EXPORTS", True)
+        routes = [city_data[city]["routes_file"]] if exports else []
+        routes_with_bikeability = [f"./tracks/BI/routes_with_bikeability_{city}.geojson"] if exports else []
+        stages += [
+            Stage(f"fetch:{city}", lambda city=city: asyncio.run(fetch_and_store_data(city, full_refresh=full_refresh)),
+                  outputs=[f"db:tracks:{city}", f"db:measurements:{city}"], volatile=True),
+            Stage(f"preprocessing_tracks:{city}", lambda city=city: preprocessing_tracks(city),
+                  inputs=[f"db:tracks:{city}"], outputs=[track_index_path(city)] + routes),
+            # Only the track store's index changes when new tracks are added, not its untouched days
+            Stage(f"bikeability_trackwise:{city}", lambda city=city: bikeability_trackwise(city),
+                  inputs=city_data[city]["sensor_files"] + [track_index_path(city)],
+                  outputs=[track_scores_path(city)] + routes_with_bikeability),
+            Stage(f"process_city:{city}", lambda city=city: process_city(city, workers=workers),
+                  inputs=snapping_city_data[city]["sensor_files"] + [snapping_city_data[city]["osm_file"]],
+                  outputs=[winter_streets]),
+            Stage(f"merge_cqi:{city}",
+                  lambda city=city: merge_cqi(city, id_column='id', columns_to_add=None, column_rename_map=None),
+                  inputs=[winter_streets, f"./tracks/{city}_cycling_quality_index.geojson"], outputs=[streets]),
+            Stage(f"precompute_normalized_data:{city}", lambda city=city: precompute_normalized_data(city),
+                  inputs=[streets], outputs=normalized + [version_path(city)]),
+            # weight = expand_weights(weights)
+            Stage(f"calculate_bikeability:{city}", lambda city=city: calculate_bikeability(city, weights),
+                  inputs=[normalized_path(city)]),
+        ]
+    if prebuild_routes and 'ms' in cities:
+        def prebuild():
+            built = routing_pool().prebuild()
+            log(f"Prebuilt routing profiles: {', '.join(built)}")
+        stages.append(Stage("prebuild_routes", prebuild, inputs=[version_path('ms')]))
+
+    state_path = f"./tracks/pipeline/{'_'.join(cities)}.json"
+    return Pipeline(stages, state_path, fingerprints=fingerprints, max_workers=jobs, log=log)
+
+
 class Command(BaseCommand):
     help = 'Fetches bike data for a specified city'
 
     def add_arguments(self, parser):
-        parser.add_argument('city', type=str, help="Specify the city (e.g., 'ms' or 'os')")
+        parser.add_argument('cities', nargs='+', type=str,
+                            help="Specify the city (e.g., 'ms' or 'os'); several cities are refreshed in one "
+                                 "run that preprocesses their sensor data in a single scan")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Number of worker processes for street snapping (default: 1, serial)")
+        parser.add_argument('--jobs', type=int, default=2,
+                            help="Number of independent pipeline stages run at the same time (default: 2)")
+        parser.add_argument('--full-refresh', action='store_true',
+                            help="Back up and delete the city and refetch its complete history "
+                                 "instead of fetching only new measurements")
+        parser.add_argument('--prebuild-routes', action='store_true',
+                            help="Customize the routing graphs of the default and most requested "
+                                 "weight profiles after the refresh (routing covers 'ms' only)")
+        parser.add_argument('--fresh', action='store_true',
+                            help="Start a new run instead of resuming an unfinished one (fetches again)")
+        parser.add_argument('--force', action='store_true',
+                            help="Run every stage, even those whose inputs are unchanged")
 
     def handle(self, *args, **kwargs):
-        city = kwargs['city']
+        cities = list(dict.fromkeys(kwargs['cities']))
+        unknown = [city for city in cities if city not in city_data]
+        if unknown:
+            raise CommandError(f"Unknown cities: {', '.join(unknown)}")
+        pipeline = refresh_pipeline(cities, workers=kwargs['workers'], full_refresh=kwargs['full_refresh'],
+                                 prebuild_routes=kwargs['prebuild_routes'], jobs=kwargs['jobs'], log=self.stdout.write)
+        print((f"Fetching data for city:{', '.join(cities)}!"))
         for attempt in range(MAX_RETRIES):
             try:
-                weights = {
-                    "safety": 0.4,
-                    "infrastructure_quality": 0.5,
-                    "environment_quality": 0.1
-                }
-                print((f"Fetching data for city:{city}!"))
-                asyncio.run(fetch_and_store_data(city))
-                # async_to_sync(fetch_and_store_data)(city)
-                timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                msg = f"[{timestamp}] Data fetched and saved successfully for city:{city}!"
-                # print(msg)
-                self.stdout.write(msg)
-                time.sleep(5)
-                preprocessing_tracks(city) 
-                preprocessing_sensors()
-                bikeability_trackwise(city)
-                process_city(city) 
-                time.sleep(5)
-                merge_cqi(city, id_column='id', columns_to_add=None, column_rename_map=None)
-                precompute_normalized_data(city)
-                # weight = expand_weights(weights)
-                calculate_bikeability(city, weights)
-                # osm_segements_bikeability_index_view(city, weights)
+                # Retries resume the run, so completed stages (the fetch above all) are not repeated.
+                # Trackwise bikeability and street snapping share the sensor files decoded during the run
+                with sensor_file_cache():
+                    pipeline.run(force=kwargs['force'] and attempt == 0, fresh=kwargs['fresh'] and attempt == 0)
                 break  # Success, exit loop
 
-            except OperationalError as e:
-                if 'database is locked' in str(e):
+            except PipelineError as err:
+                errors = [stage.get("error", "") for stage in pipeline.load_state()["stages"].values()
+                          if stage.get("status") == "failed"]
+                if any('database is locked' in error for error in errors):
                     wait_time = 2
                     print(f"[Retry {attempt + 1}] DB is locked, waiting {wait_time}s...")
                     time.sleep(wait_time)
                 else:
-                    raise
-
-            except Exception as err:
-                self.stdout.write(f"An error occurred: {err}")
-                break
-        
\ No newline at end of file
+                    self.stdout.write(f"An error occurred: {err}")
+                    break
@@ -0,0 +1,105 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.dateparse import parse_datetime
+
+BATCH_SIZE = 5000
+
+
+# Frozen copies of the parsing in sensebox.utils at the time of this migration, so the migration
+# keeps its behavior when the runtime code changes.
+def parse_measurement(entry):
+    """Returns (timestamp, value, lon, lat) for an openSenseMap measurement, or None if invalid."""
+    try:
+        timestamp = parse_datetime(entry["createdAt"])
+        value = float(entry["value"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if timestamp is None:
+        return None
+    lon, lat = parse_location(entry.get("location"))
+    return timestamp, value, lon, lat
+
+
+def parse_location(location):
+    """Returns (lon, lat) of a measurement location given as [lon, lat, ...], {"lng", "lat"} or GeoJSON."""
+    if isinstance(location, dict):
+        if "coordinates" not in location:
+            return location.get("lng"), location.get("lat")
+        location = location["coordinates"]
+    if location and len(location) >= 2:
+        return location[0], location[1]
+    return None, None
+
+
+def explode_sensor_blobs(apps, schema_editor):
+    """Copies the JSON histories in SensorDataTable.value into one MeasurementTable row each."""
+    SensorDataTable = apps.get_model('sensebox', 'SensorDataTable')
+    MeasurementTable = apps.get_model('sensebox', 'MeasurementTable')
+
+    rows = []
+    blobs = SensorDataTable.objects.values_list(
+        'sensor_id_id', 'box_id_id', 'sensor_title', 'city', 'value'
+    ).iterator(chunk_size=100)
+    for sensor_id, box_id, sensor_title, city, value in blobs:
+        if not isinstance(value, list):
+            continue
+        for entry in value:
+            parsed = parse_measurement(entry) if isinstance(entry, dict) else None
+            if parsed is None:
+                continue
+            timestamp, measurement, lon, lat = parsed
+            rows.append(MeasurementTable(
+                sensor_id=sensor_id, box_id=box_id, sensor_title=sensor_title, city=city,
+                timestamp=timestamp, value=measurement, lon=lon, lat=lat,
+            ))
+            if len(rows) >= BATCH_SIZE:
+                MeasurementTable.objects.bulk_create(rows, ignore_conflicts=True)
+                rows = []
+    if rows:
+        MeasurementTable.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sensebox', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MeasurementTableBackup',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('sensor_id', models.CharField(max_length=100)),
+                ('box_id', models.CharField(max_length=255)),
+                ('sensor_title', models.CharField(max_length=255)),
+                ('city', models.CharField(default='city', max_length=100)),
+                ('timestamp', models.DateTimeField()),
+                ('value', models.FloatField()),
+                ('lon', models.FloatField(null=True)),
+                ('lat', models.FloatField(null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MeasurementTable',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('sensor_title', models.CharField(max_length=255)),
+                ('city', models.CharField(default='city', max_length=100)),
+                ('timestamp', models.DateTimeField()),
+                ('value', models.FloatField()),
+                ('lon', models.FloatField(blank=True, null=True)),
+                ('lat', models.FloatField(blank=True, null=True)),
+                ('box', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='measurements', to='sensebox.boxtable')),
+                ('sensor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='measurements', to='sensebox.sensortable')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['city', 'sensor_title'], name='measurement_city_title_idx'), models.Index(fields=['lon', 'lat'], name='measurement_lon_lat_idx')],
+                'constraints': [models.UniqueConstraint(fields=('sensor', 'timestamp'), name='unique_sensor_measurement')],
+            },
+        ),
+        migrations.RunPython(explode_sensor_blobs, migrations.RunPython.noop),
+    ]
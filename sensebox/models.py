@@ -29,7 +29,9 @@ class SensorTable(models.Model):
         return f"{self.sensor_id}"
 
 
-# 3. SensorData Model (for time series data)
+# 3. SensorData Model (one row per sensor fetch)
+# Fetches store a summary ({"measurements": n, "from_date": ...}) in `value`; the measurements
+# themselves are in MeasurementTable. Rows from before that hold the full JSON history.
 class SensorDataTable(models.Model):
     data_id = models.AutoField(primary_key=True)
     sensor_id = models.ForeignKey(SensorTable, on_delete=models.CASCADE, related_name='data')
@@ -58,6 +60,31 @@ class TracksTable(models.Model):
         return f"Location for {self.box.name} at {self.timestamp}"
 
 
+# 5. Measurement Model (one row per measurement)
+class MeasurementTable(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    sensor = models.ForeignKey(SensorTable, on_delete=models.CASCADE, related_name='measurements')
+    box = models.ForeignKey(BoxTable, on_delete=models.CASCADE, related_name='measurements')
+    sensor_title = models.CharField(max_length=255)
+    city = models.CharField(max_length=100, default='city')
+    timestamp = models.DateTimeField()
+    value = models.FloatField()
+    lon = models.FloatField(null=True, blank=True)
+    lat = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sensor', 'timestamp'], name='unique_sensor_measurement'),
+        ]
+        indexes = [
+            models.Index(fields=['city', 'sensor_title'], name='measurement_city_title_idx'),
+            models.Index(fields=['lon', 'lat'], name='measurement_lon_lat_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.sensor_title} = {self.value} at {self.timestamp}"
+
+
 # Backup Tables
 class BoxTableBackup(models.Model):
     id = models.AutoField(primary_key=True)
@@ -102,3 +129,16 @@ class TracksTableBackup(models.Model):
     tracks = models.JSONField()
     city = models.CharField(max_length=255)
     archived_at = models.DateTimeField(auto_now_add=True)
+
+
+class MeasurementTableBackup(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    sensor_id = models.CharField(max_length=100)  # store as string
+    box_id = models.CharField(max_length=255)
+    sensor_title = models.CharField(max_length=255)
+    city = models.CharField(max_length=100, default='city')
+    timestamp = models.DateTimeField()
+    value = models.FloatField()
+    lon = models.FloatField(null=True)
+    lat = models.FloatField(null=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from django.db import connections
+
+from sensebox.storage import find_dataset
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Stage:
+    """One step of a pipeline.
+
+    ``inputs`` and ``outputs`` are resource names: dataset paths (see sensebox/storage.py) or names
+    registered with a fingerprint function on the pipeline. A stage runs after the stages producing its
+    inputs, and is skipped when its inputs and outputs are unchanged since it last completed.
+    A ``volatile`` stage reads from outside the pipeline (e.g. the openSenseMap API), so it always
+    runs, except when resuming the unfinished run it already completed in.
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), volatile=False):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.volatile = volatile
+
+
+def file_fingerprint(path):
+    """(file name, mtime, size) of a file or stored dataset, or None if it does not exist."""
+    found = path if os.path.exists(path) else find_dataset(path)
+    if found is None:
+        return None
+    stat = os.stat(found)
+    return [os.path.basename(found), stat.st_mtime_ns, stat.st_size]
+
+
+class Pipeline:
+    """Runs stages in dependency order, independent stages concurrently, with checkpoints in ``state_path``.
+
+    The state file records for each stage its input and output fingerprints, status and timings. It is
+    rewritten after every stage, so a failed run can be resumed without redoing the completed stages.
+    """
+
+    def __init__(self, stages, state_path, fingerprints=None, max_workers=2, log=print):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.fingerprints = fingerprints or {}
+        self.max_workers = max_workers
+        self.log = log
+        self._lock = threading.Lock()
+
+        producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise PipelineError(f"{output} is produced by both {producers[output]} and {stage.name}")
+                producers[output] = stage.name
+        self.dependencies = {
+            stage.name: {producers[i] for i in stage.inputs if i in producers and producers[i] != stage.name}
+            for stage in stages
+        }
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        visited, active = set(), set()
+
+        def visit(name):
+            if name in active:
+                raise PipelineError(f"Dependency cycle through stage {name}")
+            if name not in visited:
+                active.add(name)
+                for dependency in self.dependencies[name]:
+                    visit(dependency)
+                active.discard(name)
+                visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    # --- state ---------------------------------------------------------------------------------
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"run": None, "stages": {}}
+
+    def _save_state(self, state):
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def fingerprint(self, resource):
+        if resource in self.fingerprints:
+            return self.fingerprints[resource]()
+        return file_fingerprint(resource)
+
+    def _digest(self, resources):
+        values = [[resource, self.fingerprint(resource)] for resource in resources]
+        return hashlib.sha1(json.dumps(values, default=str).encode()).hexdigest()
+
+    def is_current(self, stage, checkpoint, run_id):
+        """Whether ``stage`` can be skipped given its last ``checkpoint``."""
+        if not checkpoint or checkpoint.get("status") != "done":
+            return False
+        if stage.volatile and checkpoint.get("run_id") != run_id:
+            return False
+        return (checkpoint.get("inputs") == self._digest(stage.inputs)
+                and checkpoint.get("outputs") == self._digest(stage.outputs))
+
+    # --- running -------------------------------------------------------------------------------
+
+    def run(self, force=False, fresh=False):
+        """Runs the pipeline; returns {stage: status}. Raises PipelineError if a stage failed.
+
+        An unfinished previous run is resumed unless ``fresh``; ``force`` runs every stage.
+        """
+        state = self.load_state()
+        previous = state.get("run") or {}
+        if previous.get("status") in (None, "done") or fresh or force:
+            run_id = uuid.uuid4().hex
+        else:
+            run_id = previous["id"]
+            self.log(f"Resuming pipeline run {run_id} from {previous.get('started_at')}")
+        state["run"] = {"id": run_id, "status": "running", "started_at": datetime.now().isoformat(timespec="seconds")}
+        self._save_state(state)
+
+        statuses = {}
+        pending = dict(self.dependencies)
+        running = {}
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                for name, dependencies in list(pending.items()):
+                    if any(statuses.get(d) in ("failed", "blocked") for d in dependencies):
+                        statuses[name] = "blocked"
+                        del pending[name]
+                        self.log(f"[{name}] not run, an upstream stage failed")
+                    elif all(d in statuses for d in dependencies):
+                        del pending[name]
+                        stage = self.stages[name]
+                        try:
+                            current = not force and self.is_current(stage, state["stages"].get(name), run_id)
+                        except Exception as err:
+                            # Fingerprints read the database, which may be locked by another process
+                            checkpoint = {"run_id": run_id, "started_at": datetime.now().isoformat(timespec="seconds")}
+                            statuses[name] = self._record(stage, state, self._failed(stage, checkpoint, err))
+                            continue
+                        if current:
+                            statuses[name] = "skipped"
+                            self.log(f"[{name}] skipped, inputs unchanged")
+                        else:
+                            running[pool.submit(self._run_stage, stage, state, run_id)] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    statuses[running.pop(future)] = future.result()
+
+        failed = [name for name, status in statuses.items() if status == "failed"]
+        state["run"].update(status="failed" if failed else "done", seconds=round(time.perf_counter() - started, 3))
+        self._save_state(state)
+        self.log(self.summary(state, statuses))
+        if failed:
+            raise PipelineError(f"Stages failed: {', '.join(failed)}")
+        return statuses
+
+    def _run_stage(self, stage, state, run_id):
+        self.log(f"[{stage.name}] running")
+        started = time.perf_counter()
+        checkpoint = {"run_id": run_id, "started_at": datetime.now().isoformat(timespec="seconds")}
+        try:
+            inputs = self._digest(stage.inputs)
+            stage.run()
+            outputs = self._digest(stage.outputs)
+        except Exception as err:
+            self._failed(stage, checkpoint, err)
+        else:
+            checkpoint.update(status="done", inputs=inputs, outputs=outputs)
+        finally:
+            # Stages run in worker threads, each with its own database connection
+            connections.close_all()
+        checkpoint["seconds"] = round(time.perf_counter() - started, 3)
+        return self._record(stage, state, checkpoint)
+
+    def _failed(self, stage, checkpoint, err):
+        checkpoint.update(status="failed", error=f"{type(err).__name__}: {err}")
+        self.log(f"[{stage.name}] failed: {err}")
+        return checkpoint
+
+    def _record(self, stage, state, checkpoint):
+        """Saves the stage's ``checkpoint`` to the state file and returns its status."""
+        with self._lock:
+            state["stages"][stage.name] = checkpoint
+            self._save_state(state)
+        return checkpoint["status"]
+
+    def summary(self, state, statuses):
+        lines = ["Pipeline summary:"]
+        for name in self.stages:
+            status = statuses.get(name, "not run")
+            seconds = state["stages"].get(name, {}).get("seconds") if status in ("done", "failed") else None
+            lines.append(f"  {name:<28} {status:<8}" + (f" {seconds:9.1f}s" if seconds is not None else ""))
+        return "\n".join(lines)
@@ -0,0 +1,95 @@
+import gzip
+import hashlib
+import json
+import math
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+# Django cache aliases holding the pre-compressed response bodies (see CACHES in settings)
+RESPONSE_CACHE = "responses"
+TILE_CACHE = "tiles"
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def normalize_weights(weights, names=("safety", "infrastructure_quality", "environment_quality")):
+    """Canonical form of a weight dict for cache keys: known names only, as rounded floats.
+
+    Raises ValueError for weights that are not finite ("Infinity", "nan", 1e999).
+    """
+    normalized = tuple((name, round(float(weights[name]), 6)) for name in names)
+    if not all(math.isfinite(value) for _, value in normalized):
+        raise ValueError("Weights must be finite numbers")
+    return normalized
+
+
+def response_etag(*parts):
+    """ETag derived from the inputs of a response, so it is known before the body is built.
+
+    It is a weak ETag, since the identity, gzip and br bodies of a response share it.
+    """
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def compress_body(body):
+    """The body in every supported Content-Encoding ("identity", "gzip" and, if available, "br")."""
+    encodings = {"identity": body, "gzip": gzip.compress(body, GZIP_LEVEL)}
+    if brotli is not None:
+        encodings["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return encodings
+
+
+def _accepted_encodings(request):
+    accepted = set()
+    for item in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        name, _, params = item.strip().partition(";")
+        if name and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            accepted.add(name.lower())
+    return accepted
+
+
+def _etag_matches(request, etag):
+    header = request.META.get("HTTP_IF_NONE_MATCH")
+    if not header:
+        return False
+    # Weak comparison, as required for If-None-Match
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in candidates
+
+
+def cached_response(request, cache_key, etag, build_body, content_type="application/json",
+                    cache_alias=RESPONSE_CACHE):
+    """Returns a 304 if the client holds ``etag``, else the cached (or freshly built) body.
+
+    ``build_body()`` is only called on a cache miss; its result is stored pre-compressed under
+    ``cache_key`` in the ``cache_alias`` cache, and the response is sent in the best encoding
+    the client accepts.
+    """
+    if _etag_matches(request, etag):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+
+    cache = caches[cache_alias]
+    encodings = cache.get(cache_key)
+    if encodings is None:
+        encodings = compress_body(build_body())
+        cache.set(cache_key, encodings)
+
+    accepted = _accepted_encodings(request)
+    encoding = next((name for name in ("br", "gzip") if name in accepted and name in encodings), "identity")
+
+    response = HttpResponse(encodings[encoding], content_type=content_type)
+    if encoding != "identity":
+        response["Content-Encoding"] = encoding
+    response["ETag"] = etag
+    response["Cache-Control"] = "no-cache"  # clients keep the body but revalidate with If-None-Match
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
@@ -0,0 +1,494 @@
+import os
+import atexit
+import fcntl
+import json
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# OSRM binaries and the preprocessed (extract/partition) MLD dataset
+OSRM_DIR = "./sensebox/osrm"
+OSRM_CUSTOMIZE = os.path.join(OSRM_DIR, "osrm-customize")
+OSRM_ROUTED = os.path.join(OSRM_DIR, "osrm-routed")
+BASE_DATASET = os.path.join(OSRM_DIR, "work", "smol.osrm")
+PROFILES_DIR = os.path.join(OSRM_DIR, "work", "profiles")
+
+# Files osrm-customize rewrites; these are copied per profile, the rest of the dataset is symlinked
+CUSTOMIZED_SUFFIXES = (".cell_metrics", ".mldgr", ".geometry", ".datasource_names",
+                       ".turn_weight_penalties", ".turn_duration_penalties")
+
+MAX_ROUTERS = 4                 # long-lived osrm-routed processes
+MAX_INFLIGHT = 4                # concurrent requests per router, others wait in line
+QUEUE_TIMEOUT = 30              # seconds a request waits for a free router slot
+READY_TIMEOUT = 60              # seconds to wait for osrm-routed to load the dataset
+REQUEST_TIMEOUT = 30            # seconds per routing request
+READY_MESSAGE = "running and waiting for requests"
+
+# Weight profiles are snapped onto a grid so nearby weights share one customized graph
+WEIGHT_STEP = 10
+# Customized profile directories kept on disk, least recently used are removed beyond this
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Profiles built ahead of time after a data refresh: the default weights plus the most used ones
+DEFAULT_WEIGHTS = {"safety": 50, "infrastructure_quality": 40, "environment_quality": 10}
+PREBUILD_PROFILES = 4
+PROFILE_MARKER = "profile.json"
+# Taken while a profile is customized, by every process sharing PROFILES_DIR (runserver, cron jobs)
+PROFILE_LOCK = ".lock"
+# Seconds a profile directory without a marker is left alone by pruning, as it may be starting a build
+PROFILE_BUILD_GRACE = 15 * 60
+# Seconds between writes of a profile's request count to its marker; the write also marks the
+# profile as recently used for pruning
+HIT_FLUSH_INTERVAL = 60
+
+
+class RoutingError(Exception):
+    """Raised when no router is available for a request."""
+
+
+def quantize_weights(weights, step=WEIGHT_STEP):
+    """Rounds every weight to the nearest multiple of ``step``."""
+    return {name: int(round(float(value) / step) * step) for name, value in weights.items()}
+
+
+def profile_key(weights):
+    """Stable key of a weight profile, e.g. ``e10_i40_s50``."""
+    return "_".join(f"{name[0]}{int(weights[name])}" for name in sorted(weights))
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def prepare_profile_dir(profile_dir, base_dataset=BASE_DATASET):
+    """Creates a working directory for one profile holding its own copy of the customizable files."""
+    os.makedirs(profile_dir, exist_ok=True)
+    base_dir, base_name = os.path.split(base_dataset)
+    for name in os.listdir(base_dir or "."):
+        if not name.startswith(base_name):
+            continue
+        source = os.path.abspath(os.path.join(base_dir, name))
+        target = os.path.join(profile_dir, name)
+        if os.path.lexists(target):
+            continue
+        if name.endswith(CUSTOMIZED_SUFFIXES):
+            shutil.copy2(source, target)
+        else:
+            os.symlink(source, target)
+    return os.path.join(profile_dir, base_name)
+
+
+def read_profile_marker(profile_dir):
+    """Build information of a cached profile ({"version", "weights", "hits"}), or None."""
+    try:
+        with open(os.path.join(profile_dir, PROFILE_MARKER)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_profile_marker(profile_dir, marker):
+    path = os.path.join(profile_dir, PROFILE_MARKER)
+    with open(path + ".tmp", "w") as f:
+        json.dump(marker, f)
+    os.replace(path + ".tmp", path)
+
+
+@contextmanager
+def profile_file_lock(profile_dir, blocking=True):
+    """Holds an exclusive lock on a profile directory, across processes and threads.
+
+    The directory is created if needed; if it is pruned while waiting, the lock is taken again
+    on the recreated one. With ``blocking`` False nothing is created and the block gets False
+    instead of waiting if the lock is held or the directory is gone.
+    """
+    path = os.path.join(profile_dir, PROFILE_LOCK)
+    while True:
+        if blocking:
+            os.makedirs(profile_dir, exist_ok=True)
+        try:
+            f = open(path, "a")
+        except FileNotFoundError:
+            if blocking:
+                continue
+            yield False
+            return
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except BlockingIOError:
+                locked = False
+            if locked:
+                try:
+                    current = os.stat(path).st_ino
+                except FileNotFoundError:
+                    current = None
+                if current != os.fstat(f.fileno()).st_ino:
+                    continue
+            yield locked
+            return
+
+
+def profile_dir_size(profile_dir):
+    """Bytes used by a profile directory; symlinks into the base dataset are not counted."""
+    total = 0
+    for name in os.listdir(profile_dir):
+        path = os.path.join(profile_dir, name)
+        if not os.path.islink(path) and os.path.isfile(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def prune_profile_cache(profiles_dir, max_bytes=CACHE_MAX_BYTES, keep=(), grace=PROFILE_BUILD_GRACE):
+    """Removes least recently used profile directories until the cache fits into ``max_bytes``.
+
+    Profiles in ``keep`` (e.g. those served by a running router) are never removed, nor are
+    profiles locked by a build in any process, or without a marker for less than ``grace``
+    seconds (just created). Returns the removed profile keys.
+    """
+    if not os.path.isdir(profiles_dir):
+        return []
+    now = time.time()
+    profiles = []
+    for key in os.listdir(profiles_dir):
+        profile_dir = os.path.join(profiles_dir, key)
+        marker = os.path.join(profile_dir, PROFILE_MARKER)
+        try:
+            if not os.path.isdir(profile_dir):
+                continue
+            if os.path.exists(marker):
+                last_used = os.path.getmtime(marker)
+            elif now - os.path.getmtime(profile_dir) < grace:
+                continue
+            else:
+                # A build that never finished
+                last_used = 0.0
+            profiles.append((last_used, key, profile_dir_size(profile_dir)))
+        except OSError:
+            # Removed by another process in the meantime
+            continue
+
+    total = sum(size for _, _, size in profiles)
+    removed = []
+    for _, key, size in sorted(profiles):
+        if total <= max_bytes:
+            break
+        if key in keep:
+            continue
+        profile_dir = os.path.join(profiles_dir, key)
+        with profile_file_lock(profile_dir, blocking=False) as locked:
+            if not locked:
+                continue
+            shutil.rmtree(profile_dir, ignore_errors=True)
+        total -= size
+        removed.append(key)
+    if removed:
+        print(f"Removed {len(removed)} cached routing profiles, {total / 1024 ** 2:.1f} MB left")
+    return removed
+
+
+class Router:
+    """One osrm-routed process serving a customized dataset on its own port."""
+
+    def __init__(self, key, dataset, routed=OSRM_ROUTED, max_inflight=MAX_INFLIGHT, version=None):
+        self.key = key
+        self.dataset = dataset
+        self.version = version
+        self.routed = routed
+        self.port = None
+        self.process = None
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.inflight = 0
+        self.ready = False
+        self._ready = threading.Event()
+
+    def start(self, timeout=READY_TIMEOUT):
+        """Starts osrm-routed and blocks until it reports that it is accepting requests."""
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            [self.routed, "--algorithm=mld", "--ip", "127.0.0.1", "--port", str(self.port), self.dataset],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+        )
+        # Keep draining stdout so the router never blocks on a full pipe
+        threading.Thread(target=self._watch_output, daemon=True).start()
+
+        self._ready.wait(timeout)
+        if not self.ready or not self.alive():
+            self.stop()
+            raise RoutingError(f"Router for profile {self.key} did not become ready within {timeout}s")
+        print(f"Router for profile {self.key} ready on port {self.port}")
+
+    def _watch_output(self):
+        for line in self.process.stdout:
+            if READY_MESSAGE in line:
+                self.ready = True
+                self._ready.set()
+        # Process exited; wake up anyone still waiting for it
+        self._ready.set()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def request(self, path, timeout=REQUEST_TIMEOUT):
+        """Returns (status, body); OSRM error responses such as NoRoute are passed through."""
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{self.port}{path}", timeout=timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class RouterPool:
+    """Long-lived routers keyed by weight profile.
+
+    Weights are quantized onto a ``weight_step`` grid. The first request for a profile writes
+    its traffic file (``write_traffic(weights, path)``) and customizes a per-profile copy of the
+    dataset; that copy is kept on disk for later processes until ``data_version()`` changes, with
+    least recently used profiles removed beyond ``cache_max_bytes``. Each profile is served by one
+    osrm-routed process that handles ``max_inflight`` requests at a time and queues the rest.
+    Once more than ``max_routers`` profiles are running, the least recently used idle router is
+    stopped.
+
+    Requests per profile are counted in memory and added to the profile's marker every
+    ``hit_flush_interval`` seconds, when the profile is built, before pruning and on shutdown.
+    """
+
+    def __init__(self, write_traffic, data_version=lambda: "", max_routers=MAX_ROUTERS,
+                 max_inflight=MAX_INFLIGHT, weight_step=WEIGHT_STEP, cache_max_bytes=CACHE_MAX_BYTES,
+                 base_dataset=BASE_DATASET, profiles_dir=PROFILES_DIR,
+                 customize=OSRM_CUSTOMIZE, routed=OSRM_ROUTED, ready_timeout=READY_TIMEOUT,
+                 hit_flush_interval=HIT_FLUSH_INTERVAL):
+        self.write_traffic = write_traffic
+        self.data_version = data_version
+        self.max_routers = max_routers
+        self.max_inflight = max_inflight
+        self.weight_step = weight_step
+        self.cache_max_bytes = cache_max_bytes
+        self.base_dataset = base_dataset
+        self.profiles_dir = profiles_dir
+        self.customize = customize
+        self.routed = routed
+        self.ready_timeout = ready_timeout
+        self.hit_flush_interval = hit_flush_interval
+        self.routers = OrderedDict()
+        self._lock = threading.Lock()
+        self._profile_locks = {}
+        self._hits = {}             # requests per profile not yet written to its marker
+        self._hits_flushed = {}     # time.monotonic() of the last write per profile
+
+    def _profile_lock(self, key):
+        with self._lock:
+            return self._profile_locks.setdefault(key, threading.Lock())
+
+    def build_profile(self, weights, version=None):
+        """Customizes the dataset of a (quantized) profile unless an up to date copy is cached.
+
+        Returns the dataset path; the profile's marker is touched, so it counts as recently used.
+        """
+        key = profile_key(weights)
+        version = self.data_version() if version is None else version
+        profile_dir = os.path.join(self.profiles_dir, key)
+        # Other processes (runserver, the prebuild cron job) may be customizing the same profile
+        with profile_file_lock(profile_dir):
+            dataset = prepare_profile_dir(profile_dir, self.base_dataset)
+            marker = read_profile_marker(profile_dir)
+
+            if marker is None or marker.get("version") != version:
+                traffic_path = os.path.join(profile_dir, "traffic.csv")
+                self.write_traffic(weights, traffic_path)
+                subprocess.run([self.customize, dataset, f"--segment-speed-file={traffic_path}"], check=True)
+                marker = {"version": version, "weights": weights, "hits": marker.get("hits", 0) if marker else 0}
+                print(f"Customized routing profile {key}")
+            marker["hits"] = marker.get("hits", 0) + self._take_hits(key)
+            write_profile_marker(profile_dir, marker)
+        # Pruning goes by marker mtime, so bring the markers of the other profiles up to date first
+        self.flush_hits()
+        with self._lock:
+            running = set(self.routers)
+        prune_profile_cache(self.profiles_dir, self.cache_max_bytes, keep=running | {key})
+        return dataset
+
+    def _record_hit(self, key):
+        """Counts a request for a profile; the marker is only rewritten every ``hit_flush_interval`` seconds."""
+        now = time.monotonic()
+        with self._lock:
+            self._hits[key] = self._hits.get(key, 0) + 1
+            due = now - self._hits_flushed.setdefault(key, now) >= self.hit_flush_interval
+        if due:
+            self._flush_hits(key)
+
+    def _take_hits(self, key):
+        """Returns and resets the requests counted for a profile since its last write."""
+        with self._lock:
+            self._hits_flushed[key] = time.monotonic()
+            return self._hits.pop(key, 0)
+
+    def _flush_hits(self, key):
+        """Adds the counted requests of a profile to its marker, which also marks it as recently used."""
+        hits = self._take_hits(key)
+        profile_dir = os.path.join(self.profiles_dir, key)
+        if not hits or not os.path.isdir(profile_dir):
+            # Nothing counted, or the profile was pruned
+            return
+        # Under the profile lock, so a stale marker never overwrites a rebuilt one. If a build holds
+        # the lock, the hits are kept for the next write instead of waiting for it.
+        with profile_file_lock(profile_dir, blocking=False) as locked:
+            if locked:
+                marker = read_profile_marker(profile_dir)
+                if marker is not None:
+                    marker["hits"] = marker.get("hits", 0) + hits
+                    write_profile_marker(profile_dir, marker)
+                return
+        with self._lock:
+            self._hits[key] = self._hits.get(key, 0) + hits
+
+    def flush_hits(self):
+        """Writes the counted requests of all profiles to their markers."""
+        with self._lock:
+            keys = list(self._hits)
+        for key in keys:
+            self._flush_hits(key)
+
+    def _start_router(self, key, weights, version):
+        dataset = self.build_profile(weights, version)
+        router = Router(key, dataset, routed=self.routed, max_inflight=self.max_inflight, version=version)
+        router.start(self.ready_timeout)
+        return router
+
+    def _evict(self):
+        """Removes least recently used idle routers while the pool is over capacity; returns them.
+
+        Called with ``self._lock`` held; the caller stops the routers after releasing it.
+        """
+        evicted = []
+        while len(self.routers) > self.max_routers:
+            idle = [key for key, router in self.routers.items() if router.inflight == 0]
+            if not idle:
+                break
+            evicted.append(self.routers.pop(idle[0]))
+        return evicted
+
+    def get(self, weights):
+        """Returns a running router for ``weights``, starting one if needed.
+
+        The router is returned with one request reserved (``inflight``) so it cannot be evicted
+        before the caller is done; release it with ``release(router)``.
+        """
+        weights = quantize_weights(weights, self.weight_step)
+        key = profile_key(weights)
+        version = self.data_version()
+
+        # Only one thread customizes and starts a profile; the others wait for it
+        with self._profile_lock(key):
+            with self._lock:
+                router = self.routers.get(key)
+                if router is not None and router.alive() and router.version == version:
+                    self.routers.move_to_end(key)
+                    router.inflight += 1
+                else:
+                    router = None
+                    stale = self.routers.pop(key, None)
+            if router is None:
+                if stale is not None:
+                    # Data changed (or the router died); let it finish its requests before stopping it
+                    self._retire(stale)
+                router = self._start_router(key, weights, version)
+                with self._lock:
+                    self.routers[key] = router
+                    router.inflight += 1
+                    evicted = self._evict()
+                # Stopping waits for the process to exit, which must not block other requests
+                for old in evicted:
+                    print(f"Stopping router for profile {old.key}")
+                    old.stop()
+        self._record_hit(key)
+        return router
+
+    def release(self, router):
+        with self._lock:
+            router.inflight -= 1
+
+    def _retire(self, router):
+        """Stops a router that is no longer in the pool once its last request finished."""
+        def stop_when_idle():
+            deadline = time.monotonic() + QUEUE_TIMEOUT + REQUEST_TIMEOUT
+            while router.inflight > 0 and time.monotonic() < deadline:
+                time.sleep(0.1)
+            router.stop()
+        threading.Thread(target=stop_when_idle, daemon=True).start()
+
+    def popular_profiles(self, count=PREBUILD_PROFILES):
+        """The default weights plus the most requested cached profiles."""
+        profiles = [quantize_weights(DEFAULT_WEIGHTS, self.weight_step)]
+        markers = []
+        if os.path.isdir(self.profiles_dir):
+            for key in os.listdir(self.profiles_dir):
+                marker = read_profile_marker(os.path.join(self.profiles_dir, key))
+                if marker and marker.get("weights"):
+                    markers.append(marker)
+        for marker in sorted(markers, key=lambda m: m.get("hits", 0), reverse=True):
+            if len(profiles) >= count:
+                break
+            if marker["weights"] not in profiles:
+                profiles.append(marker["weights"])
+        return profiles
+
+    def prebuild(self, profiles=None):
+        """Customizes ``profiles`` (default: popular_profiles()) for the current data version."""
+        profiles = self.popular_profiles() if profiles is None else profiles
+        version = self.data_version()
+        for weights in profiles:
+            weights = quantize_weights(weights, self.weight_step)
+            with self._profile_lock(profile_key(weights)):
+                self.build_profile(weights, version)
+        return [profile_key(weights) for weights in profiles]
+
+    def route(self, weights, path, timeout=QUEUE_TIMEOUT):
+        """Sends ``path`` (e.g. ``/route/v1/driving/...``) to the router of ``weights``; returns (status, body)."""
+        router = self.get(weights)
+        try:
+            if not router.slots.acquire(timeout=timeout):
+                raise RoutingError(f"Router for profile {router.key} is busy")
+            try:
+                return router.request(path)
+            finally:
+                router.slots.release()
+        finally:
+            self.release(router)
+
+    def shutdown(self):
+        with self._lock:
+            routers, self.routers = list(self.routers.values()), OrderedDict()
+        for router in routers:
+            router.stop()
+        self.flush_hits()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_router_pool(write_traffic, data_version=lambda: ""):
+    """Process-wide RouterPool, created on first use and shut down at exit."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = RouterPool(write_traffic, data_version)
+            atexit.register(_pool.shutdown)
+        return _pool
@@ -0,0 +1,174 @@
+import os
+import json
+import logging
+import threading
+import uuid
+import numpy as np
+import shapely
+
+from sensebox.storage import find_dataset, read_dataset, write_dataset
+
+logger = logging.getLogger(__name__)
+
+SCORE_COLUMNS = ["safety_score", "infrastructure_score", "environment_score"]
+
+# Simplified copies of the normalized streets written by precompute_normalized_data:
+# {detail: (simplification tolerance in metres, decimals kept of the EPSG:4326 coordinates)}.
+# "full" is the normalized dataset itself.
+DETAIL_LEVELS = {
+    "high": (2.0, 6),
+    "medium": (8.0, 5),
+    "low": (30.0, 4),
+}
+DETAILS = ("full",) + tuple(DETAIL_LEVELS)
+# Lowest map zoom at which each level is detailed enough
+DETAIL_MIN_ZOOM = {"full": 17, "high": 15, "medium": 13, "low": 0}
+
+# {(city, detail): (file signature, table)}, kept for the lifetime of the process
+_score_tables = {}
+_lock = threading.Lock()
+
+
+def normalized_path(city, detail="full"):
+    if detail == "full":
+        return f"./tracks/BI/osm_normalized_{city}.geojson"
+    return f"./tracks/BI/osm_normalized_{city}_{detail}.geojson"
+
+
+def detail_for_zoom(zoom):
+    """The coarsest detail level that still looks right at a web map zoom level."""
+    return next(detail for detail in DETAILS if zoom >= DETAIL_MIN_ZOOM[detail])
+
+
+def write_detail_levels(streets, city):
+    """Writes the simplified copies of the normalized streets, one file per level of DETAIL_LEVELS.
+
+    Geometries are simplified in metres (topology preserving, so no line collapses or
+    self-intersects) and their EPSG:4326 coordinates rounded, which is what shrinks the payload.
+    """
+    metric = streets
+    if streets.crs is not None and not streets.crs.is_projected:
+        metric = streets.to_crs(streets.estimate_utm_crs())
+    for detail, (tolerance, decimals) in DETAIL_LEVELS.items():
+        level = metric.copy()
+        level["geometry"] = shapely.simplify(metric.geometry.values, tolerance, preserve_topology=True)
+        if level.crs is not None:
+            level = level.to_crs(epsg=4326)
+        level["geometry"] = shapely.transform(level.geometry.values, lambda coords: np.round(coords, decimals))
+        write_dataset(level, normalized_path(city, detail))
+
+
+def version_path(city):
+    return f"./tracks/BI/version_{city}.txt"
+
+
+def write_data_version(city):
+    """Marks a new pipeline output for a city; called after the normalized streets are written."""
+    version = uuid.uuid4().hex
+    with open(version_path(city) + ".tmp", "w") as f:
+        f.write(version)
+    os.replace(version_path(city) + ".tmp", version_path(city))
+    return version
+
+
+def data_version(city):
+    """Version of the city's pipeline output, used to key caches of derived responses."""
+    try:
+        with open(version_path(city)) as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    # Output written before version files existed
+    path = find_dataset(normalized_path(city))
+    if path is None:
+        return ""
+    mtime_ns, size = _signature(path)
+    return f"{mtime_ns}-{size}"
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def stored_normalized_path(city, detail="full"):
+    """The stored file of the city's normalized streets at ``detail``.
+
+    Output written before detail levels existed only has the full geometries, which are used instead.
+    """
+    path = find_dataset(normalized_path(city, detail))
+    if path is None and detail != "full":
+        path = find_dataset(normalized_path(city))
+    if path is None:
+        raise FileNotFoundError(f"No normalized streets for {city}, run precompute_normalized_data first")
+    return path
+
+
+def _build_table(path):
+    streets = read_dataset(path, columns=["id"] + SCORE_COLUMNS)
+    if streets.crs is not None:
+        streets = streets.to_crs(epsg=4326)
+
+    # Everything of a feature except its bikeability index, serialized once:
+    # {"id": "0", "type": "Feature", "properties": {"id": "way/1", "bikeability_index": <value>}, "geometry": {...}}
+    geometries = shapely.to_geojson(streets.geometry.values)
+    heads, tails = [], []
+    for index, street_id, geometry in zip(streets.index, streets["id"], geometries):
+        heads.append(
+            ('{"id": %s, "type": "Feature", "properties": {"id": %s, "bikeability_index": '
+             % (json.dumps(str(index)), json.dumps(street_id))).encode()
+        )
+        tails.append(('}, "geometry": %s}, ' % (geometry if geometry is not None else "null")).encode())
+    if tails:
+        tails[-1] = tails[-1][:-2]  # no separator after the last feature
+
+    return {
+        "scores": streets[SCORE_COLUMNS].to_numpy(dtype=np.float64),
+        "heads": heads,
+        "tails": tails,
+    }
+
+
+def load_score_table(city, detail="full"):
+    """Category scores and pre-serialized EPSG:4326 features of a city's normalized streets.
+
+    Loaded once per process and reloaded when precompute_normalized_data rewrites the file.
+    """
+    path = stored_normalized_path(city, detail)
+    signature = _signature(path)
+    cached = _score_tables.get((city, detail))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with _lock:
+        cached = _score_tables.get((city, detail))
+        if cached is None or cached[0] != signature:
+            cached = (signature, _build_table(path))
+            _score_tables[(city, detail)] = cached
+            logger.info("Loaded %d street scores for %s (%s)", len(cached[1]["heads"]), city, detail)
+    return cached[1]
+
+
+def bikeability_index(table, weights):
+    """Weighted sum of the category scores, one value per street segment."""
+    scores = table["scores"]
+    # Summed left to right like the column-wise formula, so values are bit-identical to it
+    return (scores[:, 0] * weights["safety"] + scores[:, 1] * weights["infrastructure_quality"]
+            + scores[:, 2] * weights["environment_quality"])
+
+
+def bikeability_geojson(city, weights, detail="full"):
+    """GeoJSON FeatureCollection (bytes) of the city's streets with their bikeability index."""
+    table = load_score_table(city, detail)
+    values = bikeability_index(table, weights)
+
+    # Shortest round-trip repr, as json.dumps writes floats; missing scores (and infinite values,
+    # which JSON cannot represent) become null
+    texts = values.astype("S32")
+    texts[~np.isfinite(values)] = b"null"
+
+    parts = [None] * (3 * len(values))
+    parts[0::3] = table["heads"]
+    parts[1::3] = texts.tolist()
+    parts[2::3] = table["tails"]
+    return b"".join([b'{"type": "FeatureCollection", "features": ['] + parts + [b"]}"])
@@ -0,0 +1,104 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import pandas as pd
+
+from sensebox.storage import find_dataset, read_dataset
+
+# Sensor files are read with only the columns the trackwise bikeability and the street snapping use,
+# so both stages can share one decoded copy. Accident files have their own schema and are read in full.
+SENSOR_COLUMNS = ("value", "timestamp", "box_id")
+
+# Files read at the same time by load_sensor_files; pyogrio releases the GIL while decoding
+SENSOR_LOADER_WORKERS = 4
+
+# {stored file: ((mtime, size), Future of the frame)} while a sensor_file_cache() block is active
+_cache = None
+_cache_depth = 0
+_lock = threading.Lock()
+
+
+def sensor_columns(path):
+    """Columns read from a sensor file, or None for all of them."""
+    return None if "accidents" in os.path.basename(path).lower() else list(SENSOR_COLUMNS)
+
+
+@contextmanager
+def sensor_file_cache():
+    """Keeps the sensor files loaded in the block (e.g. one pipeline run) decoded in memory.
+
+    Entries are keyed by the file's mtime and size, so a file rewritten in the meantime is read again.
+    Blocks may be nested and entered from several threads; the cache is dropped when the outermost exits.
+    """
+    global _cache, _cache_depth
+    with _lock:
+        if _cache_depth == 0:
+            _cache = {}
+        _cache_depth += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _cache_depth -= 1
+            if _cache_depth == 0:
+                _cache = None
+
+
+def _read(path):
+    return read_dataset(path, columns=sensor_columns(path))
+
+
+def load_sensor_file(path, geometry=True):
+    """Reads a sensor file (see sensor_columns), from the cache inside a sensor_file_cache() block.
+
+    Returns a copy the caller may modify, without the geometry if ``geometry`` is False (which is
+    then not decoded at all outside a cache block). Raises FileNotFoundError if the file does not exist.
+    """
+    found = find_dataset(path)
+    if found is None:
+        raise FileNotFoundError(f"No dataset stored for {path}")
+
+    with _lock:
+        cache = _cache
+        if cache is None:
+            future = None
+        else:
+            stat = os.stat(found)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            entry = cache.get(found)
+            if entry is not None and entry[0] == stamp:
+                future, owner = entry[1], False
+            else:
+                # Concurrent callers wait for this read instead of decoding the file again
+                future, owner = Future(), True
+                cache[found] = (stamp, future)
+    if future is None:
+        return read_dataset(path, columns=sensor_columns(path), geometry=geometry)
+
+    if owner:
+        try:
+            future.set_result(_read(path))
+        except Exception as err:
+            future.set_exception(err)
+            with _lock:
+                if cache.get(found, (None, None))[1] is future:
+                    del cache[found]
+    frame = future.result()
+    return frame.copy() if geometry else pd.DataFrame(frame.drop(columns=frame.geometry.name))
+
+
+def load_sensor_files(paths, geometry=True, max_workers=SENSOR_LOADER_WORKERS):
+    """Reads sensor files concurrently; returns {path: frame, or the exception reading it raised}."""
+    def load(path):
+        try:
+            return load_sensor_file(path, geometry=geometry)
+        except Exception as err:
+            return err
+
+    paths = list(dict.fromkeys(paths))
+    if max_workers <= 1 or len(paths) <= 1:
+        return {path: load(path) for path in paths}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as pool:
+        return dict(zip(paths, pool.map(load, paths)))
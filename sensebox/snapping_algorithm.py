@@ -7,13 +7,18 @@ import geopandas as gpd
 import pandas as pd
 from shapely.geometry import Point, LineString, shape
 from shapely.ops import nearest_points
+import shapely
 from shapely.strtree import STRtree
-# import multiprocessing as mp
 import numpy as np
 # import fiona
 from uuid import uuid5, NAMESPACE_URL
-from shapely import wkt
-import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from sensebox.storage import write_dataset
+from sensebox.sensor_data import load_sensor_file, load_sensor_files
+from sensebox.snapping_cache import (
+    read_snapping_cache, append_snapping_cache, migrate_csv_cache, has_legacy_segments, rekey_legacy_segments
+)
 
 
 city_data = {
@@ -49,6 +54,9 @@ city_data = {
     }
 }
 
+# Maximum snapping distance in metres (streets CRS units); None snaps every point to its nearest street
+SNAP_MAX_DISTANCE = None
+
 def compute_point_uid(geom, tag=None, value=None):
     """Generates a stable UUIDv5 using normalized WKT + tag + value."""
 
@@ -63,53 +71,100 @@ def compute_point_uid(geom, tag=None, value=None):
     uid_input = f"{geom_str}_{tag_str}_{value_str}"
     return str(uuid5(NAMESPACE_URL, uid_input))
 
-def snap_to_nearest_line(point, streets, street_index):
-    # ref:https://medium.com/data-science/connecting-pois-to-a-road-network-358a81447944
-    """Finds the nearest point on the closest street line using STRtree + distance refinement."""
-    
-    nearest_idx = street_index.nearest(point)  # This might return an index, not a geometry!
-    
-    # Ensure we fetch the actual geometry using the index
-    if isinstance(nearest_idx, np.int64):  # If it's an index, get the geometry
-        possible_nearest_geom = streets.iloc[nearest_idx].geometry
-    else:
-        possible_nearest_geom = nearest_idx  # If it's already a geometry, use it
-    
-    # Validate the geometry
-    if possible_nearest_geom is None or possible_nearest_geom.is_empty:
-        return point  # Return original if invalid
+def compute_point_keys(geometry, tags=None, values=None):
+    """Vectorized stable 64-bit point keys from the coordinates, tag and value of each point.
 
-    # Find the truly closest street using Euclidean distance
-    nearest_index = streets.geometry.distance(point).idxmin()
-    nearest_geom = streets.loc[nearest_index, "geometry"]
+    Hashes the coordinate arrays together with the stripped tag and the value rounded to
+    4 decimals (the same inputs as compute_point_uid) and returns a uint64 array.
+    """
+    geometry = np.asarray(geometry, dtype=object)
+    n = len(geometry)
+    frame = pd.DataFrame({
+        "x": shapely.get_x(geometry),
+        "y": shapely.get_y(geometry),
+        "tag": pd.Series(tags).astype(str).str.strip().to_numpy() if tags is not None else np.full(n, ""),
+        "value": np.round(np.asarray(values, dtype=float), 4) if values is not None else np.zeros(n),
+    })
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+def snap_points_bulk(points, streets, street_index, max_distance=None):
+    """Snaps a whole GeoSeries of points onto their nearest street line in one vectorized pass.
+
+    Uses a single ``STRtree.query_nearest`` call for the lookup and ``shapely.shortest_line`` to
+    find the exact nearest point on each matched street. Returns a GeoDataFrame indexed like
+    ``points`` with the snapped ``geometry`` and the ``index_right`` label of the matched street.
+    Points without a street within ``max_distance`` are dropped.
+    """
+    if isinstance(points, gpd.GeoDataFrame):
+        points = points.geometry
+    elif not isinstance(points, gpd.GeoSeries):
+        points = gpd.GeoSeries(list(points))
 
-    return nearest_points(point, nearest_geom)[1]  # Return the exact nearest point
+    if points.empty or len(street_index) == 0:
+        return gpd.GeoDataFrame({"index_right": pd.Series([], dtype="int64")},
+                                geometry=gpd.GeoSeries([], crs=points.crs), crs=points.crs)
 
+    geoms = np.asarray(points.values, dtype=object)
+    point_pos, street_pos = street_index.query_nearest(geoms, max_distance=max_distance, all_matches=False)
 
-def snap_batch(points_chunk, streets, street_index):
-    """Multiprocessing helper function to snap a batch of points."""
-    return [snap_to_nearest_line(point,streets, street_index) for point in points_chunk]
+    # Nearest point on the matched street = end point of the shortest line towards it
+    street_geoms = np.asarray(street_index.geometries, dtype=object)[street_pos]
+    snapped = shapely.get_point(shapely.shortest_line(geoms[point_pos], street_geoms), 1)
 
-def process_sensor_file(city, sensor_file, streets, street_index):
+    index = points.index[point_pos]
+    return gpd.GeoDataFrame(
+        {"index_right": np.asarray(streets.index)[street_pos]},
+        geometry=gpd.GeoSeries(snapped, index=index, crs=points.crs),
+        index=index,
+    )
+
+
+def snap_to_nearest_line(point, streets, street_index):
+    # ref:https://medium.com/data-science/connecting-pois-to-a-road-network-358a81447944
+    """Finds the nearest point on the closest street line using the STRtree nearest lookup."""
+    snapped = snap_points_bulk([point], streets, street_index)
+    if snapped.empty:
+        return point  # Return original if no street available
+    return snapped.geometry.iloc[0]
+
+
+def snap_batch(points_chunk, streets, street_index):
+    """Snaps a batch of points, keeping the original point where no street was found."""
+    points_chunk = list(points_chunk)
+    snapped = snap_points_bulk(points_chunk, streets, street_index)
+    result = list(points_chunk)
+    for pos, geom in zip(snapped.index, snapped.geometry):
+        result[pos] = geom
+    return result
+
+def aggregate_sensor_file(city, sensor_file, streets, street_index, points=None):
+    """Snaps one sensor file onto the streets and aggregates its values per street.
+
+    ``points`` is the file as returned by load_sensor_file (or the exception loading it raised),
+    if it was loaded already. Returns a DataFrame indexed by the street index label
+    (``index_right``), or None if the file could not be processed.
+    """
     print(f"Processing {sensor_file}...")
 
     sensor_name = os.path.basename(sensor_file).replace(".geojson", "")
     is_accident = "accidents" in sensor_name.lower()
-    cache_path = f"./tracks/cache/snapping_map_{sensor_name}.csv"
+    cache_dir = f"./tracks/cache/snapping_map_{sensor_name}"
     os.makedirs("./tracks/cache", exist_ok=True)
 
-    # === Load raw GeoJSON ===
+    # === Load sensor points ===
     try:
-        with open(sensor_file) as f:
-            data = json.load(f)
-        features = data.get("features", [])
-        if not features:
+        if points is None:
+            points = load_sensor_file(sensor_file)
+        elif isinstance(points, Exception):
+            raise points
+        if points.empty:
             raise ValueError(f"No features in {sensor_file}")
-        points = gpd.GeoDataFrame.from_features(features)
-        points = points.set_crs("EPSG:4326").to_crs(streets.crs)
+        if points.crs is None:
+            points = points.set_crs("EPSG:4326")
+        points = points.to_crs(streets.crs)
     except Exception as e:
         print(f"Error loading {sensor_file}: {e}")
-        return streets
+        return None
 
     # === Clean invalid geometries ===
     points = points[points.geometry.notnull() & points.geometry.apply(lambda g: isinstance(g, Point))]
@@ -122,12 +177,6 @@ def process_sensor_file(city, sensor_file, streets, street_index):
         points = points.dropna(subset=["value"])
         points["UKATEGORIE"] = points["UKATEGORIE"].astype(str).str.strip()
         points["value"] = points["value"].astype(float)
-        # points["point_uid"] = points["point_uid"].astype(str).str.strip()
-        points["point_uid"] = points.apply(
-            lambda row: compute_point_uid(row.geometry, row["UKATEGORIE"], row["value"]),
-            axis=1
-        )
-        # print(points.geometry.iloc[0].wkt)
     else:
         # Standard sensor handling
         if "ms_Overtaking_Distance" in sensor_file:
@@ -141,70 +190,51 @@ def process_sensor_file(city, sensor_file, streets, street_index):
         points["value"] = points["value"].astype(float)
         if "timestamp" in points.columns:
             points["timestamp"] = points["timestamp"].astype(str).str.strip()
-        # points["point_uid"] = points["point_uid"].astype(str).str.strip()
-        points["point_uid"] = points.apply(
-            lambda row: compute_point_uid(row.geometry, row.get("timestamp", ""), row["value"]),
-            axis=1
-        )
-   
-    # === Load cache if exists ===
-    if os.path.exists(cache_path):
-        cached_map = pd.read_csv(cache_path)
-        # Normalize cached point_uid to prevent mismatch
-        cached_map["point_uid"] = cached_map["point_uid"].astype(str).str.strip()
-        cached_map["geometry"] = cached_map["geometry_wkt"].apply(wkt.loads)
-        cached_map = gpd.GeoDataFrame(cached_map, geometry="geometry", crs=streets.crs)
-    else:
-        cached_map = gpd.GeoDataFrame(columns=["point_uid", "geometry", "index_right"], geometry="geometry", crs=streets.crs)
+
+    # === Stable point keys ===
+    tag_column = "UKATEGORIE" if is_accident else "timestamp"
+    tags = points[tag_column] if tag_column in points.columns else None
+    points["point_uid"] = compute_point_keys(points.geometry.values, tags, points["value"])
+
+    # === Load cache (one-time migration from the old WKT CSV cache and UUID keys) ===
+    migrate_csv_cache(f"{cache_dir}.csv", cache_dir, streets, street_index)
+    if has_legacy_segments(cache_dir):
+        legacy_tags = tags.astype(str).str.strip() if tags is not None else pd.Series("", index=points.index)
+        legacy_uids = [
+            compute_point_uid(geom, tag, value)
+            for geom, tag, value in zip(points.geometry, legacy_tags, points["value"])
+        ]
+        rekey_legacy_segments(cache_dir, pd.Series(points["point_uid"].to_numpy(), index=legacy_uids))
+    cached_map = read_snapping_cache(cache_dir, columns=["point_uid", "index_right"])
 
     # === Identify new points to snap ===
-    snapped_uids = set(cached_map["point_uid"])
-    new_points = points[~points["point_uid"].isin(snapped_uids)]
+    new_points = points[~points["point_uid"].isin(cached_map["point_uid"])]
     print(f"New points to snap: {len(new_points)} | Cached: {len(cached_map)}")
 
     if not new_points.empty:
-        # Snap
-        snapped_geoms = snap_batch(new_points.geometry.tolist(), streets, street_index)
-        # Strictly keep only valid shapely Points
-        cleaned_geoms = []
-        for g in snapped_geoms:
-            if isinstance(g, Point):
-                cleaned_geoms.append(g)
-            else:
-                # print(f"Invalid geometry type: {type(g)} - {g}")
-                cleaned_geoms.append(None)
-        new_points = new_points.copy()
-        new_points["geometry"] = cleaned_geoms
-        new_points = new_points.dropna(subset=["geometry"])
-        new_points = gpd.GeoDataFrame(new_points, geometry="geometry", crs=streets.crs)
-
-        # Spatial join to find street segment
-        streets["buffered_geom"] = streets.geometry.buffer(1)
-        new_joined = gpd.sjoin(new_points, streets.set_geometry("buffered_geom"), predicate="intersects")
-        new_map = new_joined[["point_uid", "geometry", "index_right"]].copy()
-
-        # Combine + Save to cache (as CSV with WKT)
-        full_map = pd.concat([cached_map, new_map], ignore_index=True).drop_duplicates("point_uid")
-        full_map["geometry_wkt"] = full_map["geometry"].apply(lambda g: g.wkt)
-        full_map.drop(columns=["geometry"], inplace=True)
-        full_map.to_csv(cache_path, index=False)
-        print(f"Cache updated: {cache_path}")
-        
+        # Snap all new points in one pass; the nearest-street lookup also yields index_right
+        snapped = snap_points_bulk(new_points.geometry, streets, street_index, max_distance=SNAP_MAX_DISTANCE)
+        new_map = pd.DataFrame({
+            "point_uid": new_points.loc[snapped.index, "point_uid"].to_numpy(),
+            "x": snapped.geometry.x.to_numpy(),
+            "y": snapped.geometry.y.to_numpy(),
+            "index_right": snapped["index_right"].to_numpy(),
+        }).drop_duplicates("point_uid")
+
+        # Append the new snaps as a cache segment
+        append_snapping_cache(cache_dir, new_map)
+        print(f"Cache updated: {cache_dir}")
+        full_map = pd.concat([cached_map, new_map[["point_uid", "index_right"]]], ignore_index=True)
     else:
-        # Reload full cache
-        full_map = cached_map.copy()
-        full_map["geometry_wkt"] = full_map["geometry"].apply(lambda g: g.wkt)
-        full_map.drop(columns=["geometry"], inplace=True)
-
-    # === Merge points with snapped geometry and index
-    full_map["geometry"] = full_map["geometry_wkt"].apply(wkt.loads)
-    full_map = gpd.GeoDataFrame(full_map, geometry="geometry", crs=streets.crs)
+        full_map = cached_map
+
+    # === Merge points with the snapped street index
     merged_points = points.merge(full_map, on="point_uid", how="inner")
     
     # === Final aggregation
     if "value" not in merged_points.columns:
         print("No 'value' column found — skipping aggregation.")
-        return streets
+        return None
 
     # === Aggregate per street
     if is_accident:
@@ -213,24 +243,72 @@ def process_sensor_file(city, sensor_file, streets, street_index):
             f"list_{city}_accidents":("value", list),
             f"sum_{city}_accidents": ("value", "sum")
             }
-        ).reset_index()
+        )
     else:
         agg_data = merged_points.groupby("index_right").agg(
             **{
                 f"list_{sensor_name}": ("value", list),
                 f"avg_{sensor_name}": ("value", "mean")
             }
-        ).reset_index()
+        )
+
+    return agg_data
+
+
+def process_sensor_file(city, sensor_file, streets, street_index):
+    """Snaps one sensor file and joins its per-street aggregates into ``streets``."""
+    agg_data = aggregate_sensor_file(city, sensor_file, streets, street_index)
+    if agg_data is None:
+        return streets
+    return streets.join(agg_data, how="left")
+
+
+# Street geometries shared with pool workers, set once per worker process by _init_worker
+_worker_streets = None
+_worker_street_index = None
+
+
+def _init_worker(street_wkb, street_labels, crs):
+    """Rebuilds the streets and their STRtree once per worker process."""
+    global _worker_streets, _worker_street_index
+    geometry = gpd.GeoSeries(shapely.from_wkb(street_wkb), index=street_labels, crs=crs)
+    _worker_streets = gpd.GeoDataFrame(geometry=geometry)
+    _worker_street_index = STRtree(geometry.values)
 
-    # === Merge into streets
-    streets = streets.merge(agg_data, left_index=True, right_on="index_right", how="left")
-    streets.drop(columns=["index_right", "buffered_geom"], errors="ignore", inplace=True)
-    
-    return streets
 
-def process_city(city):
+def _aggregate_in_worker(city, sensor_file):
+    return aggregate_sensor_file(city, sensor_file, _worker_streets, _worker_street_index)
+
+
+def aggregate_sensor_files(city, sensor_files, streets, street_index, workers=1):
+    """Aggregates all sensor files, in a process pool when ``workers`` > 1.
+
+    The street geometries are sent to each worker once as WKB through the pool initializer
+    instead of being pickled with every task; workers read their sensor files themselves.
+    Workers are started from a forkserver rather than forked from this process, whose other
+    threads (pipeline stages) may hold locks a forked child would inherit.
+    Returns the per-file aggregates in file order.
+    """
+    if workers <= 1 or len(sensor_files) <= 1:
+        # The files are read concurrently up front, then snapped one after another
+        loaded = load_sensor_files(sensor_files)
+        return [aggregate_sensor_file(city, f, streets, street_index, points=loaded[f]) for f in sensor_files]
+
+    street_wkb = shapely.to_wkb(np.asarray(streets.geometry.values, dtype=object))
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(sensor_files)),
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_init_worker,
+        initargs=(street_wkb, streets.index.to_numpy(), streets.crs),
+    ) as pool:
+        return list(pool.map(_aggregate_in_worker, [city] * len(sensor_files), sensor_files))
+
+def process_city(city, workers=1):
     """
     Main function to process all sensor files for a city.
+
+    Sensor files are snapped and aggregated independently (in ``workers`` processes when > 1)
+    and merged into the streets in one final join.
     """
     if city not in city_data:
         raise ValueError(f"City '{city}' not found in city_data dictionary!")
@@ -261,9 +339,11 @@ def process_city(city):
     # Build STRtree index for fast nearest street lookup
     street_index = STRtree(streets.geometry.values)
     
-    # Process each sensor file
-    for sensor_file in sensor_files:
-        streets = process_sensor_file(city, sensor_file, streets, street_index)
+    # Process each sensor file, then merge all aggregates at once
+    aggregates = aggregate_sensor_files(city, sensor_files, streets, street_index, workers=workers)
+    aggregates = [agg for agg in aggregates if agg is not None]
+    if aggregates:
+        streets = streets.join(pd.concat(aggregates, axis=1), how="left")
 
     # Select final columns
     keep_columns = [
@@ -287,11 +367,11 @@ def process_city(city):
     base_path = '/app/tracks/BI/' if os.path.exists('/app') else './tracks/BI/'
     os.makedirs(base_path, exist_ok=True)
 
-    # Save updated routes to a new GeoJSON file
+    # Save updated streets for merge_cqi
     output_file = f"osm_streets_{city}_winter.geojson"
     output_path = os.path.join(base_path, output_file)
    
-    streets.to_file(output_path, driver="GeoJSON")
+    output_file = os.path.basename(write_dataset(streets, output_path))
     print(f"Processing completed for {city}. Output saved to {output_file}")
 
     return JsonResponse({ "message": f"Processing completed for {city}. Output saved to {output_file}"})
@@ -0,0 +1,181 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+import shapely
+
+# Each snapping run appends one segment: a structured .npy array that can be memory-mapped on read.
+# point_uid is a uint64 point key; segments written before that hold UUID strings and are re-keyed
+# once by rekey_legacy_segments.
+# The segments are plain NumPy rather than GeoParquet (storage.py): a run adds its segment without
+# rewriting the others, segments can be memory-mapped instead of read, and uint64 keys stay exact.
+SEGMENT_FIELDS = [("x", "f8"), ("y", "f8"), ("index_right", "i8")]
+SEGMENT_PATTERN = "segment_*.npy"
+
+# Segments are merged into one once a cache directory holds more than this many
+MAX_SEGMENTS = 64
+
+
+def _segment_number(path):
+    """Number of a segment file, e.g. 12 for ``segment_00012.npy``."""
+    return int(os.path.splitext(os.path.basename(path))[0].split("_", 1)[1])
+
+
+def _segment_paths(cache_dir):
+    # Sorted numerically: names are zero-padded to 5 digits, but longer numbers are not
+    return sorted(glob.glob(os.path.join(cache_dir, SEGMENT_PATTERN)), key=_segment_number)
+
+
+def iter_segments(cache_dir, mmap=True):
+    """Yields the cache segments of ``cache_dir`` as (memory-mapped) structured arrays."""
+    for path in _segment_paths(cache_dir):
+        yield np.load(path, mmap_mode="r" if mmap else None)
+
+
+def read_snapping_cache(cache_dir, columns=None, mmap=True):
+    """Reads all segments of a snapping cache into one DataFrame.
+
+    Returns the columns ``point_uid``, ``x``, ``y`` and ``index_right`` (or only ``columns``).
+    """
+    columns = columns or ["point_uid"] + [name for name, _ in SEGMENT_FIELDS]
+    segments = [seg for seg in iter_segments(cache_dir, mmap=mmap) if len(seg)]
+    if not segments:
+        return pd.DataFrame({col: pd.Series([], dtype=_column_dtype(col)) for col in columns})
+
+    return pd.concat(
+        [pd.DataFrame({col: _column_values(seg, col) for col in columns}) for seg in segments],
+        ignore_index=True,
+    )
+
+
+def _column_values(segment, column):
+    values = np.asarray(segment[column])
+    if values.dtype.kind == "S":
+        # UUID string keys are stored as fixed-width ASCII bytes
+        return np.char.decode(values, "ascii").astype(object)
+    return values
+
+
+def _column_dtype(column):
+    return dict(SEGMENT_FIELDS).get(column, "object")
+
+
+def _to_segment(frame):
+    """Converts a (point_uid, x, y, index_right) DataFrame into a structured array."""
+    uids = frame["point_uid"].to_numpy()
+    if uids.dtype == object:
+        uids = uids.astype(str).astype("S")
+    segment = np.empty(len(frame), dtype=[("point_uid", uids.dtype)] + SEGMENT_FIELDS)
+    segment["point_uid"] = uids
+    for name, _ in SEGMENT_FIELDS:
+        segment[name] = frame[name].to_numpy()
+    return segment
+
+
+def _write_segment(cache_dir, segment, number):
+    path = os.path.join(cache_dir, f"segment_{number:05d}.npy")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, segment)
+    os.replace(tmp_path, path)
+    return path
+
+
+def append_snapping_cache(cache_dir, frame):
+    """Appends newly snapped points as a new segment without rewriting existing ones."""
+    if frame.empty:
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    existing = _segment_paths(cache_dir)
+    number = _segment_number(existing[-1]) + 1 if existing else 0
+    path = _write_segment(cache_dir, _to_segment(frame), number)
+
+    if len(existing) + 1 > MAX_SEGMENTS:
+        compact_snapping_cache(cache_dir)
+    return path
+
+
+def compact_snapping_cache(cache_dir):
+    """Merges all segments of a cache directory into a single segment.
+
+    Skipped while UUID-keyed segments are left: merged with point keys they would turn every key
+    into a string, and rekey_legacy_segments would then drop them all.
+    """
+    paths = _segment_paths(cache_dir)
+    if len(paths) <= 1 or has_legacy_segments(cache_dir):
+        return
+    frame = read_snapping_cache(cache_dir, mmap=False).drop_duplicates("point_uid")
+    last = _segment_number(paths[-1])
+    _write_segment(cache_dir, _to_segment(frame), last + 1)
+    for path in paths:
+        os.remove(path)
+    print(f"Compacted {len(paths)} cache segments in {cache_dir}")
+
+
+def _is_legacy(path):
+    return np.load(path, mmap_mode="r").dtype["point_uid"].kind == "S"
+
+
+def has_legacy_segments(cache_dir):
+    """Returns True if the cache still holds segments keyed by UUID strings."""
+    return any(_is_legacy(path) for path in _segment_paths(cache_dir))
+
+
+def rekey_legacy_segments(cache_dir, key_map):
+    """Re-keys UUID-keyed segments to point keys using ``key_map`` (a Series UUID -> key).
+
+    Cached points whose UUID is not in ``key_map`` are dropped. Returns the number of re-keyed rows.
+    """
+    paths = _segment_paths(cache_dir)
+    legacy = [path for path in paths if _is_legacy(path)]
+    if not legacy:
+        return 0
+
+    key_map = key_map[~key_map.index.duplicated()]
+    frames = []
+    for path in legacy:
+        segment = np.load(path)
+        frame = pd.DataFrame({col: _column_values(segment, col) for col in segment.dtype.names})
+        # Positional lookup keeps the uint64 keys exact (Series.map would go through float64)
+        positions = key_map.index.get_indexer(frame["point_uid"])
+        frame = frame[positions >= 0].copy()
+        frame["point_uid"] = key_map.to_numpy()[positions[positions >= 0]]
+        frames.append(frame)
+    rekeyed = pd.concat(frames, ignore_index=True).drop_duplicates("point_uid")
+
+    last = _segment_number(paths[-1])
+    _write_segment(cache_dir, _to_segment(rekeyed), last + 1)
+    for path in legacy:
+        os.remove(path)
+    print(f"Re-keyed {len(rekeyed)} cached points in {cache_dir}")
+    return len(rekeyed)
+
+
+def migrate_csv_cache(csv_path, cache_dir, streets, street_index):
+    """One-time migration of a WKT CSV snapping cache into the binary segment format.
+
+    The street index is re-derived from the cached snapped geometries, since the CSV caches
+    could hold labels from an already merged streets frame. The CSV is renamed to
+    ``*.csv.migrated`` afterwards.
+    """
+    if not os.path.exists(csv_path) or _segment_paths(cache_dir):
+        return False
+
+    cached = pd.read_csv(csv_path, usecols=["point_uid", "geometry_wkt"])
+    cached["point_uid"] = cached["point_uid"].astype(str).str.strip()
+    cached = cached.drop_duplicates("point_uid")
+    geoms = shapely.from_wkt(cached["geometry_wkt"].to_numpy())
+    valid = ~shapely.is_missing(geoms) & (shapely.get_type_id(geoms) == 0)
+    cached, geoms = cached[valid], geoms[valid]
+
+    point_pos, street_pos = street_index.query_nearest(geoms, all_matches=False)
+    migrated = pd.DataFrame({
+        "point_uid": cached["point_uid"].to_numpy()[point_pos],
+        "x": shapely.get_x(geoms[point_pos]),
+        "y": shapely.get_y(geoms[point_pos]),
+        "index_right": np.asarray(streets.index)[street_pos],
+    })
+    append_snapping_cache(cache_dir, migrated)
+    os.replace(csv_path, csv_path + ".migrated")
+    print(f"Migrated {len(migrated)} cached points from {csv_path} to {cache_dir}")
+    return True
@@ -0,0 +1,155 @@
+import os
+import json
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.conf import settings
+
+# Intermediate datasets of the pipeline are addressed by their historical GeoJSON path
+# (e.g. ./tracks/BI/osm_streets_ms.geojson) and stored next to it as GeoParquet, which reads several
+# times faster than GeoJSON and supports reading a subset of the columns.
+PARQUET_EXTENSION = ".parquet"
+GEOJSON_EXTENSION = ".geojson"
+
+
+def _base(path):
+    return os.path.splitext(path)[0]
+
+
+def storage_path(path):
+    """The file a dataset is written to."""
+    return _base(path) + PARQUET_EXTENSION
+
+
+def find_dataset(path):
+    """The stored file of a dataset, preferring the GeoParquet copy over GeoJSON; None if missing.
+
+    A plain GeoJSON file is still found, so inputs and output of older runs remain readable.
+    """
+    base = _base(path)
+    for extension in (PARQUET_EXTENSION, GEOJSON_EXTENSION):
+        if os.path.exists(base + extension):
+            return base + extension
+    return None
+
+
+def dataset_exists(path):
+    return find_dataset(path) is not None
+
+
+def read_dataset(path, columns=None, geometry=True):
+    """Reads a dataset, optionally only ``columns`` (and the geometry unless ``geometry`` is False)."""
+    found = find_dataset(path)
+    if found is None:
+        raise FileNotFoundError(f"No dataset stored for {path}")
+
+    if found.endswith(PARQUET_EXTENSION):
+        if not geometry:
+            return pd.read_parquet(found, columns=columns)
+        return gpd.read_parquet(found, columns=None if columns is None else list(columns) + ["geometry"])
+    # Timestamps stay the strings they were written as, GDAL would parse them into datetimes
+    return gpd.read_file(found, columns=columns, ignore_geometry=not geometry, datetime_as_string=True)
+
+
+def write_dataset(gdf, path, geojson=None):
+    """Writes a dataset as GeoParquet and returns the path of the file.
+
+    A GeoJSON copy for people to look at is written as well if ``geojson`` is True, or if it is None
+    and the PIPELINE_GEOJSON_EXPORT setting is on; otherwise an older GeoJSON file is removed.
+    """
+    target = storage_path(path)
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+
+    # Written under a temporary name, so readers never see a half-written file
+    tmp = _tmp_path(target)
+    gdf.to_parquet(tmp)
+    os.replace(tmp, target)
+    _finish(path, geojson, lambda: gdf)
+    return target
+
+
+class DatasetWriter:
+    """Writes a dataset chunk by chunk, so it never has to be in memory as a whole.
+
+        with DatasetWriter(path) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+
+    Chunks must have the same columns. The dataset replaces the previous one when the block exits
+    without an exception, as in write_dataset; if nothing was written, the previous one is kept.
+    """
+
+    def __init__(self, path, geojson=None):
+        self.path = path
+        self.geojson = geojson
+        self.target = storage_path(path)
+        self.tmp = _tmp_path(self.target)
+        self.rows = 0
+        self._parquet = None
+
+    def write(self, gdf):
+        if gdf.empty:
+            return
+        table = _arrow_table(gdf)
+        if self._parquet is None:
+            os.makedirs(os.path.dirname(self.target) or ".", exist_ok=True)
+            self._parquet = pq.ParquetWriter(self.tmp, table.schema)
+        self._parquet.write_table(table)
+        self.rows += len(gdf)
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+        if self.rows:
+            os.replace(self.tmp, self.target)
+            _finish(self.path, self.geojson, lambda: read_dataset(self.path))
+
+    def abort(self):
+        if self._parquet is not None:
+            self._parquet.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _tmp_path(target):
+    base, extension = os.path.splitext(target)
+    return base + ".tmp" + extension
+
+
+def _arrow_table(gdf):
+    """GeoParquet table of one chunk, with geo metadata that holds for every chunk of the dataset."""
+    table = pa.table(gdf.to_arrow(index=False))
+    name = gdf.geometry.name
+    # No bbox, and an empty list of geometry types (meaning unknown): both would describe this chunk only
+    column = {"encoding": "WKB", "geometry_types": []}
+    if gdf.crs is not None:
+        column["crs"] = gdf.crs.to_json_dict()
+    geo = {"version": "1.0.0", "primary_column": name, "columns": {name: column}}
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), b"geo": json.dumps(geo).encode()})
+
+
+def _finish(path, geojson, frame):
+    """Writes the GeoJSON copy if asked to (of ``frame()``), otherwise removes an older one."""
+    if geojson is None:
+        geojson = getattr(settings, "PIPELINE_GEOJSON_EXPORT", False)
+    if geojson:
+        export_geojson(frame(), path)
+    elif os.path.exists(_base(path) + GEOJSON_EXTENSION):
+        os.remove(_base(path) + GEOJSON_EXTENSION)
+
+
+def export_geojson(gdf, path):
+    """Writes the GeoJSON copy of a dataset."""
+    geojson_path = _base(path) + GEOJSON_EXTENSION
+    gdf.to_file(geojson_path, driver="GeoJSON")
+    return geojson_path
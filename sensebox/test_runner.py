@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TempCacheTestRunner(DiscoverRunner):
+    """Runs the tests with the file based response caches in a temporary directory.
+
+    FileBasedCache creates its directory as soon as it is set up, which the system checks
+    already do, so overriding CACHES in the test classes alone still left
+    tracks/cache/responses behind in the repository.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_dir = tempfile.mkdtemp(prefix="responses-")
+        caches = {
+            alias: {**settings.CACHES[alias], "LOCATION": os.path.join(self.cache_dir, alias)}
+            for alias, cache in settings.CACHES.items() if cache["BACKEND"].endswith("FileBasedCache")
+        }
+        self.cache_settings = override_settings(CACHES={**settings.CACHES, **caches})
+        self.cache_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.cache_settings.disable()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
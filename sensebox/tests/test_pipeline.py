@@ -0,0 +1,168 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from sensebox.pipeline import Pipeline, PipelineError, Stage
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.calls = []
+        self.fail = set()
+        self.remote = {"version": 1}
+        self.locked = False
+        self.messages = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def writer(self, name, *outputs):
+        def run():
+            self.calls.append(name)
+            if name in self.fail:
+                raise RuntimeError(f"{name} broke")
+            for output in outputs:
+                with open(self.path(output), "w") as f:
+                    f.write(f"{name} {len(self.calls)}")
+        return run
+
+    def pipeline(self, barrier=None):
+        def snapping():
+            if barrier is not None:
+                barrier.wait(timeout=5)  # only passes if trackwise runs at the same time
+            self.writer("snapping", "streets.txt")()
+
+        def trackwise():
+            if barrier is not None:
+                barrier.wait(timeout=5)
+            self.writer("trackwise", "routes.txt")()
+
+        stages = [
+            Stage("fetch", self.writer("fetch"), outputs=["remote"], volatile=True),
+            Stage("sensors", self.writer("sensors", "sensors.txt"), inputs=["remote"], outputs=[self.path("sensors.txt")]),
+            Stage("trackwise", trackwise, inputs=[self.path("sensors.txt")], outputs=[self.path("routes.txt")]),
+            Stage("snapping", snapping, inputs=[self.path("sensors.txt")], outputs=[self.path("streets.txt")]),
+            Stage("normalize", self.writer("normalize", "normalized.txt"),
+                  inputs=[self.path("streets.txt")], outputs=[self.path("normalized.txt")]),
+        ]
+        return Pipeline(stages, self.path("state.json"), fingerprints={"remote": self.remote_version},
+                        log=self.messages.append)
+
+    def remote_version(self):
+        if self.locked:
+            raise RuntimeError("database is locked")
+        return self.remote["version"]
+
+    def test_dependencies_from_inputs_and_outputs(self):
+        self.assertEqual(self.pipeline().dependencies, {
+            "fetch": set(), "sensors": {"fetch"}, "trackwise": {"sensors"}, "snapping": {"sensors"},
+            "normalize": {"snapping"},
+        })
+
+    def test_independent_stages_run_concurrently(self):
+        statuses = self.pipeline(barrier=threading.Barrier(2)).run()
+        self.assertEqual(set(statuses.values()), {"done"})
+
+    def test_unchanged_inputs_are_skipped(self):
+        self.pipeline().run()
+        self.calls.clear()
+
+        # The fetch always runs, but brings nothing new
+        statuses = self.pipeline().run()
+        self.assertEqual(self.calls, ["fetch"])
+        self.assertEqual(statuses["normalize"], "skipped")
+
+        # New remote data reruns everything downstream
+        self.calls.clear()
+        self.remote["version"] = 2
+        self.pipeline().run()
+        self.assertEqual(sorted(self.calls), ["fetch", "normalize", "sensors", "snapping", "trackwise"])
+
+    def test_changed_or_missing_outputs_rerun_their_stage(self):
+        self.pipeline().run()
+        self.calls.clear()
+        os.remove(self.path("normalized.txt"))
+        self.pipeline().run()
+        self.assertEqual(self.calls, ["fetch", "normalize"])
+
+    def test_failed_run_is_resumed_without_fetching_again(self):
+        self.fail.add("snapping")
+        with self.assertRaises(PipelineError):
+            self.pipeline().run()
+        state = json.load(open(self.path("state.json")))
+        self.assertEqual(state["run"]["status"], "failed")
+        self.assertEqual(state["stages"]["snapping"]["error"], "RuntimeError: snapping broke")
+        self.assertNotIn("normalize", state["stages"])
+        self.assertEqual(state["stages"]["trackwise"]["status"], "done")
+        self.assertIn("seconds", state["stages"]["trackwise"])
+
+        self.fail.clear()
+        self.calls.clear()
+        statuses = self.pipeline().run()
+        self.assertEqual(self.calls, ["snapping", "normalize"])
+        self.assertEqual(statuses["fetch"], "skipped")
+        self.assertEqual(json.load(open(self.path("state.json")))["run"]["status"], "done")
+
+    def test_fingerprint_errors_fail_the_stage(self):
+        # While the stage runs
+        self.locked = True
+        with self.assertRaises(PipelineError):
+            self.pipeline().run()
+        state = json.load(open(self.path("state.json")))
+        self.assertEqual(state["stages"]["fetch"]["error"], "RuntimeError: database is locked")
+
+        # While deciding whether the stage can be skipped, when resuming the run
+        self.locked = False
+        self.fail.add("snapping")
+        with self.assertRaises(PipelineError):
+            self.pipeline().run()
+        self.locked = True
+        self.calls.clear()
+        with self.assertRaises(PipelineError):
+            self.pipeline().run()
+        self.assertEqual(self.calls, [])
+        state = json.load(open(self.path("state.json")))
+        self.assertEqual(state["stages"]["fetch"]["status"], "failed")
+        self.assertEqual(state["stages"]["fetch"]["error"], "RuntimeError: database is locked")
+        self.assertEqual(state["run"]["status"], "failed")
+
+    def test_force_and_fresh(self):
+        self.pipeline().run()
+        self.calls.clear()
+        self.pipeline().run(force=True)
+        self.assertEqual(len(self.calls), 5)
+
+        self.fail.add("normalize")
+        self.remote["version"] = 2
+        with self.assertRaises(PipelineError):
+            self.pipeline().run()
+        self.fail.clear()
+        self.calls.clear()
+        self.pipeline().run(fresh=True)
+        self.assertEqual(self.calls, ["fetch", "normalize"])
+
+    def test_refresh_pipeline_scans_sensors_once(self):
+        from sensebox.management.commands.fetch_bike_data import refresh_pipeline
+
+        dependencies = refresh_pipeline(["ms", "os"], prebuild_routes=True).dependencies
+        self.assertEqual(dependencies["preprocessing_sensors"], {"fetch:ms", "fetch:os"})
+        self.assertEqual(dependencies["process_city:os"], {"preprocessing_sensors"})
+        self.assertEqual(dependencies["bikeability_trackwise:ms"], {"preprocessing_sensors", "preprocessing_tracks:ms"})
+        self.assertEqual(dependencies["prebuild_routes"], {"precompute_normalized_data:ms"})
+
+    def test_cycles_are_rejected(self):
+        with self.assertRaises(PipelineError):
+            Pipeline([
+                Stage("a", lambda: None, inputs=["y"], outputs=["x"]),
+                Stage("b", lambda: None, inputs=["x"], outputs=["y"]),
+            ], self.path("state.json"))
+
+
+if __name__ == '__main__':
+    unittest.main()
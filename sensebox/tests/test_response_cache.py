@@ -0,0 +1,146 @@
+import gzip
+import json
+import os
+import tempfile
+from unittest.mock import patch
+
+import geopandas as gpd
+from django.test import SimpleTestCase, RequestFactory, override_settings
+from shapely.geometry import LineString
+
+from sensebox import score_store
+from sensebox.response_cache import cached_response, normalize_weights, response_etag
+from sensebox.score_store import data_version, write_data_version
+from sensebox.views import osm_segements_bikeability_index_view
+
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "responses": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "responses-test"},
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CachedResponseTest(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.body = json.dumps({"type": "FeatureCollection", "features": [{"id": "0"}] * 200}).encode()
+        self.builds = 0
+
+    def tearDown(self):
+        from django.core.cache import caches
+        caches["responses"].clear()
+
+    def build(self):
+        self.builds += 1
+        return self.body
+
+    def test_body_is_built_once_and_sent_compressed(self):
+        etag = response_etag("test", 1)
+        first = cached_response(self.factory.get("/", HTTP_ACCEPT_ENCODING="gzip, deflate"), "k", etag, self.build)
+        second = cached_response(self.factory.get("/"), "k", etag, self.build)
+
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(first["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(first.content), self.body)
+        self.assertFalse(second.has_header("Content-Encoding"))
+        self.assertEqual(second.content, self.body)
+        self.assertEqual(first["ETag"], etag)
+        self.assertIn("Accept-Encoding", first["Vary"])
+
+    def test_matching_etag_returns_304_without_building(self):
+        etag = response_etag("test", 1)
+        response = cached_response(self.factory.get("/", HTTP_IF_NONE_MATCH=etag), "k", etag, self.build)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.builds, 0)
+
+    def test_refused_encoding_is_not_used(self):
+        etag = response_etag("test", 1)
+        response = cached_response(self.factory.get("/", HTTP_ACCEPT_ENCODING="gzip;q=0"), "k", etag, self.build)
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    def test_normalize_weights(self):
+        self.assertEqual(
+            normalize_weights({"environment_quality": "0.1", "safety": 0.4, "infrastructure_quality": 0.5, "other": 1}),
+            (("safety", 0.4), ("infrastructure_quality", 0.5), ("environment_quality", 0.1)),
+        )
+        for value in ("Infinity", "nan", 1e999):
+            with self.assertRaises(ValueError):
+                normalize_weights({"safety": value, "infrastructure_quality": 0.5, "environment_quality": 0.1})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BikeabilityViewCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        os.makedirs("tracks/BI")
+        gpd.GeoDataFrame({
+            "safety_score": [0.5, 0.2],
+            "infrastructure_score": [0.4, 0.9],
+            "environment_score": [0.3, 0.1],
+            "id": ["way/1", "way/2"],
+        }, geometry=[LineString([(7.6, 51.9), (7.61, 51.91)]), LineString([(7.62, 51.92), (7.63, 51.93)])],
+            crs="EPSG:4326").to_file("tracks/BI/osm_normalized_ms.geojson", driver="GeoJSON")
+        write_data_version("ms")
+        score_store._score_tables.clear()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        from django.core.cache import caches
+        caches["responses"].clear()
+        score_store._score_tables.clear()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def post(self, weights, **headers):
+        request = self.factory.post("/", data=json.dumps(weights), content_type="application/json", **headers)
+        return osm_segements_bikeability_index_view(request, "ms")
+
+    def test_get_uses_default_weights(self):
+        response = osm_segements_bikeability_index_view(self.factory.get("/"), "ms")
+        features = json.loads(response.content)["features"]
+        self.assertAlmostEqual(features[0]["properties"]["bikeability_index"], 0.5 * 0.4 + 0.4 * 0.5 + 0.3 * 0.1)
+
+    def test_repeated_weights_are_served_from_cache(self):
+        weights = {"safety": 40, "infrastructure_quality": 50, "environment_quality": 10}
+        with patch("sensebox.views.bikeability_geojson", wraps=score_store.bikeability_geojson) as build:
+            first = self.post(weights)
+            second = self.post(weights)
+            revalidated = self.post(weights, HTTP_IF_NONE_MATCH=first["ETag"])
+
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_new_data_version_changes_the_etag(self):
+        weights = {"safety": 40, "infrastructure_quality": 50, "environment_quality": 10}
+        first = self.post(weights)
+        old_version = data_version("ms")
+        write_data_version("ms")
+
+        response = self.post(weights, HTTP_IF_NONE_MATCH=first["ETag"])
+
+        self.assertNotEqual(data_version("ms"), old_version)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], first["ETag"])
+
+    def test_detail_is_part_of_the_response(self):
+        full = osm_segements_bikeability_index_view(self.factory.get("/"), "ms")
+        overview = osm_segements_bikeability_index_view(self.factory.get("/?zoom=10"), "ms")
+        invalid = osm_segements_bikeability_index_view(self.factory.get("/?detail=tiny"), "ms")
+
+        self.assertNotEqual(full["ETag"], overview["ETag"])
+        self.assertEqual(invalid.status_code, 400)
+
+    def test_missing_weights_are_rejected(self):
+        self.assertEqual(self.post({"safety": 1}).status_code, 400)
+
+    def test_unknown_city(self):
+        response = osm_segements_bikeability_index_view(self.factory.get("/"), "ol")
+        self.assertEqual(response.status_code, 404)
+
+    def test_non_finite_weights_are_rejected(self):
+        response = self.post({"safety": "Infinity", "infrastructure_quality": 0.3, "environment_quality": 0.2})
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,309 @@
+import json
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from sensebox.routing import (
+    RouterPool, RoutingError, profile_file_lock, profile_key, prepare_profile_dir, quantize_weights,
+    prune_profile_cache, read_profile_marker
+)
+
+# Stand-in for osrm-customize: records the dataset and the traffic file it was called with
+STUB_CUSTOMIZE = """
+import sys
+dataset = sys.argv[1]
+with open(dataset + ".cell_metrics", "a") as f:
+    f.write(sys.argv[2] + "\\n")
+"""
+
+# Stand-in for osrm-routed: loads slowly, then answers every request with its dataset and port
+STUB_ROUTED = """
+import json, sys, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+args = sys.argv[1:]
+port = int(args[args.index("--port") + 1])
+dataset = args[-1]
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(0.05)
+        status = 400 if "nowhere" in self.path else 200
+        body = json.dumps({"code": "Ok" if status == 200 else "NoRoute", "dataset": dataset,
+                           "port": port, "path": self.path}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+time.sleep(0.2)
+print("[info] running and waiting for requests", flush=True)
+server.serve_forever()
+"""
+
+STUB_BROKEN = """
+import sys
+print("[error] Required files are missing", flush=True)
+sys.exit(1)
+"""
+
+
+def write_stub(directory, name, source):
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write(f"#!{sys.executable}\n{source}")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+class RouterPoolTest(unittest.TestCase):
+    """Runs the router pool against stub OSRM binaries"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        os.makedirs(os.path.join(root, "work"))
+        self.dataset = os.path.join(root, "work", "smol.osrm")
+        for suffix in ["", ".cell_metrics", ".partition"]:
+            with open(self.dataset + suffix, "w") as f:
+                f.write("base")
+        self.customize = write_stub(root, "osrm-customize", STUB_CUSTOMIZE)
+        self.routed = write_stub(root, "osrm-routed", STUB_ROUTED)
+        self.traffic_calls = []
+        self.pools = []
+        self.version = "v1"
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.shutdown()
+        self.tmpdir.cleanup()
+
+    def write_traffic(self, weights, path):
+        self.traffic_calls.append(profile_key(weights))
+        with open(path, "w") as f:
+            f.write("1,2,20\n")
+
+    def make_pool(self, **kwargs):
+        pool = RouterPool(
+            self.write_traffic, data_version=lambda: self.version, base_dataset=self.dataset,
+            profiles_dir=os.path.join(self.tmpdir.name, "work", "profiles"),
+            customize=self.customize, routed=kwargs.pop("routed", self.routed), ready_timeout=10, **kwargs
+        )
+        self.pools.append(pool)
+        return pool
+
+    def weights(self, safety=50):
+        return {"safety": safety, "infrastructure_quality": 40, "environment_quality": 10}
+
+    def test_profile_key(self):
+        self.assertEqual(profile_key(self.weights()), "e10_i40_s50")
+
+    def test_profile_dir_copies_customized_files(self):
+        profile_dir = os.path.join(self.tmpdir.name, "profile")
+        dataset = prepare_profile_dir(profile_dir, self.dataset)
+
+        self.assertEqual(dataset, os.path.join(profile_dir, "smol.osrm"))
+        self.assertTrue(os.path.islink(dataset + ".partition"))
+        self.assertFalse(os.path.islink(dataset + ".cell_metrics"))
+
+    def test_router_is_reused_per_profile(self):
+        pool = self.make_pool()
+        status, body = pool.route(self.weights(), "/route/v1/driving/7.6,51.9;7.62,51.96")
+        status_again, body_again = pool.route(self.weights(), "/route/v1/driving/7.6,51.9;7.62,51.96")
+
+        self.assertEqual((status, status_again), (200, 200))
+        self.assertEqual(json.loads(body)["port"], json.loads(body_again)["port"])
+        self.assertEqual(self.traffic_calls, ["e10_i40_s50"])
+
+        # The profile got its own customized copy; the base dataset is untouched
+        profile_dataset = json.loads(body)["dataset"]
+        self.assertIn(os.path.join("profiles", "e10_i40_s50"), profile_dataset)
+        with open(profile_dataset + ".cell_metrics") as f:
+            self.assertIn("--segment-speed-file=", f.read())
+        with open(self.dataset + ".cell_metrics") as f:
+            self.assertEqual(f.read(), "base")
+
+    def test_concurrent_requests_start_one_router(self):
+        pool = self.make_pool(max_inflight=2)
+        results = []
+
+        def request():
+            results.append(pool.route(self.weights(), "/route/v1/driving/7.6,51.9;7.62,51.96"))
+
+        threads = [threading.Thread(target=request) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 6)
+        self.assertTrue(all(status == 200 for status, _ in results))
+        self.assertEqual(len({json.loads(body)["port"] for _, body in results}), 1)
+        self.assertEqual(self.traffic_calls, ["e10_i40_s50"])
+
+    def test_least_recently_used_router_is_stopped(self):
+        pool = self.make_pool(max_routers=2)
+        first = pool.get(self.weights(10))
+        pool.release(first)
+        stop, locked = first.stop, []
+        first.stop = lambda: (locked.append(pool._lock.locked()), stop())
+        for safety in (20, 30):
+            pool.release(pool.get(self.weights(safety)))
+
+        self.assertEqual(list(pool.routers), ["e10_i40_s20", "e10_i40_s30"])
+        self.assertEqual(locked, [False])  # other requests are not held up while it exits
+        first.process.wait(5)
+        self.assertFalse(first.alive())
+
+    def test_weights_are_quantized(self):
+        self.assertEqual(
+            quantize_weights({"safety": 47, "infrastructure_quality": 42, "environment_quality": 11}),
+            {"safety": 50, "infrastructure_quality": 40, "environment_quality": 10},
+        )
+        self.assertEqual(quantize_weights({"safety": 47}, step=25), {"safety": 50})
+
+    def test_nearby_weights_share_a_profile(self):
+        pool = self.make_pool()
+        _, body = pool.route(self.weights(50), "/route/v1/driving/7.6,51.9;7.62,51.96")
+        _, body_near = pool.route(self.weights(52), "/route/v1/driving/7.6,51.9;7.62,51.96")
+
+        self.assertEqual(json.loads(body)["port"], json.loads(body_near)["port"])
+        self.assertEqual(self.traffic_calls, ["e10_i40_s50"])
+
+    def test_customized_profiles_are_reused_from_disk(self):
+        first = self.make_pool()
+        first.route(self.weights(), "/route/v1/driving/7.6,51.9;7.62,51.96")
+        first.shutdown()
+
+        # A new process (pool) starts its router without customizing again
+        second = self.make_pool()
+        status, _ = second.route(self.weights(), "/route/v1/driving/7.6,51.9;7.62,51.96")
+        self.assertEqual(status, 200)
+        self.assertEqual(self.traffic_calls, ["e10_i40_s50"])
+
+    def test_pools_sharing_the_cache_customize_a_profile_once(self):
+        # Two pools stand in for runserver and the prebuild job, which only share the directory
+        pools = [self.make_pool(), self.make_pool()]
+        write_traffic = self.write_traffic
+
+        def slow_write_traffic(weights, path):
+            time.sleep(0.2)
+            write_traffic(weights, path)
+        for pool in pools:
+            pool.write_traffic = slow_write_traffic
+
+        threads = [threading.Thread(target=pool.build_profile, args=(self.weights(),)) for pool in pools]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.traffic_calls, ["e10_i40_s50"])
+
+    def test_new_data_version_rebuilds_the_profile(self):
+        pool = self.make_pool()
+        _, body = pool.route(self.weights(), "/route/v1/driving/7.6,51.9;7.62,51.96")
+        self.version = "v2"
+        _, body_new = pool.route(self.weights(), "/route/v1/driving/7.6,51.9;7.62,51.96")
+
+        self.assertEqual(self.traffic_calls, ["e10_i40_s50", "e10_i40_s50"])
+        self.assertNotEqual(json.loads(body)["port"], json.loads(body_new)["port"])
+
+    def test_prebuild_popular_profiles(self):
+        pool = self.make_pool()
+        for _ in range(3):
+            pool.release(pool.get(self.weights(80)))
+        pool.release(pool.get(self.weights(20)))
+        pool.shutdown()
+        self.version = "v2"
+        self.traffic_calls.clear()
+
+        built = self.make_pool().prebuild()
+
+        self.assertEqual(built[:3], ["e10_i40_s50", "e10_i40_s80", "e10_i40_s20"])
+        self.assertEqual(self.traffic_calls, built)
+
+    def test_hits_are_written_at_intervals(self):
+        pool = self.make_pool(hit_flush_interval=3600)
+        for _ in range(3):
+            pool.release(pool.get(self.weights()))
+        profile_dir = os.path.join(self.tmpdir.name, "work", "profiles", "e10_i40_s50")
+        self.assertEqual(read_profile_marker(profile_dir)["hits"], 0)
+
+        pool.shutdown()
+        self.assertEqual(read_profile_marker(profile_dir)["hits"], 3)
+
+        pool = self.make_pool(hit_flush_interval=0)
+        pool.release(pool.get(self.weights()))
+        self.assertEqual(read_profile_marker(profile_dir)["hits"], 4)
+
+    def test_osrm_errors_are_passed_through(self):
+        pool = self.make_pool()
+        status, body = pool.route(self.weights(), "/route/v1/driving/nowhere")
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(body)["code"], "NoRoute")
+
+    def test_router_that_exits_is_reported(self):
+        pool = self.make_pool(routed=write_stub(self.tmpdir.name, "osrm-broken", STUB_BROKEN))
+        with self.assertRaises(RoutingError):
+            pool.route(self.weights(), "/route/v1/driving/7.6,51.9;7.62,51.96")
+
+
+class PruneProfileCacheTest(unittest.TestCase):
+    def test_least_recently_used_profiles_are_removed(self):
+        with tempfile.TemporaryDirectory() as profiles_dir:
+            for i, key in enumerate(["old", "kept", "new"]):
+                os.makedirs(os.path.join(profiles_dir, key))
+                with open(os.path.join(profiles_dir, key, "smol.osrm.cell_metrics"), "wb") as f:
+                    f.write(b"x" * 100)
+                marker = os.path.join(profiles_dir, key, "profile.json")
+                with open(marker, "w") as f:
+                    json.dump({"version": "v1", "hits": 0}, f)
+                os.utime(marker, (1000 + i, 1000 + i))
+
+            removed = prune_profile_cache(profiles_dir, max_bytes=300, keep={"kept"})
+
+            self.assertEqual(removed, ["old"])
+            self.assertEqual(sorted(os.listdir(profiles_dir)), ["kept", "new"])
+
+    def make_profile(self, profiles_dir, key, last_used=None):
+        os.makedirs(os.path.join(profiles_dir, key))
+        with open(os.path.join(profiles_dir, key, "smol.osrm.cell_metrics"), "wb") as f:
+            f.write(b"x" * 100)
+        if last_used is not None:
+            marker = os.path.join(profiles_dir, key, "profile.json")
+            with open(marker, "w") as f:
+                json.dump({"version": "v1", "hits": 0}, f)
+            os.utime(marker, (last_used, last_used))
+
+    def test_profiles_being_built_are_not_removed(self):
+        with tempfile.TemporaryDirectory() as profiles_dir:
+            # No marker yet: just created by a build in another thread or process
+            self.make_profile(profiles_dir, "building")
+            self.make_profile(profiles_dir, "locked", last_used=1000)
+            self.make_profile(profiles_dir, "used", last_used=2000)
+
+            with profile_file_lock(os.path.join(profiles_dir, "locked")):
+                removed = prune_profile_cache(profiles_dir, max_bytes=100)
+
+            self.assertEqual(removed, ["used"])
+            self.assertEqual(sorted(os.listdir(profiles_dir)), ["building", "locked"])
+
+    def test_abandoned_builds_are_removed_after_the_grace_period(self):
+        with tempfile.TemporaryDirectory() as profiles_dir:
+            self.make_profile(profiles_dir, "abandoned")
+            os.utime(os.path.join(profiles_dir, "abandoned"), (1000, 1000))
+            self.make_profile(profiles_dir, "used", last_used=2000)
+
+            self.assertEqual(prune_profile_cache(profiles_dir, max_bytes=150), ["abandoned"])
+
+
+if __name__ == '__main__':
+    unittest.main()
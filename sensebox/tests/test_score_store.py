@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import geopandas as gpd
+from shapely.geometry import LineString
+
+from sensebox import score_store
+from sensebox.score_store import bikeability_geojson, detail_for_zoom, load_score_table, write_detail_levels
+
+
+class TestScoreStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        os.makedirs("tracks/BI")
+        score_store._score_tables.clear()
+        self.weights = {"safety": 0.4, "infrastructure_quality": 0.5, "environment_quality": 0.1}
+
+    def tearDown(self):
+        score_store._score_tables.clear()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def write_streets(self, safety):
+        streets = gpd.GeoDataFrame({
+            "safety_score": safety,
+            "infrastructure_score": [0.2, 0.7, 1.0],
+            "environment_score": [0.9, 0.1, 1.0],
+            "id": ["way/1", "way/2", "way/3"],
+        }, geometry=[
+            LineString([(405000, 5757000), (405030, 5757010)]),
+            LineString([(405100, 5757100), (405150, 5757090), (405200, 5757120)]),
+            LineString([(405300, 5757300), (405310, 5757330)]),
+        ], crs="EPSG:25832")
+        streets.to_file("tracks/BI/osm_normalized_ms.geojson", driver="GeoJSON")
+        return streets
+
+    def test_matches_geopandas_serialization(self):
+        streets = self.write_streets([0.5, None, 0.3])
+        streets["bikeability_index"] = (
+            streets["safety_score"] * self.weights["safety"] +
+            streets["infrastructure_score"] * self.weights["infrastructure_quality"] +
+            streets["environment_score"] * self.weights["environment_quality"]
+        )
+        expected = json.loads(streets[["id", "bikeability_index", "geometry"]].to_crs(epsg=4326).to_json())
+
+        actual = json.loads(bikeability_geojson("ms", self.weights))
+
+        self.assertEqual(actual, expected)
+        self.assertIsNone(actual["features"][1]["properties"]["bikeability_index"])
+
+    def test_missing_scores_with_short_values(self):
+        self.write_streets([0.0, None, 0.0])
+        features = json.loads(bikeability_geojson("ms", {"safety": 1, "infrastructure_quality": 0, "environment_quality": 0}))["features"]
+        self.assertEqual([f["properties"]["bikeability_index"] for f in features], [0.0, None, 0.0])
+
+    def test_infinite_values_become_null(self):
+        self.write_streets([0.5, None, 0.3])
+        weights = {"safety": float("inf"), "infrastructure_quality": 0, "environment_quality": 0}
+        features = json.loads(bikeability_geojson("ms", weights))["features"]
+        self.assertEqual([f["properties"]["bikeability_index"] for f in features], [None, None, None])
+
+    def test_table_is_reloaded_when_the_file_changes(self):
+        self.write_streets([0.5, 0.5, 0.5])
+        with patch("sensebox.score_store.read_dataset", wraps=score_store.read_dataset) as read_file:
+            load_score_table("ms")
+            load_score_table("ms")
+            self.assertEqual(read_file.call_count, 1)
+
+            self.write_streets([1.0, 1.0, 1.0])
+            os.utime("tracks/BI/osm_normalized_ms.geojson", (2000000000, 2000000000))
+            table = load_score_table("ms")
+            self.assertEqual(read_file.call_count, 2)
+        self.assertEqual(list(table["scores"][:, 0]), [1.0, 1.0, 1.0])
+
+    def test_detail_levels(self):
+        streets = self.write_streets([0.5, 0.5, 0.5])
+        write_detail_levels(streets, "ms")
+        full = json.loads(bikeability_geojson("ms", self.weights))["features"]
+        low = json.loads(bikeability_geojson("ms", self.weights, "low"))["features"]
+
+        self.assertEqual([f["properties"] for f in low], [f["properties"] for f in full])
+        # The middle vertex of way/2 is within the low tolerance; coordinates keep four decimals
+        self.assertEqual(len(low[1]["geometry"]["coordinates"]), 2)
+        self.assertEqual(len(full[1]["geometry"]["coordinates"]), 3)
+        for x, y in low[1]["geometry"]["coordinates"]:
+            self.assertEqual((x, y), (round(x, 4), round(y, 4)))
+
+    def test_missing_detail_level_falls_back_to_full(self):
+        self.write_streets([0.5, 0.5, 0.5])
+        self.assertEqual(bikeability_geojson("ms", self.weights, "medium"), bikeability_geojson("ms", self.weights))
+
+    def test_detail_for_zoom(self):
+        self.assertEqual([detail_for_zoom(z) for z in (5, 13, 15.5, 18)], ["low", "medium", "high", "full"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import geopandas as gpd
+from django.test import SimpleTestCase
+
+from sensebox import sensor_data
+from sensebox.sensor_data import load_sensor_file, load_sensor_files, sensor_file_cache
+from sensebox.storage import read_dataset, write_dataset
+
+
+class TestSensorData(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.paths = [os.path.join(self.tmpdir.name, f"ms_{name}.geojson") for name in ("Speed", "Temperature")]
+        for i, path in enumerate(self.paths):
+            self.write(path, [1.0 + i, 2.0 + i])
+        self.reads = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, path, values):
+        gdf = gpd.GeoDataFrame({
+            "value": values,
+            "timestamp": ["2025-08-01T10:00:00.000Z"] * len(values),
+            "sensor_id": ["s1"] * len(values),
+            "box_id": ["box1"] * len(values),
+        }, geometry=gpd.points_from_xy([7.6] * len(values), [51.9] * len(values)), crs="EPSG:4326")
+        write_dataset(gdf, path)
+
+    def counting_read(self, path, **kwargs):
+        self.reads.append(os.path.basename(path))
+        return read_dataset(path, **kwargs)
+
+    def test_projected_columns(self):
+        frame = load_sensor_file(self.paths[0])
+        self.assertEqual(list(frame.columns), ["value", "timestamp", "box_id", "geometry"])
+        self.assertEqual(sensor_data.sensor_columns("./tracks/ms_accidents.geojson"), None)
+
+        frame = load_sensor_file(self.paths[0], geometry=False)
+        self.assertEqual(list(frame.columns), ["value", "timestamp", "box_id"])
+        with sensor_file_cache():
+            load_sensor_file(self.paths[0])
+            self.assertEqual(list(load_sensor_file(self.paths[0], geometry=False).columns),
+                             ["value", "timestamp", "box_id"])
+
+    def test_cached_within_a_block(self):
+        with patch("sensebox.sensor_data.read_dataset", side_effect=self.counting_read):
+            load_sensor_file(self.paths[0])
+            load_sensor_file(self.paths[0])
+            self.assertEqual(len(self.reads), 2)  # no caching outside a block
+
+            self.reads.clear()
+            with sensor_file_cache():
+                frame = load_sensor_file(self.paths[0])
+                frame["value"] = 0.0  # callers get their own copy
+                self.assertEqual(load_sensor_file(self.paths[0])["value"].tolist(), [1.0, 2.0])
+                self.assertEqual(len(self.reads), 1)
+
+                # A rewritten file is read again
+                self.write(self.paths[0], [5.0])
+                os.utime(sensor_data.find_dataset(self.paths[0]), ns=(1, 1))
+                self.assertEqual(load_sensor_file(self.paths[0])["value"].tolist(), [5.0])
+                self.assertEqual(len(self.reads), 2)
+            self.assertIsNone(sensor_data._cache)
+
+    def test_concurrent_loading(self):
+        missing = os.path.join(self.tmpdir.name, "ms_PM1.geojson")
+        loaded = load_sensor_files(self.paths + [missing])
+        self.assertEqual(loaded[self.paths[1]]["value"].tolist(), [2.0, 3.0])
+        self.assertIsInstance(loaded[missing], FileNotFoundError)
+
+    def test_concurrent_stages_decode_each_file_once(self):
+        barrier = threading.Barrier(2)
+
+        def stage():
+            barrier.wait(timeout=5)
+            load_sensor_files(self.paths)
+
+        with sensor_file_cache(), patch("sensebox.sensor_data.read_dataset", side_effect=self.counting_read):
+            threads = [threading.Thread(target=stage) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(self.reads), 2)
+        self.assertEqual(len(set(self.reads)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
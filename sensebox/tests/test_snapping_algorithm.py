@@ -11,9 +11,12 @@ import numpy as np
 
 from sensebox.snapping_algorithm import (
     compute_point_uid,
+    compute_point_keys,
     snap_to_nearest_line,
     snap_batch,
+    snap_points_bulk,
     process_sensor_file,
+    aggregate_sensor_files,
     process_city,
     city_data
 )
@@ -73,6 +76,41 @@ class TestComputePointUid(unittest.TestCase):
         self.assertNotEqual(uid1, uid2)
 
 
+class TestComputePointKeys(unittest.TestCase):
+    """Test cases for the vectorized compute_point_keys function"""
+
+    def setUp(self):
+        self.geometry = np.array([Point(10.0, 20.0), Point(10.1, 20.1), Point(10.0, 20.0)], dtype=object)
+
+    def test_keys_are_stable_uint64(self):
+        """Test that keys are uint64 and identical across calls"""
+        tags = pd.Series(["2025-08-01T10:00:00Z"] * 3)
+        values = [1.0, 2.0, 1.0]
+
+        keys1 = compute_point_keys(self.geometry, tags, values)
+        keys2 = compute_point_keys(self.geometry, tags, values)
+
+        self.assertEqual(keys1.dtype, np.uint64)
+        np.testing.assert_array_equal(keys1, keys2)
+        self.assertEqual(keys1[0], keys1[2])
+        self.assertNotEqual(keys1[0], keys1[1])
+
+    def test_keys_differ_by_tag_and_value(self):
+        """Test that tag and value are part of the key"""
+        keys = compute_point_keys(self.geometry[[0, 0, 0]], pd.Series(["a", "b", "a"]), [1.0, 1.0, 2.0])
+        self.assertEqual(len(set(keys)), 3)
+
+    def test_keys_normalize_tag_whitespace_and_value_precision(self):
+        """Test that tags are stripped and values rounded like compute_point_uid"""
+        keys = compute_point_keys(self.geometry[[0, 0]], pd.Series(["a", " a "]), [1.00001, 1.0])
+        self.assertEqual(keys[0], keys[1])
+
+    def test_keys_without_tags(self):
+        """Test key generation when no tag column exists"""
+        keys = compute_point_keys(self.geometry, None, [1.0, 1.0, 1.0])
+        self.assertEqual(len(keys), 3)
+
+
 class TestSnapToNearestLine(unittest.TestCase):
     """Test cases for snap_to_nearest_line function"""
     
@@ -223,6 +261,45 @@ class TestSnapBatch(unittest.TestCase):
             self.assertIsInstance(point, Point)
 
 
+class TestSnapPointsBulk(unittest.TestCase):
+    """Test cases for snap_points_bulk function"""
+
+    def setUp(self):
+        """Set up test data with non-default index labels"""
+        self.streets = gpd.GeoDataFrame({
+            'id': [1, 2],
+            'geometry': [
+                LineString([(0, 0), (10, 0)]),
+                LineString([(0, 5), (10, 5)])
+            ]
+        }, index=[7, 9])
+        self.street_index = STRtree(self.streets.geometry.values)
+
+    def test_snap_returns_geometry_and_street_label(self):
+        """Test snapped points and index_right are returned in one pass"""
+        points = gpd.GeoSeries([Point(5, 1), Point(5, 6)], index=[10, 11])
+        snapped = snap_points_bulk(points, self.streets, self.street_index)
+
+        self.assertEqual(list(snapped.index), [10, 11])
+        self.assertEqual(list(snapped["index_right"]), [7, 9])
+        self.assertAlmostEqual(snapped.geometry.iloc[0].y, 0.0)
+        self.assertAlmostEqual(snapped.geometry.iloc[1].y, 5.0)
+
+    def test_snap_drops_points_beyond_max_distance(self):
+        """Test that points further than max_distance are dropped"""
+        points = gpd.GeoSeries([Point(5, 1), Point(50, 50)])
+        snapped = snap_points_bulk(points, self.streets, self.street_index, max_distance=2)
+
+        self.assertEqual(list(snapped.index), [0])
+        self.assertEqual(list(snapped["index_right"]), [7])
+
+    def test_snap_empty_points(self):
+        """Test snapping an empty GeoSeries"""
+        snapped = snap_points_bulk(gpd.GeoSeries([]), self.streets, self.street_index)
+        self.assertTrue(snapped.empty)
+        self.assertIn("index_right", snapped.columns)
+
+
 class TestProcessSensorFile(unittest.TestCase):
     """Test cases for process_sensor_file function"""
     
@@ -237,6 +314,55 @@ class TestProcessSensorFile(unittest.TestCase):
         # For now, just verify the function signature
         self.assertIsNotNone(streets)
 
+class TestAggregateSensorFiles(unittest.TestCase):
+    """Test cases for serial and process-pool aggregation of sensor files"""
+
+    def setUp(self):
+        """Write two small sensor files into a temporary working directory"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.old_cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+
+        self.streets = gpd.GeoDataFrame({
+            'id': [1, 2],
+            'geometry': [
+                LineString([(7.50, 51.90), (7.51, 51.90)]),
+                LineString([(7.50, 51.95), (7.51, 51.95)])
+            ]
+        }, crs="EPSG:4326").to_crs(epsg=32637)
+        self.street_index = STRtree(self.streets.geometry.values)
+
+        self.sensor_files = []
+        for name, values in [("ms_Speed", [1.0, 3.0, 8.0]), ("ms_Temperature", [20.0, 22.0, 15.0])]:
+            features = [
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": coords},
+                    "properties": {"value": value, "timestamp": f"2025-08-01T10:0{i}:00Z", "box_id": "box1"}
+                }
+                for i, (coords, value) in enumerate(zip([[7.505, 51.901], [7.506, 51.899], [7.505, 51.949]], values))
+            ]
+            path = f"{name}.geojson"
+            with open(path, "w") as f:
+                json.dump({"type": "FeatureCollection", "features": features}, f)
+            self.sensor_files.append(path)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.tmpdir.cleanup()
+
+    def test_parallel_matches_serial(self):
+        """Test that the process pool produces the same aggregates as the serial fallback"""
+        serial = aggregate_sensor_files("ms", self.sensor_files, self.streets, self.street_index, workers=1)
+        parallel = aggregate_sensor_files("ms", self.sensor_files, self.streets, self.street_index, workers=2)
+
+        self.assertEqual(len(serial), 2)
+        for expected, result in zip(serial, parallel):
+            pd.testing.assert_frame_equal(expected, result)
+        self.assertAlmostEqual(serial[0].loc[0, "avg_ms_Speed"], 2.0)
+        self.assertAlmostEqual(serial[0].loc[1, "avg_ms_Speed"], 8.0)
+
+
 class TestIntegration(unittest.TestCase):
     """Integration tests for the snapping algorithm"""
     
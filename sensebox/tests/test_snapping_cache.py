@@ -0,0 +1,138 @@
+import unittest
+import unittest.mock
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString
+from shapely.strtree import STRtree
+
+from sensebox import snapping_cache
+from sensebox.snapping_cache import (
+    read_snapping_cache,
+    append_snapping_cache,
+    iter_segments,
+    migrate_csv_cache,
+    has_legacy_segments,
+    rekey_legacy_segments,
+)
+
+
+class TestSnappingCache(unittest.TestCase):
+    """Test cases for the segmented binary snapping cache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmpdir.name, "snapping_map_ms_Speed")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_frame(self, uids, index_right):
+        return pd.DataFrame({
+            "point_uid": uids,
+            "x": np.arange(len(uids), dtype=float),
+            "y": np.arange(len(uids), dtype=float) * 2,
+            "index_right": index_right,
+        })
+
+    def test_read_missing_cache_is_empty(self):
+        """Test reading a cache that does not exist yet"""
+        cached = read_snapping_cache(self.cache_dir)
+        self.assertTrue(cached.empty)
+        self.assertEqual(list(cached.columns), ["point_uid", "x", "y", "index_right"])
+
+    def test_append_writes_new_segments(self):
+        """Test that every append adds a segment and reads return all rows"""
+        append_snapping_cache(self.cache_dir, self.make_frame(["a", "b"], [1, 2]))
+        append_snapping_cache(self.cache_dir, self.make_frame(["c"], [3]))
+
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        cached = read_snapping_cache(self.cache_dir)
+        self.assertEqual(list(cached["point_uid"]), ["a", "b", "c"])
+        self.assertEqual(list(cached["index_right"]), [1, 2, 3])
+
+    def test_segments_are_memory_mapped(self):
+        """Test that segments are opened as memory maps"""
+        append_snapping_cache(self.cache_dir, self.make_frame(["a"], [1]))
+        segment = next(iter_segments(self.cache_dir))
+        self.assertIsInstance(segment, np.memmap)
+
+    def test_compaction_merges_segments(self):
+        """Test that segments are merged once MAX_SEGMENTS is exceeded"""
+        with unittest.mock.patch.object(snapping_cache, "MAX_SEGMENTS", 2):
+            for key in [1, 2, 3]:
+                append_snapping_cache(self.cache_dir, self.make_frame(np.array([key], dtype=np.uint64), [1]))
+
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertEqual(sorted(read_snapping_cache(self.cache_dir)["point_uid"]), [1, 2, 3])
+
+    def test_segment_numbers_beyond_five_digits(self):
+        """Test that segment numbers keep increasing once they need more than 5 digits"""
+        os.makedirs(self.cache_dir)
+        snapping_cache._write_segment(self.cache_dir, snapping_cache._to_segment(self.make_frame(["a"], [1])), 99999)
+        for uid in ["b", "c"]:
+            append_snapping_cache(self.cache_dir, self.make_frame([uid], [1]))
+
+        self.assertEqual(set(os.listdir(self.cache_dir)),
+                         {"segment_99999.npy", "segment_100000.npy", "segment_100001.npy"})
+        self.assertEqual(list(read_snapping_cache(self.cache_dir)["point_uid"]), ["a", "b", "c"])
+
+    def test_rekey_legacy_segments(self):
+        """Test that UUID-keyed segments are re-keyed to exact uint64 point keys"""
+        append_snapping_cache(self.cache_dir, self.make_frame(["uuid-a", "uuid-b"], [1, 2]))
+        self.assertTrue(has_legacy_segments(self.cache_dir))
+
+        big_key = np.uint64(2**63 + 12345)
+        key_map = pd.Series(np.array([big_key], dtype=np.uint64), index=["uuid-b"])
+        rekeyed = rekey_legacy_segments(self.cache_dir, key_map)
+
+        self.assertEqual(rekeyed, 1)
+        self.assertFalse(has_legacy_segments(self.cache_dir))
+        cached = read_snapping_cache(self.cache_dir)
+        self.assertEqual(cached["point_uid"].dtype, np.uint64)
+        self.assertEqual(cached["point_uid"].iloc[0], big_key)
+        self.assertEqual(cached["index_right"].iloc[0], 2)
+
+    def test_compaction_waits_for_legacy_segments(self):
+        """Test that mixed UUID and point key segments are not compacted before re-keying"""
+        append_snapping_cache(self.cache_dir, self.make_frame(["uuid-a"], [1]))
+        keys = np.array([7, 8], dtype=np.uint64)
+        with unittest.mock.patch.object(snapping_cache, "MAX_SEGMENTS", 1):
+            for key in keys:
+                append_snapping_cache(self.cache_dir, self.make_frame(np.array([key], dtype=np.uint64), [2]))
+
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+        key_map = pd.Series(np.array([6], dtype=np.uint64), index=["uuid-a"])
+        self.assertEqual(rekey_legacy_segments(self.cache_dir, key_map), 1)
+
+        cached = read_snapping_cache(self.cache_dir)
+        self.assertEqual(cached["point_uid"].dtype, np.uint64)
+        self.assertEqual(sorted(cached["point_uid"]), [6, 7, 8])
+
+    def test_migrate_csv_cache(self):
+        """Test the one-time migration of the WKT CSV cache"""
+        streets = gpd.GeoDataFrame({
+            "geometry": [LineString([(0, 0), (10, 0)]), LineString([(0, 5), (10, 5)])]
+        }, index=[4, 8])
+        csv_path = self.cache_dir + ".csv"
+        pd.DataFrame({
+            "point_uid": ["a", "b"],
+            "index_right": [0, 0],
+            "geometry_wkt": ["POINT (2 0)", "POINT (3 5)"],
+        }).to_csv(csv_path, index=False)
+
+        migrated = migrate_csv_cache(csv_path, self.cache_dir, streets, STRtree(streets.geometry.values))
+
+        self.assertTrue(migrated)
+        self.assertFalse(os.path.exists(csv_path))
+        self.assertTrue(os.path.exists(csv_path + ".migrated"))
+        cached = read_snapping_cache(self.cache_dir)
+        self.assertEqual(list(cached["point_uid"]), ["a", "b"])
+        self.assertEqual(list(cached["index_right"]), [4, 8])
+        self.assertEqual(list(cached["x"]), [2.0, 3.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
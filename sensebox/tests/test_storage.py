@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import unittest
+
+import geopandas as gpd
+import pyarrow.parquet as pq
+from django.test import SimpleTestCase, override_settings
+from shapely.geometry import LineString, MultiLineString
+
+from sensebox.storage import DatasetWriter, dataset_exists, find_dataset, read_dataset, storage_path, write_dataset
+
+
+class TestStorage(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "osm_streets_ms.geojson")
+        self.streets = gpd.GeoDataFrame({
+            "id": ["way/3", "way/1", "way/2"],
+            "avg_ms_Speed": [4.5, None, 2.0],
+            "timestamp": ["2025-08-01T12:00:00.250Z"] * 3,
+        }, geometry=[
+            LineString([(7.6, 51.9), (7.61, 51.91)]),
+            MultiLineString([[(7.7, 51.9), (7.71, 51.91)], [(7.72, 51.92), (7.73, 51.93)]]),
+            LineString([(7.5, 51.8), (7.51, 51.81)]),
+        ], crs="EPSG:4326")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        target = write_dataset(self.streets, self.path, geojson=False)
+        self.assertEqual(target, storage_path(self.path))
+        self.assertEqual(find_dataset(self.path), target)
+
+        frame = read_dataset(self.path)
+        self.assertEqual(frame["id"].tolist(), ["way/3", "way/1", "way/2"])  # order is kept
+        self.assertEqual(frame.geom_type.tolist(), ["LineString", "MultiLineString", "LineString"])
+        self.assertEqual(frame["timestamp"].iloc[0], "2025-08-01T12:00:00.250Z")
+        self.assertEqual(frame.crs, "EPSG:4326")
+
+        projected = read_dataset(self.path, columns=["id"], geometry=False)
+        self.assertEqual(list(projected.columns), ["id"])
+        self.assertTrue(target.endswith(".parquet"))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_legacy_geojson_is_read_and_replaced(self):
+        self.streets.to_file(self.path, driver="GeoJSON")
+        self.assertEqual(find_dataset(self.path), self.path)
+        self.assertEqual(read_dataset(self.path, columns=["id"])["id"].tolist(), ["way/3", "way/1", "way/2"])
+
+        write_dataset(self.streets, self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(os.listdir(self.tmpdir.name), [os.path.basename(storage_path(self.path))])
+
+    @override_settings(PIPELINE_GEOJSON_EXPORT=True)
+    def test_geojson_export(self):
+        write_dataset(self.streets, self.path)
+        self.assertEqual(gpd.read_file(self.path)["id"].tolist(), ["way/3", "way/1", "way/2"])
+        self.assertEqual(find_dataset(self.path), storage_path(self.path))
+
+    def test_chunked_writer(self):
+        self.streets.to_file(self.path, driver="GeoJSON")
+        with DatasetWriter(self.path, geojson=False) as writer:
+            for start in range(3):
+                writer.write(self.streets.iloc[start:start + 1])
+            writer.write(self.streets.iloc[:0])
+            self.assertFalse(os.path.exists(storage_path(self.path)))  # only visible once complete
+        self.assertEqual(writer.rows, 3)
+
+        frame = read_dataset(self.path)
+        self.assertEqual(frame["id"].tolist(), ["way/3", "way/1", "way/2"])
+        self.assertEqual(frame.geom_type.tolist(), ["LineString", "MultiLineString", "LineString"])
+        self.assertEqual(frame.crs, "EPSG:4326")
+        self.assertEqual(os.listdir(self.tmpdir.name), [os.path.basename(storage_path(self.path))])
+
+        # Nothing in the geo metadata may describe the first chunk only
+        target = storage_path(self.path)
+        geo = json.loads(pq.read_schema(target).metadata[b"geo"])
+        self.assertNotIn("bbox", geo["columns"]["geometry"])
+        self.assertEqual(geo["columns"]["geometry"]["geometry_types"], [])
+        frame = gpd.read_parquet(target)
+        self.assertEqual(frame["id"].tolist(), ["way/3", "way/1", "way/2"])
+        self.assertEqual(frame.crs, "EPSG:4326")
+
+    def test_chunked_writer_keeps_the_previous_dataset_on_error(self):
+        write_dataset(self.streets.iloc[:1], self.path)
+        with self.assertRaises(RuntimeError):
+            with DatasetWriter(self.path) as writer:
+                writer.write(self.streets)
+                raise RuntimeError("interrupted")
+        self.assertEqual(read_dataset(self.path)["id"].tolist(), ["way/3"])
+        self.assertEqual(os.listdir(self.tmpdir.name), [os.path.basename(storage_path(self.path))])
+
+    def test_missing_dataset(self):
+        self.assertFalse(dataset_exists(self.path))
+        with self.assertRaises(FileNotFoundError):
+            read_dataset(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import os
+import struct
+import tempfile
+from unittest.mock import patch
+
+import geopandas as gpd
+from django.test import SimpleTestCase, RequestFactory, override_settings
+from shapely.geometry import LineString
+
+from sensebox import tiles
+from sensebox.score_store import write_data_version
+from sensebox.tiles import TILE_EXTENT, bikeability_tile, tile_bounds
+from sensebox.views import bikeability_tile_view
+
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "responses": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "responses-test"},
+    "tiles": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "tiles-test"},
+}
+
+
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return result, pos
+
+
+def read_message(data):
+    """{field number: [values]} of a protobuf message (varint, 64-bit and length-delimited fields)."""
+    fields, pos = {}, 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        else:
+            length, pos = read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+def read_packed(data):
+    values, pos = [], 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def decode_tile(data):
+    """Features of the single layer of a tile as (properties, [[(x, y), ...], ...])."""
+    layer = read_message(read_message(data)[3][0])
+    keys = [key.decode() for key in layer.get(3, [])]
+    values = []
+    for raw in layer.get(4, []):
+        value = read_message(raw)
+        values.append(value[1][0].decode() if 1 in value else struct.unpack("<d", value[3][0])[0])
+
+    features = []
+    for raw in layer.get(2, []):
+        feature = read_message(raw)
+        tags = read_packed(feature[2][0])
+        properties = {keys[k]: values[v] for k, v in zip(tags[0::2], tags[1::2])}
+        commands, lines, x, y, i = read_packed(feature[4][0]), [], 0, 0, 0
+        while i < len(commands):
+            command, count = commands[i] & 7, commands[i] >> 3
+            i += 1
+            if command == 1:
+                lines.append([])
+            for _ in range(count):
+                dx, dy = commands[i], commands[i + 1]
+                x += (dx >> 1) ^ -(dx & 1)
+                y += (dy >> 1) ^ -(dy & 1)
+                lines[-1].append((x, y))
+                i += 2
+        features.append((properties, lines))
+    assert layer[1][0] == b"streets" and layer[5][0] == TILE_EXTENT and layer[15][0] == 2
+    return features
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BikeabilityTileTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        os.makedirs("tracks/BI")
+        # Two streets in a Web Mercator square, the second with a missing safety score
+        gpd.GeoDataFrame({
+            "safety_score": [0.5, None],
+            "infrastructure_score": [0.4, 0.9],
+            "environment_score": [0.3, 0.1],
+            "id": ["way/1", "way/2"],
+        }, geometry=[
+            LineString([(1000, 1000), (3000, 3000), (9000, 3000)]),
+            LineString([(-5000, 5000), (5000, 5000)]),
+        ], crs="EPSG:3857").to_file("tracks/BI/osm_normalized_ms.geojson", driver="GeoJSON")
+        write_data_version("ms")
+        tiles._tile_indexes.clear()
+        self.weights = {"safety": 0.4, "infrastructure_quality": 0.5, "environment_quality": 0.1}
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        from django.core.cache import caches
+        caches["tiles"].clear()
+        tiles._tile_indexes.clear()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def test_tile_bounds(self):
+        self.assertEqual(tile_bounds(0, 0, 0), (-tiles.WEB_MERCATOR_HALF, -tiles.WEB_MERCATOR_HALF,
+                                               tiles.WEB_MERCATOR_HALF, tiles.WEB_MERCATOR_HALF))
+        minx, miny, maxx, maxy = tile_bounds(1, 1, 0)
+        self.assertEqual((minx, miny), (0, 0))
+
+    def test_features_are_clipped_to_the_tile(self):
+        # Tile 12/2048/2047 spans x, y in [0, ~9784] m, so the second street is cut at x = 0
+        features = decode_tile(bikeability_tile("ms", 12, 2048, 2047, self.weights))
+        by_id = {properties["id"]: (properties, lines) for properties, lines in features}
+
+        self.assertEqual(set(by_id), {"way/1", "way/2"})
+        properties, lines = by_id["way/1"]
+        self.assertAlmostEqual(properties["bikeability_index"], 0.5 * 0.4 + 0.4 * 0.5 + 0.3 * 0.1)
+        size = tile_bounds(12, 2048, 2047)[2]
+        scale = TILE_EXTENT / size
+        self.assertEqual(lines, [[(round(1000 * scale), TILE_EXTENT - round(1000 * scale)),
+                                  (round(3000 * scale), TILE_EXTENT - round(3000 * scale)),
+                                  (round(9000 * scale), TILE_EXTENT - round(3000 * scale))]])
+
+        properties, lines = by_id["way/2"]
+        self.assertNotIn("bikeability_index", properties)
+        self.assertEqual(lines[0][0][0], -tiles.TILE_BUFFER)
+
+    def test_empty_tile(self):
+        self.assertEqual(decode_tile(bikeability_tile("ms", 12, 0, 0, self.weights)), [])
+
+    def test_view_caches_per_profile_and_tile(self):
+        with patch("sensebox.views.bikeability_tile", wraps=bikeability_tile) as build:
+            first = bikeability_tile_view(self.factory.get("/?safety=1"), "ms", 12, 2048, 2047)
+            second = bikeability_tile_view(self.factory.get("/?safety=1.0"), "ms", 12, 2048, 2047)
+            other = bikeability_tile_view(self.factory.get("/"), "ms", 12, 2048, 2047)
+            revalidated = bikeability_tile_view(self.factory.get("/?safety=1", HTTP_IF_NONE_MATCH=first["ETag"]),
+                                                "ms", 12, 2048, 2047)
+
+        self.assertEqual(build.call_count, 2)
+        self.assertEqual(first["Content-Type"], "application/vnd.mapbox-vector-tile")
+        self.assertEqual(first.content, second.content)
+        self.assertNotEqual(first["ETag"], other["ETag"])
+        self.assertEqual(revalidated.status_code, 304)
+        properties = {p["id"]: p for p, _ in decode_tile(first.content)}
+        self.assertAlmostEqual(properties["way/1"]["bikeability_index"], 0.5 + 0.4 * 0.5 + 0.3 * 0.1)
+
+    def test_tiles_do_not_share_the_response_cache(self):
+        from django.core.cache import caches
+        bikeability_tile_view(self.factory.get("/"), "ms", 12, 2048, 2047)
+
+        self.assertEqual(len(caches["tiles"]._cache), 1)
+        self.assertEqual(len(caches["responses"]._cache), 0)
+
+    def test_invalid_requests(self):
+        self.assertEqual(bikeability_tile_view(self.factory.get("/"), "ms", 2, 4, 0).status_code, 400)
+        self.assertEqual(bikeability_tile_view(self.factory.get("/?safety=x"), "ms", 2, 0, 0).status_code, 400)
+        self.assertEqual(bikeability_tile_view(self.factory.get("/"), "ol", 2, 0, 0).status_code, 404)
@@ -0,0 +1,134 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from shapely.geometry import LineString
+
+from sensebox.track_store import (TrackStoreWriter, load_track_index, read_track_segments, read_track_source,
+                                  track_index_path, track_store_path)
+
+
+def segment(box_id, date, x, points=3):
+    coords = [(x + i / 1000, 51.9 + i / 1000) for i in range(points)]
+    timestamps = [f"{date}T10:00:{i:02d}Z" for i in range(points)]
+    return box_id, date, LineString(coords), timestamps
+
+
+class TestTrackStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        self.segments = [
+            segment("box1", "2025-08-01", 7.60),
+            segment("box2", "2025-08-01", 7.70, points=5),
+            segment("box1", "2025-08-02", 7.61),
+            segment("box1", "2025-08-02", 7.62),
+        ]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def write(self, segments, chunk_size=2, **kwargs):
+        with TrackStoreWriter("ms", **kwargs) as store:
+            for start in range(0, len(segments), chunk_size):
+                chunk = segments[start:start + chunk_size]
+                store.add({"box_id": [s[0] for s in chunk], "date": [s[1] for s in chunk],
+                           "geometry": [s[2] for s in chunk], "timestamps": [s[3] for s in chunk]})
+        return store.rewritten
+
+    def test_round_trip(self):
+        self.assertEqual(sorted(self.write(self.segments)), ["2025-08-01", "2025-08-02"])
+        self.assertEqual(os.listdir("tracks/track_store"), ["ms"])  # no spool files left
+        segments = read_track_segments("ms", timestamps=True)
+        self.assertEqual(segments["box_id"].tolist(), ["box1", "box2", "box1", "box1"])
+        self.assertEqual(segments["date"].dt.strftime("%Y-%m-%d").tolist(),
+                         ["2025-08-01", "2025-08-01", "2025-08-02", "2025-08-02"])
+        self.assertEqual([list(g.coords) for g in segments.geometry], [list(s[2].coords) for s in self.segments])
+        self.assertEqual(segments["timestamps"][1].tolist(),
+                         list(np.array([f"2025-08-01T10:00:{i:02d}" for i in range(5)], dtype="datetime64[us]")))
+
+        only = read_track_segments("ms", dates=["2025-08-02", "2025-08-03"])
+        self.assertEqual(len(only), 2)
+        self.assertNotIn("timestamps", only.columns)
+
+    def test_index_query(self):
+        self.write(self.segments)
+        index = load_track_index("ms")
+        self.assertEqual(list(zip(index.keys["box_id"], index.keys["date"].dt.strftime("%Y-%m-%d"))),
+                         [("box1", "2025-08-01"), ("box2", "2025-08-01"), ("box1", "2025-08-02")])
+        self.assertAlmostEqual(index.keys["maxx"][2], 7.622)
+
+        hits = index.query((7.695, 51.8, 7.8, 52.0))
+        self.assertEqual(hits["box_id"].tolist(), ["box2"])
+        self.assertTrue(index.query((8.0, 52.0, 8.1, 52.1)).empty)
+
+    def test_only_changed_days_are_rewritten(self):
+        self.write(self.segments)
+        index_mtime = os.stat(track_index_path("ms")).st_mtime_ns
+        day_path = os.path.join(track_store_path("ms"), "days", "2025-08-01.npz")
+        day_mtime = os.stat(day_path).st_mtime_ns
+
+        # Nothing new: nothing is written, also not the index
+        self.assertEqual(self.write(self.segments, chunk_size=3), [])
+        self.assertEqual(os.stat(track_index_path("ms")).st_mtime_ns, index_mtime)
+
+        # A new day and a changed one; the first day stays as it is
+        changed = self.segments[:2] + [segment("box1", "2025-08-02", 7.63), segment("box2", "2025-08-03", 7.7)]
+        self.assertEqual(sorted(self.write(changed)), ["2025-08-02", "2025-08-03"])
+        self.assertEqual(os.stat(day_path).st_mtime_ns, day_mtime)
+        self.assertEqual(len(load_track_index("ms").keys), 4)
+
+        # Days without segments are removed
+        self.assertEqual(self.write(changed[:2]), [])
+        self.assertEqual(sorted(os.listdir(os.path.join(track_store_path("ms"), "days"))), ["2025-08-01.npz"])
+        self.assertEqual(len(load_track_index("ms").keys), 2)
+
+    def test_append_only_touches_the_new_days(self):
+        self.write(self.segments[:2], source={"last_id": 1})
+        first_day = os.path.join(track_store_path("ms"), "days", "2025-08-01.npz")
+        day_mtime = os.stat(first_day).st_mtime_ns
+
+        # One more segment of a stored key on a new day, and one of a new key
+        self.assertEqual(self.write(self.segments[2:3], append=True, source={"last_id": 2}), ["2025-08-02"])
+        self.assertEqual(self.write([segment("box2", "2025-08-02", 7.9), self.segments[3]], append=True,
+                                    source={"last_id": 3}), ["2025-08-02"])
+        self.assertEqual(os.stat(first_day).st_mtime_ns, day_mtime)
+        self.assertEqual(read_track_source("ms"), {"last_id": 3})
+
+        segments = read_track_segments("ms")
+        self.assertEqual(segments["box_id"].tolist(), ["box1", "box2", "box1", "box2", "box1"])
+        index = load_track_index("ms")
+        self.assertEqual(list(zip(index.keys["box_id"], index.keys["date"].dt.strftime("%Y-%m-%d"))),
+                         [("box1", "2025-08-01"), ("box2", "2025-08-01"), ("box1", "2025-08-02"),
+                          ("box2", "2025-08-02")])
+        self.assertAlmostEqual(index.keys["maxx"][2], 7.622)  # grown by the last segment of box1
+
+        # Without new segments only the source is recorded
+        self.assertEqual(self.write([], append=True, source={"last_id": 4}), [])
+        self.assertEqual(read_track_source("ms"), {"last_id": 4})
+
+    def test_z_coordinates_are_kept(self):
+        track = LineString([(7.6, 51.9, 60.0), (7.61, 51.91, 61.5), (7.62, 51.92, 63.0)])
+        self.write([self.segments[0], ("box2", "2025-08-01", track, self.segments[0][3])])
+        segments = read_track_segments("ms")
+        self.assertEqual(list(segments.geometry[1].coords), list(track.coords))
+        self.assertTrue(np.isnan(segments.geometry[0].coords[0][2]))
+
+        # A 2D day stays 2D
+        self.write([self.segments[2]], append=True)
+        self.assertFalse(read_track_segments("ms", dates=["2025-08-02"]).geometry[0].has_z)
+
+    def test_nothing_is_written_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with TrackStoreWriter("ms") as store:
+                s = self.segments[0]
+                store.add({"box_id": [s[0]], "date": [s[1]], "geometry": [s[2]], "timestamps": [s[3]]})
+                raise RuntimeError("interrupted")
+        self.assertEqual(os.listdir("tracks/track_store"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
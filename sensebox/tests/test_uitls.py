@@ -1,23 +1,55 @@
 import asyncio
+import importlib
+import json
+import unittest
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from yarl import URL
+from datetime import datetime, timedelta, timezone as dt_timezone
 from unittest.mock import patch, AsyncMock, MagicMock
+from django.apps import apps
+from django.db import OperationalError
 from django.test import TestCase
-from sensebox.utils import fetch_and_store_data
+from django.utils import timezone
+from sensebox.utils import (
+    fetch_and_store_data, backup_and_delete_city, ApiClient, fetch, stream_array,
+    FetchError, JsonArrayDecoder, MeasurementWriter, parse_measurement, format_mark
+)
+from sensebox.models import (
+    BoxTable, SensorTable, SensorDataTable, TracksTable, MeasurementTable,
+    BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup, MeasurementTableBackup
+)
+
+
+def stream_chunks(*chunks, error=None):
+    """Returns a stand-in for stream_array that yields ``chunks`` and then optionally fails."""
+    async def stream(session, url):
+        for chunk in chunks:
+            yield chunk
+        if error is not None:
+            raise error
+    return MagicMock(side_effect=stream)
 
 
 class FetchAndStoreDataTest(TestCase):
     @patch('sensebox.utils.fetch', new_callable=AsyncMock)
-    @patch('sensebox.utils.delete_all_measurements', new_callable=AsyncMock)
+    @patch('sensebox.utils.stream_array')
+    @patch('sensebox.utils.backup_and_delete_measurements', new_callable=AsyncMock)
     @patch('sensebox.utils.BoxTable.objects.bulk_create')
     @patch('sensebox.utils.SensorTable.objects.bulk_create')
+    @patch('sensebox.utils.MeasurementTable.objects.bulk_create')
     @patch('sensebox.utils.SensorDataTable.objects.bulk_create')
     @patch('sensebox.utils.TracksTable.objects.bulk_create')
     def test_fetch_and_store_data_ms(
         self,
         mock_tracks_bulk,
         mock_sensordata_bulk,
+        mock_measurement_bulk,
         mock_sensor_bulk,
         mock_box_bulk,
         mock_delete,
+        mock_stream_array,
         mock_fetch
     ):
         # Mock API response for /boxes
@@ -43,15 +75,17 @@ class FetchAndStoreDataTest(TestCase):
                     }
                 ]
             },
-            [  # Third fetch: sensor data
-                {"timestamp": "2025-08-01T11:30:00Z", "value": "25.5"}
-            ],
-            {  # Fourth fetch: track data
+            {  # Third fetch: track data
                 "type": "FeatureCollection", "features": []
             }
         ]
+        # Sensor data is streamed, one row per measurement
+        mock_stream_array.side_effect = stream_chunks(
+            [{"createdAt": "2025-08-01T11:30:00.000Z", "value": "25.5", "location": [7.6, 51.95]}],
+            [{"createdAt": "2025-08-01T11:31:00.000Z", "value": "bad"}],
+        ).side_effect
 
-        result = asyncio.run(fetch_and_store_data("ms"))
+        result = asyncio.run(fetch_and_store_data("ms", full_refresh=True))
 
         self.assertEqual(result["status"], "Data collection successfull check the admin page for the data")
         mock_delete.assert_called_once()
@@ -59,3 +93,419 @@ class FetchAndStoreDataTest(TestCase):
         self.assertTrue(mock_sensor_bulk.called)
         self.assertTrue(mock_sensordata_bulk.called)
         self.assertTrue(mock_tracks_bulk.called)
+
+        measurements = mock_measurement_bulk.call_args.args[0]
+        self.assertEqual(len(measurements), 1)
+        self.assertEqual((measurements[0].value, measurements[0].lon, measurements[0].lat), (25.5, 7.6, 51.95))
+        self.assertEqual(mock_sensordata_bulk.call_args.args[0][0].value["measurements"], 1)
+
+    @patch('sensebox.utils.fetch', new_callable=AsyncMock)
+    @patch('sensebox.utils.stream_array', new_callable=stream_chunks)
+    @patch('sensebox.utils.get_high_water_marks', new_callable=AsyncMock)
+    @patch('sensebox.utils.backup_and_delete_measurements', new_callable=AsyncMock)
+    @patch('sensebox.utils.BoxTable.objects.bulk_create')
+    @patch('sensebox.utils.SensorTable.objects.bulk_create')
+    @patch('sensebox.utils.SensorDataTable.objects.bulk_create')
+    @patch('sensebox.utils.TracksTable.objects.bulk_create')
+    def test_incremental_fetch_uses_high_water_marks(
+        self,
+        mock_tracks_bulk,
+        mock_sensordata_bulk,
+        mock_sensor_bulk,
+        mock_box_bulk,
+        mock_backup,
+        mock_marks,
+        mock_stream_array,
+        mock_fetch
+    ):
+        mock_marks.return_value = (
+            {
+                "sensor1": datetime(2025, 8, 1, 11, 0, tzinfo=dt_timezone.utc),   # has newer data
+                "sensor2": datetime(2025, 8, 1, 12, 0, tzinfo=dt_timezone.utc),   # already up to date
+            },
+            {"box123": datetime(2025, 8, 1, 11, 0, tzinfo=dt_timezone.utc)},
+        )
+        mock_fetch.side_effect = [
+            [{"_id": "box123", "currentLocation": {"timestamp": "2025-08-01T12:00:00Z"}}],
+            {
+                "_id": "box123",
+                "name": "Test Box",
+                "updatedAt": "2025-08-01T12:00:00Z",
+                "createdAt": "2025-07-01T11:00:00Z",
+                "lastMeasurementAt": "2025-08-01T11:59:00Z",
+                "currentLocation": {"coordinates": [7.5, 51.9]},
+                "sensors": [
+                    {"_id": "sensor1", "title": "Temperature", "unit": "°C", "sensorType": "t", "lastMeasurement": {"value": "25.5"}},
+                    {"_id": "sensor2", "title": "Speed", "unit": "m/s", "sensorType": "s", "lastMeasurement": {"value": "3"}},
+                ]
+            },
+            {"type": "Feature", "geometry": {"type": "LineString", "coordinates": []}, "properties": {"timestamps": []}},
+        ]
+
+        asyncio.run(fetch_and_store_data("ms"))
+
+        mock_backup.assert_not_called()
+        urls = [call.args[1] for call in mock_fetch.call_args_list]
+        data_urls = [call.args[1] for call in mock_stream_array.call_args_list]
+        self.assertEqual(len(urls), 3)
+        self.assertEqual(len(data_urls), 1)
+        self.assertFalse(any("sensor2" in url for url in data_urls))
+        self.assertIn("/data/sensor1/?from-date=2025-08-01T11:00:00.000Z&to-date=2025-08-01T12:00:00Z", data_urls[0])
+        self.assertIn("locations?format=geojson&from-date=2025-08-01T11:00:00.000Z", urls[2])
+        self.assertEqual(len(mock_sensordata_bulk.call_args.args[0]), 1)
+
+    @patch('sensebox.utils.fetch', new_callable=AsyncMock)
+    @patch('sensebox.utils.get_high_water_marks', new_callable=AsyncMock)
+    @patch('sensebox.utils.BoxTable.objects.bulk_create')
+    @patch('sensebox.utils.SensorTable.objects.bulk_create')
+    @patch('sensebox.utils.MeasurementTable.objects.bulk_create')
+    @patch('sensebox.utils.SensorDataTable.objects.bulk_create')
+    @patch('sensebox.utils.TracksTable.objects.bulk_create')
+    def test_partial_stream_is_not_logged_as_fetched(
+        self,
+        mock_tracks_bulk,
+        mock_sensordata_bulk,
+        mock_measurement_bulk,
+        mock_sensor_bulk,
+        mock_box_bulk,
+        mock_marks,
+        mock_fetch
+    ):
+        mock_marks.return_value = ({}, {})
+        mock_fetch.side_effect = [
+            [{"_id": "box123", "currentLocation": {"timestamp": "2025-08-01T12:00:00Z"}}],
+            {
+                "_id": "box123", "name": "Test Box", "updatedAt": "2025-08-01T12:00:00Z",
+                "createdAt": "2025-07-01T11:00:00Z", "currentLocation": {"coordinates": [7.5, 51.9]},
+                "sensors": [{"_id": "sensor1", "title": "Speed", "unit": "m/s", "sensorType": "s"}],
+            },
+            None,
+        ]
+        partial = stream_chunks(
+            [{"createdAt": "2025-08-01T11:30:00.000Z", "value": "3.5", "location": [7.6, 51.95]}],
+            error=FetchError("connection reset"),
+        )
+
+        with patch('sensebox.utils.stream_array', partial):
+            asyncio.run(fetch_and_store_data("ms"))
+
+        # The streamed rows are kept, but no fetch log row moves the sensor's high-water mark
+        self.assertEqual(len(mock_measurement_bulk.call_args.args[0]), 1)
+        mock_sensordata_bulk.assert_not_called()
+
+
+class FormatMarkTest(unittest.TestCase):
+    def test_marks_are_utc_with_z(self):
+        mark = datetime(2025, 8, 1, 13, 0, 0, 250000, tzinfo=dt_timezone(timedelta(hours=2)))
+        self.assertEqual(format_mark(mark), "2025-08-01T11:00:00.250Z")
+        # No '+' for the URL parser to decode into a space
+        self.assertEqual(URL(f"https://example.org/?from-date={format_mark(mark)}").query["from-date"],
+                         "2025-08-01T11:00:00.250Z")
+
+
+class ParseMeasurementTest(unittest.TestCase):
+    def test_parses_value_time_and_location(self):
+        timestamp, value, lon, lat = parse_measurement(
+            {"createdAt": "2025-08-01T11:30:00.123Z", "value": "25.5", "location": [7.6, 51.95]}
+        )
+        self.assertEqual(timestamp, datetime(2025, 8, 1, 11, 30, 0, 123000, tzinfo=dt_timezone.utc))
+        self.assertEqual((value, lon, lat), (25.5, 7.6, 51.95))
+
+    def test_dict_locations(self):
+        entry = {"createdAt": "2025-08-01T11:30:00Z", "value": "1"}
+        self.assertEqual(parse_measurement({**entry, "location": {"lng": 7.6, "lat": 51.95}})[2:], (7.6, 51.95))
+        self.assertEqual(parse_measurement({**entry, "location": {"type": "Point", "coordinates": [7.6, 51.95]}})[2:],
+                         (7.6, 51.95))
+
+    def test_location_is_optional(self):
+        self.assertEqual(parse_measurement({"createdAt": "2025-08-01T11:30:00Z", "value": "1"})[2:], (None, None))
+
+    def test_invalid_entries_are_skipped(self):
+        self.assertIsNone(parse_measurement({"createdAt": "2025-08-01T11:30:00Z", "value": "n/a"}))
+        self.assertIsNone(parse_measurement({"value": "1"}))
+
+
+class ExplodeSensorBlobsMigrationTest(TestCase):
+    def test_blobs_become_measurement_rows(self):
+        migration = importlib.import_module("sensebox.migrations.0002_measurement_table")
+        now = timezone.now()
+        box = BoxTable.objects.create(
+            box_id="box123", name="Test Box", created_at=now, updated_at=now, city="ms", coordinates=[]
+        )
+        sensor = SensorTable.objects.create(
+            sensor_id="sensor123", box_id=box, sensor_title="Speed", sensor_unit="m/s", sensor_type="s", city="ms"
+        )
+        SensorDataTable.objects.create(
+            sensor_id=sensor, box_id=box, sensor_title="Speed", timestamp=now, city="ms",
+            value=[
+                {"createdAt": "2025-08-01T11:30:00.000Z", "value": "3.5", "location": [7.6, 51.95]},
+                {"createdAt": "2025-08-01T11:30:00.000Z", "value": "3.5", "location": [7.6, 51.95]},
+                {"createdAt": "2025-08-01T11:31:00.000Z", "value": "4"},
+                {"createdAt": "2025-08-01T11:32:00.000Z", "value": "n/a"},
+                {"createdAt": "2025-08-01T11:33:00.000Z", "value": "5", "location": {"lng": 7.7, "lat": 51.9}},
+            ],
+        )
+
+        migration.explode_sensor_blobs(apps, None)
+
+        rows = list(MeasurementTable.objects.order_by("timestamp").values_list("value", "lon", "lat", "city"))
+        self.assertEqual(rows, [(3.5, 7.6, 51.95, "ms"), (4.0, None, None, "ms"), (5.0, 7.7, 51.9, "ms")])
+
+
+class BackupAndDeleteCityTest(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.box = BoxTable.objects.create(
+            box_id="box123", name="Test Box", created_at=now, updated_at=now,
+            city="ms", coordinates=[7.6, 51.9]
+        )
+        other_box = BoxTable.objects.create(
+            box_id="box456", name="Other Box", created_at=now, updated_at=now,
+            city="os", coordinates=[8.0, 52.2]
+        )
+        self.sensor = SensorTable.objects.create(
+            sensor_id="sensor123", box_id=self.box, sensor_title="Temperature",
+            sensor_unit="°C", sensor_type="temperature", city="ms"
+        )
+        SensorTable.objects.create(
+            sensor_id="sensor456", box_id=other_box, sensor_title="Temperature",
+            sensor_unit="°C", sensor_type="temperature", city="os"
+        )
+        SensorDataTable.objects.create(
+            sensor_id=self.sensor, box_id=self.box, sensor_title="Temperature",
+            timestamp=now, value=[{"value": "25.5"}], city="ms"
+        )
+        TracksTable.objects.create(
+            box=self.box, timestamp=now, tracks={"type": "Feature"}, city="ms"
+        )
+        MeasurementTable.objects.create(
+            sensor=self.sensor, box=self.box, sensor_title="Temperature", city="ms",
+            timestamp=now, value=25.5, lon=7.6, lat=51.95
+        )
+
+    def test_backup_copies_and_deletes_city_rows(self):
+        stats = backup_and_delete_city(
+            "ms", BoxTable, SensorTable, SensorDataTable, TracksTable,
+            BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup
+        )
+
+        self.assertEqual({name: s["rows"] for name, s in stats.items()}, {
+            "BoxTableBackup": 1, "SensorTableBackup": 1, "SensorDataTableBackup": 1, "TracksTableBackup": 1,
+            "MeasurementTableBackup": 1,
+        })
+        self.assertEqual(SensorTableBackup.objects.get().box_id, "box123")
+        self.assertEqual(SensorDataTableBackup.objects.get().value, [{"value": "25.5"}])
+        self.assertEqual(TracksTableBackup.objects.get().box_id, "box123")
+        self.assertEqual(MeasurementTableBackup.objects.get().sensor_id, "sensor123")
+        self.assertIsNotNone(BoxTableBackup.objects.get().archived_at)
+
+        # Originals of the city are gone, other cities are untouched
+        self.assertFalse(BoxTable.objects.filter(city="ms").exists())
+        self.assertFalse(SensorDataTable.objects.exists())
+        self.assertFalse(TracksTable.objects.exists())
+        self.assertFalse(MeasurementTable.objects.exists())
+        self.assertEqual(list(SensorTable.objects.values_list("sensor_id", flat=True)), ["sensor456"])
+
+    def test_backup_replaces_previous_backup(self):
+        args = (BoxTable, SensorTable, SensorDataTable, TracksTable,
+                BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup)
+        backup_and_delete_city("ms", *args)
+        BoxTable.objects.create(
+            box_id="box123", name="Test Box", created_at=timezone.now(), updated_at=timezone.now(),
+            city="ms", coordinates=[7.6, 51.9]
+        )
+        backup_and_delete_city("ms", *args)
+
+        self.assertEqual(BoxTableBackup.objects.filter(city="ms").count(), 1)
+
+
+class ApiClientTest(unittest.IsolatedAsyncioTestCase):
+    """Runs the fetch layer against a local aiohttp stub server"""
+
+    async def asyncSetUp(self):
+        self.calls = {"flaky": 0, "throttled": 0, "concurrent": 0, "max_concurrent": 0, "stalled": 0}
+
+        async def ok(request):
+            return web.json_response({"ok": True})
+
+        async def flaky(request):
+            self.calls["flaky"] += 1
+            if self.calls["flaky"] < 3:
+                return web.Response(status=503)
+            return web.json_response([1, 2, 3])
+
+        async def throttled(request):
+            self.calls["throttled"] += 1
+            if self.calls["throttled"] == 1:
+                return web.Response(status=429, headers={"Retry-After": "0"})
+            return web.json_response({"ok": True})
+
+        async def missing(request):
+            return web.Response(status=404)
+
+        async def broken(request):
+            return web.Response(status=500)
+
+        async def array(request):
+            response = web.StreamResponse()
+            await response.prepare(request)
+            body = json.dumps([{"value": str(i), "createdAt": "2025-08-01T11:30:00Z"} for i in range(500)])
+            for start in range(0, len(body), 1000):
+                await response.write(body[start:start + 1000].encode())
+            await response.write_eof()
+            return response
+
+        async def stalled(request):
+            # Sends the first items, then stops sending
+            self.calls["stalled"] += 1
+            response = web.StreamResponse()
+            await response.prepare(request)
+            await response.write(b'[{"value": "1"}, {"value": "2"}, ')
+            await asyncio.sleep(1)
+            return response
+
+        async def slow(request):
+            self.calls["concurrent"] += 1
+            self.calls["max_concurrent"] = max(self.calls["max_concurrent"], self.calls["concurrent"])
+            await asyncio.sleep(0.05)
+            self.calls["concurrent"] -= 1
+            return web.json_response({"ok": True})
+
+        app = web.Application()
+        for path, handler in [("/ok", ok), ("/flaky", flaky), ("/throttled", throttled),
+                              ("/missing", missing), ("/broken", broken), ("/slow", slow),
+                              ("/array", array), ("/stalled", stalled)]:
+            app.router.add_get(path, handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    def client(self, **kwargs):
+        options = {"max_retries": 3, "backoff_base": 0.001, "requests_per_second": 0}
+        options.update(kwargs)
+        return ApiClient(**options)
+
+    async def test_fetch_returns_json(self):
+        async with self.client() as client:
+            self.assertEqual(await fetch(client, str(self.server.make_url("/ok"))), {"ok": True})
+
+    async def test_retries_server_errors(self):
+        async with self.client() as client:
+            result = await fetch(client, str(self.server.make_url("/flaky")))
+        self.assertEqual(result, [1, 2, 3])
+        self.assertEqual(self.calls["flaky"], 3)
+
+    async def test_retries_after_429(self):
+        async with self.client() as client:
+            result = await fetch(client, str(self.server.make_url("/throttled")))
+        self.assertEqual(result, {"ok": True})
+        self.assertEqual(self.calls["throttled"], 2)
+
+    async def test_client_errors_are_not_retried(self):
+        async with self.client() as client:
+            self.assertIsNone(await fetch(client, str(self.server.make_url("/missing"))))
+
+    async def test_gives_up_after_max_retries(self):
+        async with self.client(max_retries=2) as client:
+            self.assertIsNone(await fetch(client, str(self.server.make_url("/broken"))))
+
+    async def test_concurrency_is_bounded(self):
+        async with self.client(max_connections=2) as client:
+            url = str(self.server.make_url("/slow"))
+            results = await asyncio.gather(*(fetch(client, url) for _ in range(6)))
+        self.assertEqual(len(results), 6)
+        self.assertLessEqual(self.calls["max_concurrent"], 2)
+
+    async def test_rate_limit_spaces_requests(self):
+        async with self.client(requests_per_second=20) as client:
+            url = str(self.server.make_url("/ok"))
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            await asyncio.gather(*(fetch(client, url) for _ in range(5)))
+            elapsed = loop.time() - start
+        self.assertGreaterEqual(elapsed, 0.18)
+
+    async def test_stream_array_yields_items_in_chunks(self):
+        async with self.client() as client:
+            chunks = [chunk async for chunk in stream_array(client, str(self.server.make_url("/array")))]
+        items = [item for chunk in chunks for item in chunk]
+        self.assertEqual(len(items), 500)
+        self.assertEqual(items[499]["value"], "499")
+
+    async def test_stream_failing_after_items_is_not_retried(self):
+        items = []
+        async with self.client(stream_timeout=aiohttp.ClientTimeout(sock_read=0.3)) as client:
+            with self.assertRaises(FetchError):
+                async for chunk in stream_array(client, str(self.server.make_url("/stalled"))):
+                    items.extend(chunk)
+        self.assertEqual(items, [{"value": "1"}, {"value": "2"}])
+        self.assertEqual(self.calls["stalled"], 1)
+
+    async def test_stream_is_not_capped_by_the_request_timeout(self):
+        # /array is sent in 1000 byte writes; each read only waits for the next one
+        async with self.client(timeout=aiohttp.ClientTimeout(total=0.001)) as client:
+            chunks = [chunk async for chunk in stream_array(client, str(self.server.make_url("/array")))]
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 500)
+
+    async def test_stream_array_rejects_non_arrays(self):
+        async with self.client() as client:
+            with self.assertRaises(FetchError):
+                async for _ in stream_array(client, str(self.server.make_url("/ok"))):
+                    pass
+
+
+class JsonArrayDecoderTest(unittest.TestCase):
+    def test_items_split_across_chunks(self):
+        text = json.dumps([{"value": "1.5", "location": [7.5, 51.9]}, 12345, "a,b", True, None, [1, [2]]])
+        decoder = JsonArrayDecoder()
+        items = []
+        for pos in range(0, len(text), 3):
+            items.extend(decoder.feed(text[pos:pos + 3]))
+        decoder.close()
+        self.assertEqual(items, json.loads(text))
+
+    def test_number_at_chunk_end_waits_for_more_data(self):
+        decoder = JsonArrayDecoder()
+        self.assertEqual(decoder.feed("[12"), [])
+        self.assertEqual(decoder.feed("34, 5]"), [1234, 5])
+        decoder.close()
+
+    def test_incomplete_array_raises(self):
+        decoder = JsonArrayDecoder()
+        decoder.feed('[{"a": 1}')
+        with self.assertRaises(ValueError):
+            decoder.close()
+
+
+class MeasurementWriterTest(unittest.IsolatedAsyncioTestCase):
+    @patch('sensebox.utils.TracksTable.objects.bulk_create')
+    @patch('sensebox.utils.BoxTable.objects.bulk_create')
+    async def test_rows_are_flushed_in_bounded_batches(self, mock_box_bulk, mock_tracks_bulk):
+        now = timezone.now()
+        async with MeasurementWriter(batch_size=2, max_pending=2) as writer:
+            box = BoxTable(box_id="box1", name="Box", created_at=now, updated_at=now, city="ms", coordinates=[])
+            await writer.put(box)
+            for _ in range(4):
+                await writer.put(TracksTable(box=box, timestamp=now, tracks={}, city="ms"))
+
+        self.assertEqual(writer.written, {"BoxTable": 1, "SensorTable": 0, "MeasurementTable": 0, "SensorDataTable": 0, "TracksTable": 4})
+        self.assertEqual([len(call.args[0]) for call in mock_tracks_bulk.call_args_list], [1, 2, 1])
+        self.assertEqual(mock_box_bulk.call_count, 1)
+
+    @patch('sensebox.utils.SensorDataTable.objects.bulk_create')
+    @patch('sensebox.utils.TracksTable.objects.bulk_create')
+    async def test_failed_batch_stops_writes_and_raises(self, mock_tracks_bulk, mock_sensordata_bulk):
+        now = timezone.now()
+        mock_tracks_bulk.side_effect = OperationalError("database is locked")
+        box = BoxTable(box_id="box1", name="Box", created_at=now, updated_at=now, city="ms", coordinates=[])
+        with self.assertRaisesRegex(OperationalError, "database is locked"):
+            async with MeasurementWriter(batch_size=2, max_pending=10) as writer:
+                for _ in range(2):
+                    await writer.put(TracksTable(box=box, timestamp=now, tracks={}, city="ms"))
+                await writer.put(SensorDataTable(box_id=box, timestamp=now, city="ms", value={}))
+
+        # The fetch log row queued after the failed batch is never written
+        self.assertEqual(mock_tracks_bulk.call_count, 1)
+        mock_sensordata_bulk.assert_not_called()
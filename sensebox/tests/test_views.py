@@ -1,11 +1,22 @@
 import unittest
-from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
 import pandas as pd
 import geopandas as gpd
 from unittest.mock import patch, MagicMock
 import json
+import random
+from collections import defaultdict
 from shapely.geometry import LineString
-from sensebox.views import split_linestring_by_day, normalize_semantic, normalization_config, calculate_bikeability, expand_weights
+from django.test import TestCase, override_settings
+from sensebox.models import BoxTable, SensorTable, MeasurementTable, TracksTable
+from sensebox import views
+from sensebox.storage import read_dataset, storage_path, write_dataset
+from sensebox.track_store import TrackStoreWriter, read_track_scores, read_track_segments
+from sensebox.tracks import split_track_by_day
+from sensebox.views import split_linestring_by_day, preprocessing_tracks, normalize_semantic, normalization_config, calculate_bikeability, expand_weights, preprocessing_sensors, calculate_traffic
 
 class TestSplitLineString(unittest.TestCase):
     def test_single_day_split(self):
@@ -46,6 +57,314 @@ class TestSplitLineString(unittest.TestCase):
         self.assertEqual(len(result["features"]), 1)  # Only one segment has 3 points
         self.assertEqual(result["features"][0]["properties"]["date"], "2025-08-02")
 
+def reference_split_linestring_by_day(features, id):
+    """The original per-point implementation of split_linestring_by_day, kept for the parity tests."""
+    coordinates = features["geometry"]["coordinates"]
+    timestamps = features["properties"]["timestamps"]
+    time_gap_threshold = timedelta(minutes=5)
+    daily_segments = defaultdict(list)
+    current_segment = {"coordinates": [], "timestamps": []}
+    last_time = None
+    for coord, timestamp in zip(coordinates, timestamps):
+        current_time = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+        if last_time is None:
+            last_time = current_time
+        if (
+            current_time.date() != last_time.date()
+            or current_time - last_time > time_gap_threshold
+        ):
+            if len(current_segment["coordinates"]) > 2:
+                daily_segments[last_time.date()].append(current_segment)
+                current_segment = {"coordinates": [], "timestamps": []}
+        current_segment["coordinates"].append(coord)
+        current_segment["timestamps"].append(timestamp)
+        last_time = current_time
+    if len(current_segment["coordinates"]) > 2:
+        daily_segments[last_time.date()].append(current_segment)
+
+    feature_collection = {"type": "FeatureCollection", "features": []}
+    for date, segments in daily_segments.items():
+        for segment in segments:
+            feature_collection["features"].append({
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": segment["coordinates"]},
+                "properties": {"timestamps": segment["timestamps"], "date": str(date), "box_id": id},
+            })
+    return feature_collection
+
+
+def random_track(rng, points, suffix="Z"):
+    """A track with short and long gaps, day changes, repeated and backwards timestamps."""
+    time = datetime(2025, 3, 1, 21, 0) + timedelta(seconds=rng.randrange(86400))
+    coordinates, timestamps = [], []
+    for _ in range(points):
+        time += rng.choice([
+            timedelta(seconds=rng.randrange(1, 30)), timedelta(0), timedelta(minutes=5),
+            timedelta(minutes=5, microseconds=1), timedelta(minutes=rng.randrange(6, 600)),
+            timedelta(hours=rng.randrange(20, 30)), -timedelta(seconds=rng.randrange(1, 600)),
+            -timedelta(days=1),
+        ])
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S") + (f".{rng.randrange(1000):03d}" if rng.random() < 0.5 else "")
+        timestamps.append(stamp + suffix)
+        coordinates.append([round(7.6 + rng.random() / 10, 6), round(51.9 + rng.random() / 10, 6)])
+    return {"type": "Feature", "geometry": {"type": "LineString", "coordinates": coordinates},
+            "properties": {"timestamps": timestamps}}
+
+
+class TestSplitLineStringParity(unittest.TestCase):
+    def assert_parity(self, track):
+        expected = reference_split_linestring_by_day(track, "box")
+        self.assertEqual(split_linestring_by_day(track, "box"), expected)
+
+        columns = split_track_by_day(track, "box")
+        features = expected["features"]
+        self.assertEqual(columns["date"], [f["properties"]["date"] for f in features])
+        self.assertEqual(columns["timestamps"], [f["properties"]["timestamps"] for f in features])
+        self.assertEqual(columns["box_id"], ["box"] * len(features))
+        self.assertEqual([list(map(list, g.coords)) for g in columns["geometry"]],
+                         [f["geometry"]["coordinates"] for f in features])
+
+    def test_random_tracks(self):
+        rng = random.Random(21)
+        for points in [0, 1, 2, 3, 4, 5, 10, 50, 200, 1000] * 5:
+            self.assert_parity(random_track(rng, points))
+
+    def test_other_offsets_and_naive_timestamps(self):
+        rng = random.Random(7)
+        for suffix in ["+02:00", "-05:30", "", "+00:00"]:
+            for points in [3, 40, 300]:
+                self.assert_parity(random_track(rng, points, suffix))
+
+    def test_mixed_offsets_use_the_local_date(self):
+        track = random_track(random.Random(1), 0)
+        track["geometry"]["coordinates"] = [[0, 0], [1, 1], [2, 2], [3, 3], [4, 4], [5, 5]]
+        track["properties"]["timestamps"] = [
+            "2025-08-01T23:58:00Z", "2025-08-02T01:59:00+02:00", "2025-08-02T00:00:00Z",
+            "2025-08-02T00:01:00Z", "2025-08-02T00:02:00Z", "2025-08-02T00:03:00+00:00",
+        ]
+        self.assert_parity(track)
+
+    def test_more_timestamps_than_coordinates(self):
+        track = random_track(random.Random(3), 100)
+        track["geometry"]["coordinates"] = track["geometry"]["coordinates"][:60]
+        self.assert_parity(track)
+        track = random_track(random.Random(4), 100)
+        track["properties"]["timestamps"] = track["properties"]["timestamps"][:70]
+        self.assert_parity(track)
+
+
+class TestPreprocessingTracks(TestCase):
+    def setUp(self):
+        now = datetime(2025, 8, 1, 12, 0, tzinfo=dt_timezone.utc)
+        rng = random.Random(22)
+        self.tracks = []
+        for i in range(4):
+            box = BoxTable.objects.create(box_id=f"box{i}", name="Box", created_at=now, updated_at=now, city="ms", coordinates=[])
+            track = random_track(rng, 300)
+            TracksTable.objects.create(box=box, timestamp=now, tracks=track, city="ms")
+            self.tracks.append((track, box.box_id))
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def test_matches_the_feature_collection_path(self):
+        features = [f for track, box_id in self.tracks for f in reference_split_linestring_by_day(track, box_id)["features"]]
+        # The track store groups the segments by day, keeping their order within a day
+        expected = gpd.GeoDataFrame.from_features(features, crs="EPSG:4326").sort_values("date", kind="stable")
+
+        exists = os.path.exists
+        with patch("sensebox.views.os.path.exists", side_effect=lambda p: False if p == "/app" else exists(p)):
+            preprocessing_tracks("ms")
+        stored = read_track_segments("ms", timestamps=True)
+
+        self.assertEqual(stored["date"].dt.strftime("%Y-%m-%d").tolist(), expected["date"].tolist())
+        self.assertEqual(stored["box_id"].tolist(), expected["box_id"].tolist())
+        self.assertEqual([list(g.coords) for g in stored.geometry], [list(g.coords) for g in expected.geometry])
+        self.assertEqual([len(t) for t in stored["timestamps"]], [len(t) for t in expected["timestamps"]])
+
+        # The Processed_tracks dataset has the same segments
+        actual = read_dataset("./tracks/tracks/Processed_tracks_ms.geojson")
+        self.assertEqual(set(actual.columns), set(expected.columns))
+        self.assertEqual(actual["date"].tolist(), expected["date"].tolist())
+        self.assertEqual(actual["box_id"].tolist(), expected["box_id"].tolist())
+        self.assertTrue(actual.geometry.geom_equals_exact(expected.geometry.reset_index(drop=True), tolerance=0).all())
+        self.assertEqual(pd.to_datetime(actual["timestamps"].explode().tolist(), utc=True).tolist(),
+                         pd.to_datetime(expected["timestamps"].explode().tolist(), utc=True, format="ISO8601").tolist())
+
+    @override_settings(TRACK_EXPORTS=False)
+    def test_processed_tracks_can_be_switched_off(self):
+        self.run_preprocessing()
+        self.assertFalse(os.path.exists("./tracks/tracks"))
+
+    def test_streams_chunks_without_the_excluded_boxes(self):
+        now = datetime(2025, 8, 1, 12, 0, tzinfo=dt_timezone.utc)
+        excluded = BoxTable.objects.create(box_id="65451cd043923100076b517c", name="Box", created_at=now,
+                                           updated_at=now, city="ms", coordinates=[])
+        TracksTable.objects.create(box=excluded, timestamp=now, tracks=random_track(random.Random(5), 50), city="ms")
+
+        exists = os.path.exists
+        with patch("sensebox.views.os.path.exists", side_effect=lambda p: False if p == "/app" else exists(p)), \
+                patch("sensebox.views.TRACK_CHUNK_SIZE", 1):
+            preprocessing_tracks("ms")
+        stored = read_track_segments("ms")
+
+        features = [f for track, box_id in self.tracks for f in reference_split_linestring_by_day(track, box_id)["features"]]
+        expected = sorted(features, key=lambda f: f["properties"]["date"])
+        self.assertEqual(stored["box_id"].tolist(), [f["properties"]["box_id"] for f in expected])
+
+    def run_preprocessing(self):
+        exists = os.path.exists
+        with patch("sensebox.views.os.path.exists", side_effect=lambda p: False if p == "/app" else exists(p)), \
+                patch("sensebox.views.split_track_by_day", wraps=split_track_by_day) as split:
+            preprocessing_tracks("ms")
+        return split.call_count
+
+    def stored_segments(self):
+        stored = read_track_segments("ms", timestamps=True)
+        return (stored["box_id"].tolist(), stored["date"].tolist(), [list(g.coords) for g in stored.geometry],
+                [t.tolist() for t in stored["timestamps"]])
+
+    def test_only_new_track_rows_are_processed(self):
+        self.assertEqual(self.run_preprocessing(), 4)
+        now = datetime(2025, 8, 2, 12, 0, tzinfo=dt_timezone.utc)
+        TracksTable.objects.create(box_id="box1", timestamp=now, tracks=random_track(random.Random(6), 200), city="ms")
+        self.assertEqual(self.run_preprocessing(), 1)
+        appended = self.stored_segments()
+        self.assertEqual(self.run_preprocessing(), 0)
+
+        # The same store as built from all rows at once
+        shutil.rmtree("./tracks/track_store")
+        self.assertEqual(self.run_preprocessing(), 5)
+        self.assertEqual(self.stored_segments(), appended)
+
+    def test_removed_track_rows_rebuild_the_store(self):
+        self.run_preprocessing()
+        TracksTable.objects.filter(box_id="box0").delete()
+        self.assertEqual(self.run_preprocessing(), 3)
+        self.assertNotIn("box0", read_track_segments("ms")["box_id"].tolist())
+
+    def test_no_tracks(self):
+        TracksTable.objects.all().delete()
+        exists = os.path.exists
+        with patch("sensebox.views.os.path.exists", side_effect=lambda p: False if p == "/app" else exists(p)):
+            with self.assertRaisesRegex(ValueError, "No tracks for ms"):
+                preprocessing_tracks("ms")
+        self.assertFalse(os.path.exists("./tracks/track_store/ms"))
+
+
+def reference_trackwise_scores(city):
+    """The sensor aggregation of bikeability_trackwise as it was before vectorizing the group normalization."""
+    info = views.city_data[city]
+    normalized_sensor_data = pd.DataFrame()
+    for file in info["sensor_files"]:
+        data = read_dataset(file, columns=["value", "timestamp", "box_id"], geometry=False)
+        data["date"] = pd.to_datetime(data["timestamp"]).dt.date
+        data["month"] = pd.to_datetime(data["timestamp"]).dt.month
+        data["value_normalized"] = data.groupby(["box_id", "date"])["value"].transform(
+            lambda x: (x - x.min()) / (x.max() - x.min()) if len(x) > 1 else x
+        )
+        pollutant_name = file.split("/")[-1].replace(".geojson", "")
+        data["weighted_value"] = data["value_normalized"] * info["weights"][pollutant_name]
+        normalized_sensor_data = pd.concat([normalized_sensor_data, data], ignore_index=True)
+    aggregated_data = normalized_sensor_data.groupby(["box_id", "date"]).agg({"weighted_value": "sum"}).reset_index()
+    series = aggregated_data["weighted_value"]
+    aggregated_data["factor_score"] = 1 - ((series - series.min()) / (series.max() - series.min()))
+    return aggregated_data
+
+
+class TestBikeabilityTrackwise(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+
+        rng = random.Random(23)
+        boxes = [f"box{i}" for i in range(5)]
+        for file in views.city_data["ms"]["sensor_files"]:
+            rows = []
+            for box in boxes:
+                for day in range(1, 8):
+                    # Some groups with a single measurement, some with constant values, a few missing values
+                    n = rng.choice([1, 2, 5, 30])
+                    constant = rng.random() < 0.1
+                    for _ in range(n):
+                        value = 3.0 if constant else (None if rng.random() < 0.02 else rng.uniform(0, 50))
+                        stamp = f"2025-08-{day:02d}T{rng.randrange(24):02d}:{rng.randrange(60):02d}:00.000Z"
+                        rows.append((value, stamp, box))
+            data = pd.DataFrame(rows, columns=["value", "timestamp", "box_id"])
+            write_dataset(gpd.GeoDataFrame(data, geometry=gpd.points_from_xy([7.6] * len(data), [51.9] * len(data)),
+                                           crs="EPSG:4326"), file)
+
+        # Two segments a day for each box, for 9 days
+        with TrackStoreWriter("ms") as store:
+            store.add({
+                "geometry": [LineString([(7.6, 51.9), (7.61, 51.91)])] * (len(boxes) * 18),
+                "timestamps": [["2025-08-01T10:00:00Z", "2025-08-01T10:00:05Z"]] * (len(boxes) * 18),
+                "date": [f"2025-08-{day:02d}" for box in boxes for day in range(1, 10) for _ in range(2)],
+                "box_id": [box for box in boxes for _ in range(18)],
+            })
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def run_trackwise(self, run=views.bikeability_trackwise, *args):
+        exists = os.path.exists
+        with patch("sensebox.views.os.path.exists", side_effect=lambda p: False if p == "/app" else exists(p)):
+            return run(*args, "ms")
+
+    def test_matches_the_per_group_lambda(self):
+        expected = reference_trackwise_scores("ms")
+        expected["date"] = pd.to_datetime(expected["date"])
+
+        self.run_trackwise()
+        scores = read_track_scores("ms")
+
+        actual = scores.merge(expected, on=["box_id", "date"], how="left", suffixes=("", "_expected"))
+        self.assertEqual(len(actual), 45)
+        self.assertEqual(actual["weighted_value"].isna().tolist(), actual["weighted_value_expected"].isna().tolist())
+        pd.testing.assert_series_equal(actual["weighted_value"], actual["weighted_value_expected"], check_names=False)
+        pd.testing.assert_series_equal(actual["factor_score"], actual["factor_score_expected"], check_names=False)
+        self.assertEqual(scores["box_id_number"].tolist(), [i + 1 for i in range(5) for _ in range(9)])
+
+    @override_settings(TRACK_EXPORTS=False)
+    def test_routes_export_can_be_switched_off(self):
+        self.run_trackwise()
+        self.assertFalse(os.path.exists("./tracks/BI/routes_with_bikeability_ms.geojson"))
+        self.assertEqual(len(read_track_scores("ms")), 45)
+
+    def test_routes_export(self):
+        self.run_trackwise()
+        routes = gpd.read_file("./tracks/BI/routes_with_bikeability_ms.geojson")
+        self.assertEqual(len(routes), 90)
+        self.assertEqual(set(routes.columns), {"box_id", "date", "month", "weighted_value", "factor_score",
+                                               "box_id_number", "geometry"})
+        scores = read_track_scores("ms")
+        self.assertEqual(routes.groupby(["box_id", "date"])["factor_score"].first().dropna().tolist(),
+                         scores.set_index(["box_id", "date"])["factor_score"].dropna().tolist())
+
+    def test_errors_are_raised(self):
+        # A missing input must fail the pipeline stage instead of returning an error status
+        os.remove(storage_path(views.city_data["ms"]["sensor_files"][0]))
+        with self.assertRaisesRegex(ValueError, "Error reading"):
+            self.run_trackwise()
+        self.assertFalse(os.path.exists("./tracks/track_store/ms/scores.npy"))
+
+        response = self.run_trackwise(views.bikeability_trackwise_view, MagicMock(method="GET"))
+        self.assertIn("Error reading", json.loads(response.content)["status"])
+
+    def test_normalize_per_group(self):
+        values = pd.Series([1.0, 3.0, 2.0, 7.0, 4.0, 4.0, None])
+        keys = pd.Series(["a", "a", "a", "b", "c", "c", None])
+        normalized = views.normalize_per_group(values, values.groupby(keys))
+        self.assertEqual(normalized.iloc[:4].tolist(), [0.0, 1.0, 0.5, 7.0])
+        self.assertTrue(normalized.iloc[4:].isna().all())
+
+
 class TestNormalizeSemantic(unittest.TestCase):
     def test_linear_benefit_normalization(self):
         s = pd.Series([100, 150, 200])
@@ -66,6 +385,114 @@ class TestNormalizeSemantic(unittest.TestCase):
         self.assertAlmostEqual(result.iloc[1], 1.0)
         self.assertAlmostEqual(result.iloc[2], 0.0)
 
+class TestPreprocessingSensors(TestCase):
+    def setUp(self):
+        now = datetime(2025, 8, 1, 12, 0, tzinfo=dt_timezone.utc)
+        box = BoxTable.objects.create(box_id="box1", name="Box", created_at=now, updated_at=now, city="ms", coordinates=[])
+        rows = [
+            ("Geschwindigkeit", 36.0, 7.6, 51.9, "ms"),   # Münster, km/h
+            ("Speed", 5.0, 8.0, 52.3, "os"),              # Osnabrück
+            ("Speed", 7.0, 9.0, 50.0, "ms"),              # outside both cities
+            ("Speed", 6.0, 7.6, 51.9, "os"),              # outside the city it was fetched for
+            ("PM25", 12.0, 7.6, 51.95, "ms"),
+            ("Other", 1.0, 7.6, 51.95, "ms"),             # not a mapped title
+        ]
+        for i, (title, value, lon, lat, city) in enumerate(rows):
+            sensor = SensorTable.objects.create(
+                sensor_id=f"s{i}", box_id=box, sensor_title=title, sensor_unit="", sensor_type="", city=city
+            )
+            MeasurementTable.objects.create(
+                sensor=sensor, box=box, sensor_title=title, city=city,
+                timestamp=now.replace(microsecond=250000), value=value, lon=lon, lat=lat
+            )
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def test_writes_one_file_per_city_and_sensor(self):
+        exists = os.path.exists
+        with patch("sensebox.views.os.path.exists", side_effect=lambda p: False if p == "/app" else exists(p)):
+            preprocessing_sensors()
+
+        out = "./tracks/sensor_data"
+        names = ["ms_Finedust_PM2_5.geojson", "ms_Speed.geojson", "os_Speed.geojson"]
+        self.assertEqual(sorted(os.listdir(out)), [os.path.basename(storage_path(name)) for name in names])
+
+        speed = read_dataset(os.path.join(out, "ms_Speed.geojson"))
+        self.assertEqual(len(speed), 1)
+        self.assertAlmostEqual(speed["value"].iloc[0], 10.0)
+        self.assertEqual(speed["sensor_id"].iloc[0], "s0")
+        self.assertEqual((speed.geometry.x.iloc[0], speed.geometry.y.iloc[0]), (7.6, 51.9))
+        self.assertEqual(speed.crs, "EPSG:4326")
+        os_speed = read_dataset(os.path.join(out, "os_Speed.geojson"))
+        self.assertEqual(os_speed["sensor_id"].tolist(), ["s1"])
+        self.assertEqual(os_speed["timestamp"].iloc[0], "2025-08-01T12:00:00.250Z")
+
+    def test_single_city(self):
+        exists = os.path.exists
+        with patch("sensebox.views.os.path.exists", side_effect=lambda p: False if p == "/app" else exists(p)):
+            preprocessing_sensors("os")
+            with self.assertRaises(ValueError):
+                preprocessing_sensors(["ms", "xx"])
+
+        self.assertEqual(os.listdir("./tracks/sensor_data"), [os.path.basename(storage_path("os_Speed.geojson"))])
+
+
+class TestCalculateTraffic(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        os.makedirs("tracks/BI")
+        os.makedirs("sensebox/osrm/work")
+        gpd.GeoDataFrame({
+            "id": ["way/10", "way/20", "way/10", "way/30", "node/5"],
+            "safety_score": [0.8, 0.5, 0.1, None, 0.9],
+            "infrastructure_score": [0.6, 0.5, 0.1, 0.4, 0.9],
+            "environment_score": [1.0, 0.0, 0.1, 0.4, 0.9],
+        }, geometry=[LineString([(7.6, 51.9), (7.61, 51.91)])] * 5).to_file(
+            "tracks/BI/osm_normalized_ms.geojson", driver="GeoJSON"
+        )
+        pd.DataFrame({
+            "way_id": [20, 10, 30, 40],
+            "first_node_id": [201, 101, 301, 401],
+            "second_node_id": [202, 102, 302, 402],
+        }).to_csv("sensebox/osrm/ways.csv", index=False)
+        views._traffic_tables.clear()
+        self.weights = {"safety": 50, "infrastructure_quality": 40, "environment_quality": 10}
+
+    def tearDown(self):
+        views._traffic_tables.clear()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def test_writes_segment_speeds(self):
+        calculate_traffic("ms", self.weights, "traffic.csv")
+        with open("traffic.csv") as f:
+            lines = f.read().splitlines()
+
+        # ways.csv order; first score per way; edges without a score or a street are skipped
+        self.assertEqual(lines, ["201,202,11.25", "101,102,18.5"])
+
+    def test_edge_table_is_cached_until_files_change(self):
+        with patch("sensebox.views.gpd.read_file", wraps=gpd.read_file) as read_file:
+            calculate_traffic("ms", self.weights, "traffic.csv")
+            calculate_traffic("ms", {"safety": 0, "infrastructure_quality": 0, "environment_quality": 100}, "traffic.csv")
+            self.assertEqual(read_file.call_count, 1)
+
+            os.utime("sensebox/osrm/ways.csv", (2000000000, 2000000000))
+            calculate_traffic("ms", self.weights, "traffic.csv")
+            self.assertEqual(read_file.call_count, 2)
+
+        with open("traffic.csv") as f:
+            self.assertEqual(f.readline().strip(), "201,202,11.25")
+
+
 # class TestCalculateBikeability(unittest.TestCase):
 #     @patch("sensebox.views.gpd.GeoDataFrame.to_file")
 #     @patch("sensebox.views.gpd.read_file")
@@ -0,0 +1,185 @@
+import math
+import struct
+import threading
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+
+from sensebox.score_store import SCORE_COLUMNS, bikeability_index, stored_normalized_path, _signature
+from sensebox.storage import read_dataset
+
+# Mapbox vector tile (spec v2) settings
+TILE_EXTENT = 4096
+TILE_BUFFER = 64                # in tile units, so lines are not cut exactly at the tile edge
+SIMPLIFY_PIXELS = 1.0           # simplification tolerance in tile units
+LAYER_NAME = "streets"
+WEB_MERCATOR_HALF = 20037508.342789244
+
+# {city: (file signature, index)}, kept for the lifetime of the process
+_tile_indexes = {}
+_lock = threading.Lock()
+
+
+def load_tile_index(city):
+    """Street ids, category scores and Web Mercator geometries of a city with an STRtree over them.
+
+    Built once per process and rebuilt when precompute_normalized_data rewrites the streets.
+    """
+    path = stored_normalized_path(city)
+    signature = _signature(path)
+    cached = _tile_indexes.get(city)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with _lock:
+        cached = _tile_indexes.get(city)
+        if cached is None or cached[0] != signature:
+            streets = read_dataset(path, columns=["id"] + SCORE_COLUMNS)
+            if streets.crs is not None:
+                streets = streets.to_crs(epsg=3857)
+            geometries = np.asarray(streets.geometry.values)
+            index = {
+                "ids": streets["id"].astype(str).to_numpy(),
+                "scores": streets[SCORE_COLUMNS].to_numpy(dtype=np.float64),
+                "geometries": geometries,
+                "tree": STRtree(geometries),
+            }
+            cached = (signature, index)
+            _tile_indexes[city] = cached
+    return cached[1]
+
+
+def tile_bounds(z, x, y):
+    """Web Mercator bounds (minx, miny, maxx, maxy) of tile z/x/y."""
+    size = 2 * WEB_MERCATOR_HALF / (1 << z)
+    minx = -WEB_MERCATOR_HALF + x * size
+    maxy = WEB_MERCATOR_HALF - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= 24 and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+
+# --- protobuf encoding -------------------------------------------------------------------------
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number, wire_type):
+    return _varint((number << 3) | wire_type)
+
+
+def _bytes_field(number, payload):
+    return _field(number, 2) + _varint(len(payload)) + payload
+
+
+def _packed(number, values):
+    return _bytes_field(number, b"".join(_varint(int(v)) for v in values))
+
+
+def _value(value):
+    """Encodes a layer value: str as string_value, float as double_value."""
+    if isinstance(value, str):
+        return _bytes_field(1, value.encode())
+    return _field(3, 1) + struct.pack("<d", value)
+
+
+def _zigzag(values):
+    return (values << 1) ^ (values >> 63)
+
+
+def _line_commands(parts):
+    """MVT geometry commands for one (multi)line feature given its parts as integer (n, 2) arrays."""
+    commands = []
+    cursor = np.zeros(2, dtype=np.int64)
+    for coords in parts:
+        deltas = np.diff(np.vstack([cursor, coords]), axis=0)
+        encoded = _zigzag(deltas)
+        commands.append((1 << 3) | 1)               # MoveTo, 1 point
+        commands.extend(encoded[0].tolist())
+        commands.append(((len(coords) - 1) << 3) | 2)  # LineTo, n-1 points
+        commands.extend(encoded[1:].ravel().tolist())
+        cursor = coords[-1]
+    return commands
+
+
+def encode_tile(features, layer_name=LAYER_NAME, extent=TILE_EXTENT):
+    """Encodes ``features`` [(parts, {key: value})] as a single-layer line vector tile."""
+    keys, key_index = [], {}
+    values, value_index = [], {}
+    encoded_features = []
+    for parts, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+            if value not in value_index:
+                value_index[value] = len(values)
+                values.append(value)
+            tags += [key_index[key], value_index[value]]
+        feature = _packed(2, tags) + _field(3, 0) + _varint(2) + _packed(4, _line_commands(parts))
+        encoded_features.append(_bytes_field(2, feature))
+
+    layer = (
+        _field(15, 0) + _varint(2)
+        + _bytes_field(1, layer_name.encode())
+        + b"".join(encoded_features)
+        + b"".join(_bytes_field(3, key.encode()) for key in keys)
+        + b"".join(_bytes_field(4, _value(value)) for value in values)
+        + _field(5, 0) + _varint(extent)
+    )
+    return _bytes_field(3, layer)
+
+
+# --- tiles -------------------------------------------------------------------------------------
+
+def bikeability_tile(city, z, x, y, weights):
+    """Vector tile of the streets intersecting tile z/x/y with their bikeability index."""
+    index = load_tile_index(city)
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    size = maxx - minx
+    buffer = size * TILE_BUFFER / TILE_EXTENT
+
+    candidates = index["tree"].query(shapely.box(minx - buffer, miny - buffer, maxx + buffer, maxy + buffer))
+    if len(candidates) == 0:
+        return encode_tile([])
+    candidates.sort()
+
+    # Simplify to the tile resolution, then clip to the buffered tile
+    geometries = shapely.simplify(index["geometries"][candidates], size * SIMPLIFY_PIXELS / TILE_EXTENT)
+    geometries = shapely.clip_by_rect(geometries, minx - buffer, miny - buffer, maxx + buffer, maxy + buffer)
+
+    # Tile coordinates: origin top left, y pointing down
+    parts, feature_pos = shapely.get_parts(geometries, return_index=True)
+    coords, part_pos = shapely.get_coordinates(parts, return_index=True)
+    scale = TILE_EXTENT / size
+    pixels = np.empty(coords.shape, dtype=np.int64)
+    pixels[:, 0] = np.rint((coords[:, 0] - minx) * scale)
+    pixels[:, 1] = np.rint((maxy - coords[:, 1]) * scale)
+
+    values = bikeability_index({"scores": index["scores"][candidates]}, weights)
+
+    # Group the parts of each feature, dropping repeated points and degenerate parts
+    boundaries = np.flatnonzero(np.diff(part_pos)) + 1
+    features = {}
+    for part, coords in zip(np.unique(part_pos), np.split(pixels, boundaries)):
+        keep = np.ones(len(coords), dtype=bool)
+        keep[1:] = np.any(coords[1:] != coords[:-1], axis=1)
+        coords = coords[keep]
+        if len(coords) >= 2:
+            features.setdefault(feature_pos[part], []).append(coords)
+
+    return encode_tile([
+        (feature_parts, {"id": str(index["ids"][candidates[pos]]), "bikeability_index": float(values[pos])})
+        for pos, feature_parts in sorted(features.items())
+    ])
@@ -0,0 +1,328 @@
+import os
+import json
+import glob
+import hashlib
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.strtree import STRtree
+
+from sensebox.tracks import parse_timestamps
+
+# Daily track segments of a city, as written by preprocessing_tracks, keyed by (box_id, date):
+#
+#   days/<date>.npz  the segments of one day: box ids, point offsets, coordinates (x, y and, if any
+#                    point of the day has one, z) and timestamps (UTC instants as datetime64[us],
+#                    instead of one list of strings per segment)
+#   index.npy        one row per (box_id, date) key with the bounding box of its segments
+#   manifest.json    a digest of each day, so a rebuild only rewrites the days that changed, and the
+#                    track rows the store was built from (see read_track_source)
+#   scores.npy       the trackwise bikeability of each key, written by bikeability_trackwise
+#
+# While the store is written, the new segments are collected per day in a <city>.spool directory next to it.
+INDEX_FIELDS = [("box_id", "U64"), ("date", "datetime64[D]"),
+                ("minx", "f8"), ("miny", "f8"), ("maxx", "f8"), ("maxy", "f8")]
+SCORE_FIELDS = [("box_id", "U64"), ("date", "datetime64[D]"),
+                ("weighted_value", "f8"), ("factor_score", "f8"), ("box_id_number", "i8")]
+# Box ids in the spool files written while the store is written
+SPOOL_BOX_ID = "U64"
+
+# {city: (index file signature, TrackIndex)}, kept for the lifetime of the process
+_track_indexes = {}
+_lock = threading.Lock()
+
+
+def track_store_path(city):
+    return f"./tracks/track_store/{city}"
+
+
+def track_index_path(city):
+    return os.path.join(track_store_path(city), "index.npy")
+
+
+def track_scores_path(city):
+    return os.path.join(track_store_path(city), "scores.npy")
+
+
+def _day_path(city, date):
+    return os.path.join(track_store_path(city), "days", f"{date}.npz")
+
+
+def _save(path, save, *args, **kwargs):
+    """Writes a file under a temporary name first, so readers never see a half-written one."""
+    base, extension = os.path.splitext(path)
+    tmp = base + ".tmp" + extension
+    with open(tmp, "wb") as f:
+        save(f, *args, **kwargs)
+    os.replace(tmp, path)
+
+
+def _read_manifest(city):
+    try:
+        with open(os.path.join(track_store_path(city), "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"days": {}}
+
+
+def read_track_source(city):
+    """What the store was built from, as recorded by TrackStoreWriter (``source``), or None without a store."""
+    if not os.path.exists(track_index_path(city)):
+        return None
+    return _read_manifest(city).get("source")
+
+
+def _load_day(city, date):
+    with np.load(_day_path(city, date)) as day:
+        return {name: day[name] for name in day.files}
+
+
+def _with_z(coords, width):
+    """``coords`` with ``width`` columns, a missing z column filled with NaN."""
+    if coords.shape[1] == width:
+        return coords
+    return np.column_stack([coords, np.full(len(coords), np.nan)])
+
+
+def _concat_days(first, second):
+    """The segments of two days' arrays, those of ``second`` after those of ``first``."""
+    width = max(first["coords"].shape[1], second["coords"].shape[1])
+    return {
+        "box_id": np.concatenate([first["box_id"], second["box_id"]]),
+        "offsets": np.concatenate([first["offsets"], first["offsets"][-1] + second["offsets"][1:]]),
+        "coords": np.concatenate([_with_z(first["coords"], width), _with_z(second["coords"], width)]),
+        "timestamps": np.concatenate([first["timestamps"], second["timestamps"]]),
+    }
+
+
+class TrackStoreWriter:
+    """Writes the track store of a city from the columns of split_track_by_day, chunk by chunk.
+
+        with TrackStoreWriter(city, append=..., source=...) as store:
+            for columns in chunks:
+                store.add(columns)
+
+    By default the chunks hold all segments of the city and the store is rebuilt from them: days
+    whose segments changed are replaced and days without segments removed. With ``append`` the
+    chunks hold only new segments; they are added after the stored segments of their days and
+    new keys after the stored keys, while the other days are not touched.
+
+    Each chunk is appended to per-day spool files as it comes in, so only one chunk is in memory
+    while adding and one day while closing. ``source`` (any JSON value) is recorded in the
+    manifest, also if no segments were added. Nothing is written to the store if the block raises.
+    """
+
+    def __init__(self, city, append=False, source=None):
+        self.city = city
+        self.append = append
+        self.source = source
+        self.spool_dir = track_store_path(city) + ".spool"
+        self.dates = set()
+        self.segments = 0
+        self.rewritten = []
+        self.changed = False  # whether any day was written or removed
+
+    def _spool(self, date, name):
+        return os.path.join(self.spool_dir, f"{date}.{name}")
+
+    def add(self, columns):
+        geometries = np.asarray(columns["geometry"], dtype=object)
+        if len(geometries) == 0:
+            return
+        if self.segments == 0:
+            # Left over by an interrupted run
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+            os.makedirs(self.spool_dir)
+        box_ids = np.asarray(columns["box_id"], dtype=SPOOL_BOX_ID)
+        dates = np.asarray(columns["date"], dtype="datetime64[D]")
+        counts = shapely.get_num_coordinates(geometries).astype(np.int64)
+        # z is NaN for points without one
+        coords = shapely.get_coordinates(geometries, include_z=True)
+        stamps = [stamp for timestamps in columns["timestamps"] for stamp in timestamps]
+        _, instants = parse_timestamps(stamps)
+        # Position of each segment among all segments added, which orders the keys of the index
+        positions = np.arange(self.segments, self.segments + len(geometries), dtype=np.int64)
+        self.segments += len(geometries)
+
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        order = np.argsort(dates, kind="stable")
+        bounds = np.flatnonzero(np.diff(dates[order].astype("int64"))) + 1
+        for segments in np.split(order, bounds):
+            date = str(dates[segments[0]])
+            day_counts = counts[segments]
+            starts = np.cumsum(day_counts) - day_counts
+            points = np.arange(day_counts.sum()) + np.repeat(offsets[segments] - starts, day_counts)
+            for name, values in (("box_id", box_ids[segments]), ("counts", day_counts),
+                                 ("positions", positions[segments]), ("coords", coords[points]),
+                                 ("timestamps", instants[points])):
+                with open(self._spool(date, name), "ab") as f:
+                    np.ascontiguousarray(values).tofile(f)
+            self.dates.add(date)
+
+    def _read_day(self, date):
+        """The spooled segments of a day, in the order they were added."""
+        counts = np.fromfile(self._spool(date, "counts"), dtype=np.int64)
+        box_ids = np.fromfile(self._spool(date, "box_id"), dtype=SPOOL_BOX_ID)
+        coords = np.fromfile(self._spool(date, "coords"), dtype=np.float64).reshape(-1, 3)
+        if np.isnan(coords[:, 2]).all():
+            coords = coords[:, :2]  # 2D tracks only
+        day = {
+            # Stored as narrow as the ids of the day allow
+            "box_id": box_ids.astype(f"U{max(1, int(np.strings.str_len(box_ids).max()))}"),
+            "offsets": np.concatenate([[0], np.cumsum(counts)]),
+            "coords": coords,
+            "timestamps": np.fromfile(self._spool(date, "timestamps"), dtype="datetime64[us]"),
+        }
+        return day, np.fromfile(self._spool(date, "positions"), dtype=np.int64)
+
+    def _write_manifest(self, days):
+        manifest = {"days": days}
+        if self.source is not None:
+            manifest["source"] = self.source
+        _save(os.path.join(track_store_path(self.city), "manifest.json"),
+              lambda f: f.write(json.dumps(manifest, indent=2).encode()))
+
+    def close(self):
+        previous = _read_manifest(self.city)["days"]
+        if self.segments == 0:
+            # No new segments, but the store now covers the rows in ``source``
+            if self.append and self.source is not None:
+                self._write_manifest(previous)
+            return
+        os.makedirs(os.path.join(track_store_path(self.city), "days"), exist_ok=True)
+        days = dict(previous) if self.append else {}
+        keys = []
+        for date in sorted(self.dates):
+            day, positions = self._read_day(date)
+            coords, starts = day["coords"], day["offsets"][:-1]
+
+            # Bounding box (and first position) of each key of the day's new segments
+            keys.append(pd.DataFrame({
+                "box_id": day["box_id"], "position": positions,
+                "minx": np.minimum.reduceat(coords[:, 0], starts), "miny": np.minimum.reduceat(coords[:, 1], starts),
+                "maxx": np.maximum.reduceat(coords[:, 0], starts), "maxy": np.maximum.reduceat(coords[:, 1], starts),
+            }).groupby("box_id", sort=False).agg(
+                position=("position", "min"), minx=("minx", "min"), miny=("miny", "min"),
+                maxx=("maxx", "max"), maxy=("maxy", "max"),
+            ).reset_index().assign(date=np.datetime64(date, "D")))
+
+            if self.append and os.path.exists(_day_path(self.city, date)):
+                day = _concat_days(_load_day(self.city, date), day)
+            digest = hashlib.sha1()
+            for name in ("box_id", "offsets", "coords", "timestamps"):
+                digest.update(np.ascontiguousarray(day[name]).tobytes())
+            days[date] = digest.hexdigest()
+            if previous.get(date) != days[date] or not os.path.exists(_day_path(self.city, date)):
+                _save(_day_path(self.city, date), np.savez, **day)
+                self.rewritten.append(date)
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+        # Keys in order of their first segment
+        keys = pd.concat(keys, ignore_index=True).sort_values("position", kind="stable")
+        if self.append and os.path.exists(track_index_path(self.city)):
+            # After the stored keys; the bounding box of a stored key grows with its new segments
+            stored = np.load(track_index_path(self.city))
+            stored = pd.DataFrame({name: stored[name] for name, _ in INDEX_FIELDS})
+            keys = pd.concat([stored, keys], ignore_index=True).groupby(["box_id", "date"], sort=False).agg(
+                minx=("minx", "min"), miny=("miny", "min"), maxx=("maxx", "max"), maxy=("maxy", "max"),
+            ).reset_index()
+        index = np.empty(len(keys), dtype=INDEX_FIELDS)
+        for name, _ in INDEX_FIELDS:
+            index[name] = keys[name].to_numpy()
+
+        for date in set(previous) - set(days):
+            if os.path.exists(_day_path(self.city, date)):
+                os.remove(_day_path(self.city, date))
+        self.changed = bool(self.rewritten) or set(previous) != set(days)
+        if self.changed or not os.path.exists(track_index_path(self.city)):
+            _save(track_index_path(self.city), np.save, index)
+            self._write_manifest(days)
+        elif self.source is not None and self.source != _read_manifest(self.city).get("source"):
+            self._write_manifest(days)
+
+    def abort(self):
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class TrackIndex:
+    """The (box_id, date) keys of a city's track segments, with an R-tree over their bounding boxes."""
+
+    def __init__(self, index):
+        self.keys = pd.DataFrame({name: index[name] for name, _ in INDEX_FIELDS})
+        self.tree = STRtree(shapely.box(index["minx"], index["miny"], index["maxx"], index["maxy"]))
+
+    def query(self, bounds):
+        """Keys whose segments' bounding box intersects ``bounds`` (minx, miny, maxx, maxy, in EPSG:4326)."""
+        hits = np.sort(self.tree.query(shapely.box(*bounds)))
+        return self.keys.iloc[hits].reset_index(drop=True)
+
+
+def load_track_index(city):
+    """The TrackIndex of a city, reloaded when the index was rewritten. Raises FileNotFoundError if missing."""
+    path = track_index_path(city)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        cached = _track_indexes.get(city)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    track_index = TrackIndex(np.load(path))
+    with _lock:
+        _track_indexes[city] = (signature, track_index)
+    return track_index
+
+
+def read_track_segments(city, dates=None, timestamps=False):
+    """The segments of a city (of ``dates`` only, if given) as a GeoDataFrame in EPSG:4326.
+
+    With ``timestamps``, the datetime64[us] instants of each segment's points are in a column of arrays.
+    """
+    if dates is None:
+        paths = sorted(glob.glob(os.path.join(track_store_path(city), "days", "*.npz")))
+        paths = [path for path in paths if not path.endswith(".tmp.npz")]
+    else:
+        paths = [_day_path(city, np.datetime64(date, "D")) for date in dates]
+        paths = [path for path in paths if os.path.exists(path)]
+
+    frames = []
+    for path in paths:
+        with np.load(path) as day:
+            offsets = day["offsets"]
+            counts = np.diff(offsets)
+            geometry = shapely.linestrings(day["coords"], indices=np.repeat(np.arange(len(counts)), counts))
+            frame = {"box_id": day["box_id"],
+                     "date": np.full(len(counts), os.path.basename(path)[:-4], dtype="datetime64[D]"),
+                     "geometry": geometry}
+            if timestamps:
+                frame["timestamps"] = np.split(day["timestamps"], offsets[1:-1])
+        frames.append(pd.DataFrame(frame))
+    columns = ["box_id", "date", "geometry"] + (["timestamps"] if timestamps else [])
+    data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    return gpd.GeoDataFrame(data, geometry="geometry", crs="EPSG:4326")
+
+
+def write_track_scores(city, scores):
+    """Writes the trackwise bikeability of each key; ``scores`` has the columns of SCORE_FIELDS."""
+    table = np.empty(len(scores), dtype=SCORE_FIELDS)
+    for name, _ in SCORE_FIELDS:
+        table[name] = scores[name].to_numpy()
+    os.makedirs(track_store_path(city), exist_ok=True)
+    _save(track_scores_path(city), np.save, table)
+    return track_scores_path(city)
+
+
+def read_track_scores(city):
+    table = np.load(track_scores_path(city))
+    return pd.DataFrame({name: table[name] for name, _ in SCORE_FIELDS})
@@ -0,0 +1,89 @@
+import numpy as np
+import shapely
+from datetime import datetime, timedelta
+
+# Daily segments of the openSenseMap tracks (location histories) of a box, shared by preprocessing_tracks
+# and the track store.
+
+# A track is split where consecutive locations are more than this apart in time, or on a new day
+TRACK_GAP = np.timedelta64(5, "m")
+
+
+def parse_timestamps(timestamps):
+    """Wall-clock times (for the date) and instants (for the gaps) of ISO 8601 strings, as datetime64[us].
+
+    As with datetime.fromisoformat, the date is the one in the timestamp's own UTC offset.
+    """
+    text = np.asarray(timestamps, dtype=str)
+    if len(text) and np.all(np.strings.endswith(text, "Z")):
+        try:
+            wall = np.strings.rstrip(text, "Z").astype("datetime64[us]")
+            return wall, wall
+        except ValueError:
+            pass  # a format numpy does not parse, fromisoformat may
+
+    # Other offsets (or formats) are rare, these are parsed one by one
+    parsed = [datetime.fromisoformat(timestamp.replace("Z", "+00:00")) for timestamp in timestamps]
+    if len({p.tzinfo is None for p in parsed}) > 1:
+        raise TypeError("can't subtract offset-naive and offset-aware datetimes")
+    wall = np.array([p.replace(tzinfo=None) for p in parsed], dtype="datetime64[us]")
+    instants = np.array([(p - (p.utcoffset() or timedelta())).replace(tzinfo=None) for p in parsed],
+                        dtype="datetime64[us]")
+    return wall, instants
+
+
+def track_segments(timestamps):
+    """Bounds of the daily segments of a track: (starts, ends, dates) with the points of segment i in
+    [starts[i], ends[i]), ordered by date (in order of first appearance), then by position.
+
+    A segment ends before a point more than TRACK_GAP after the previous one or on another day, but only
+    once it has more than two points; a shorter segment continues instead. Its date is that of its last
+    point. A last segment with two points or less is dropped.
+    """
+    count = len(timestamps)
+    if count == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype="datetime64[D]")
+
+    wall, instants = parse_timestamps(timestamps)
+    days = wall.astype("datetime64[D]")
+    breaks = np.flatnonzero((days[1:] != days[:-1]) | (instants[1:] - instants[:-1] > TRACK_GAP)) + 1
+
+    # Whether a break closes the segment depends on the breaks before it, but there are few of them
+    starts, ends = [], []
+    start = 0
+    for end in breaks.tolist() + [count]:
+        if end - start > 2:
+            starts.append(start)
+            ends.append(end)
+            start = end
+    starts, ends = np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+    dates = days[ends - 1]
+
+    # Grouped by date like a dict of dates would be
+    _, first, inverse = np.unique(dates, return_index=True, return_inverse=True)
+    order = np.lexsort((np.arange(len(dates)), first[inverse]))
+    return starts[order], ends[order], dates[order]
+
+
+def split_track_by_day(features, id):
+    """Splits a track Feature into daily segments (see track_segments), as table columns with shapely
+    LineStrings built in one call. views.split_linestring_by_day returns the same segments as Features.
+    """
+    coordinates = features["geometry"]["coordinates"]
+    timestamps = features["properties"]["timestamps"]
+    count = min(len(coordinates), len(timestamps))
+    starts, ends, dates = track_segments(timestamps[:count])
+    if len(starts) == 0:
+        return {"geometry": [], "timestamps": [], "date": [], "box_id": []}
+
+    # The points of all segments in order, with the segment number of each point
+    lengths = ends - starts
+    points = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    coords = np.asarray(coordinates[:count], dtype=float).reshape(count, -1)
+    return {
+        "geometry": shapely.linestrings(coords[points], indices=np.repeat(np.arange(len(starts)), lengths)),
+        "timestamps": [timestamps[start:end] for start, end in zip(starts.tolist(), ends.tolist())],
+        "date": dates.astype(str).tolist(),
+        "box_id": [id] * len(starts),
+    }
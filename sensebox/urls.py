@@ -9,4 +9,5 @@ urlpatterns = [
     path('bikeability_trackwise/<str:city>/', views.bikeability_trackwise_view, name='bikeability_trackwise'),
     path('osm-bikeability-index/<str:city>/', views.osm_segements_bikeability_index_view, name='osm_bikeability_index'),
     path('route/v1/driving/<str:coords>', views.route, name='route'),
+    path('tiles/<str:city>/<int:z>/<int:x>/<int:y>.mvt', views.bikeability_tile_view, name='bikeability_tile'),
 ]
@@ -1,12 +1,21 @@
 import requests
-from sensebox.models import BoxTable, SensorTable, SensorDataTable, TracksTable, BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup
+from sensebox.models import BoxTable, SensorTable, SensorDataTable, TracksTable, MeasurementTable, BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup, MeasurementTableBackup
 import json
 import os
-from django.db.models import Count
+from django.db.models import Count, Max, Value, DateTimeField
 from django.db import transaction
 from django.db import connection 
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from datetime import timezone as dt_timezone
+import time
 import asyncio
+import codecs
+import random
+import resource
+import sys
 import aiohttp
+from yarl import URL
 from asgiref.sync import sync_to_async
 
 # Helper function to create a feature from track data
@@ -32,80 +41,457 @@ def create_feature(track_data, box_id, timestamp):
         return None
 
 
+# openSenseMap HTTP client settings
+MAX_CONNECTIONS = 8             # concurrent requests in flight
+REQUESTS_PER_SECOND = 10        # per host
+MAX_RETRIES = 4                 # retries on 429/5xx, connection errors and timeouts
+BACKOFF_BASE = 1.0              # seconds, doubled per retry and jittered
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=300, connect=15)
+# Streamed responses (long sensor histories) may take arbitrarily long; only a stalled read fails
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=15, sock_read=60)
+
+# Streaming ingestion settings
+STREAM_CHUNK_BYTES = 64 * 1024  # bytes read from a response at a time
+WRITE_BATCH_SIZE = 2000         # rows per bulk_create flush
+MAX_PENDING_ROWS = 4000         # rows queued for the writer before fetches wait
+
+
+class FetchError(Exception):
+    """Raised when a streamed request fails."""
+
+
+class JsonArrayDecoder:
+    """Incrementally decodes the items of a top-level JSON array fed in text chunks."""
+
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.done = False
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, text):
+        """Adds ``text`` and returns the list of items completed by it."""
+        buf = self.buffer + text
+        pos, items = 0, []
+        while not self.done:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buf):
+                break
+            if not self.started:
+                if buf[pos] != "[":
+                    raise ValueError(f"Expected a JSON array, got {buf[pos:pos + 40]!r}")
+                self.started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                self.done = True
+                pos += 1
+                break
+            try:
+                item, end = self._decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break  # item not complete yet
+            if end == len(buf) and not isinstance(item, (dict, list, str)):
+                break  # a number or literal may continue in the next chunk
+            items.append(item)
+            pos = end
+        self.buffer = buf[pos:]
+        return items
+
+    def close(self):
+        if not self.done:
+            raise ValueError("Incomplete JSON array")
+
+
+class RateLimiter:
+    """Spaces out requests so that at most ``rate`` requests per second are started."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class ApiClient:
+    """aiohttp session with bounded concurrency, per-host rate limiting, timeouts and retries.
+
+    Use as ``async with ApiClient() as client:`` and request JSON with ``fetch(client, url)``.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, requests_per_second=REQUESTS_PER_SECOND,
+                 max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE, timeout=REQUEST_TIMEOUT,
+                 stream_timeout=STREAM_TIMEOUT):
+        self.max_connections = max_connections
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self.stream_timeout = stream_timeout
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.rate_limiters = {}
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def backoff(self, attempt, retry_after=None):
+        """Exponential backoff with full jitter; honours a numeric Retry-After header."""
+        if retry_after is not None:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                pass
+        return random.uniform(0, self.backoff_base * (2 ** attempt))
+
+    async def get_json(self, url):
+        """GETs ``url`` and returns the decoded JSON, or None once all retries failed."""
+        host = URL(url).host
+        limiter = self.rate_limiters.setdefault(host, RateLimiter(self.requests_per_second))
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            async with self.semaphore:
+                await limiter.wait()
+                try:
+                    async with self.session.get(url) as response:
+                        if response.status not in RETRY_STATUSES:
+                            response.raise_for_status()
+                            return await response.json(content_type=None)
+                        retry_after = response.headers.get("Retry-After")
+                        error = f"HTTP {response.status}"
+                except aiohttp.ClientResponseError as e:
+                    # Other 4xx responses are not retried
+                    print(f"Request failed for {url}: {e}")
+                    return None
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = repr(e)
+
+            if attempt < self.max_retries:
+                delay = self.backoff(attempt, retry_after)
+                print(f"Request for {url} failed ({error}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+        print(f"Request failed for {url} after {self.max_retries + 1} attempts: {error}")
+        return None
+
+
+    async def iter_json_array(self, url):
+        """Streams a JSON array response, yielding lists of items as they are decoded.
+
+        Connection errors and retryable statuses are retried until the first items were yielded;
+        after that a failure raises FetchError, since a retry would yield those items again.
+        """
+        host = URL(url).host
+        limiter = self.rate_limiters.setdefault(host, RateLimiter(self.requests_per_second))
+
+        yielded = False
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            async with self.semaphore:
+                await limiter.wait()
+                try:
+                    async with self.session.get(url, timeout=self.stream_timeout) as response:
+                        if response.status not in RETRY_STATUSES:
+                            response.raise_for_status()
+                            decoder = JsonArrayDecoder()
+                            text_decoder = codecs.getincrementaldecoder("utf-8")()
+                            async for chunk in response.content.iter_chunked(STREAM_CHUNK_BYTES):
+                                items = decoder.feed(text_decoder.decode(chunk))
+                                if items:
+                                    yielded = True
+                                    yield items
+                            decoder.feed(text_decoder.decode(b"", final=True))
+                            decoder.close()
+                            return
+                        retry_after = response.headers.get("Retry-After")
+                        error = f"HTTP {response.status}"
+                except aiohttp.ClientResponseError as e:
+                    raise FetchError(f"Request failed for {url}: {e}") from e
+                except (aiohttp.ClientPayloadError, ValueError) as e:
+                    raise FetchError(f"Streaming failed for {url}: {e!r}") from e
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if yielded:
+                        raise FetchError(f"Streaming failed for {url}: {e!r}") from e
+                    error = repr(e)
+
+            if attempt < self.max_retries:
+                delay = self.backoff(attempt, retry_after)
+                print(f"Request for {url} failed ({error}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+        raise FetchError(f"Request failed for {url} after {self.max_retries + 1} attempts: {error}")
+
+
 async def fetch(session, url):
-    """Fetch a URL asynchronously."""
+    """Fetch a URL asynchronously through an ApiClient; returns None on failure."""
+    return await session.get_json(url)
+
+
+def stream_array(session, url):
+    """Stream a JSON array through an ApiClient in decoded chunks; raises FetchError on failure."""
+    return session.iter_json_array(url)
+
+
+def parse_measurement(entry):
+    """Returns (timestamp, value, lon, lat) for an openSenseMap measurement, or None if invalid."""
     try:
-        async with session.get(url) as response:
-            response.raise_for_status()
-            return await response.json()
-    except aiohttp.ClientError as e:
-        print(f"Request failed for {url}: {e}")
+        timestamp = parse_datetime(entry["createdAt"])
+        value = float(entry["value"])
+    except (KeyError, TypeError, ValueError):
         return None
+    if timestamp is None:
+        return None
+    lon, lat = parse_location(entry.get("location"))
+    return timestamp, value, lon, lat
+
+
+def parse_location(location):
+    """Returns (lon, lat) of a measurement location given as [lon, lat, ...], {"lng", "lat"} or GeoJSON."""
+    if isinstance(location, dict):
+        if "coordinates" not in location:
+            return location.get("lng"), location.get("lat")
+        location = location["coordinates"]
+    if location and len(location) >= 2:
+        return location[0], location[1]
+    return None, None
+
+
+class MeasurementWriter:
+    """Writes fetched rows to the database in bounded batches while the fetch is running.
+
+    Rows are queued with ``await writer.put(obj)``; the queue is bounded, so fetches wait while
+    the database catches up. Boxes and sensors are always flushed before the rows referencing them.
+
+    Batches are written in queue order, so a sensor's fetch log row is committed together with, or
+    after, the last of its measurements. Once a batch fails nothing more is written: further put()
+    calls raise the error, and it is raised again when the block exits.
+    """
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, max_pending=MAX_PENDING_ROWS):
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.batches = {BoxTable: [], SensorTable: [], MeasurementTable: [], SensorDataTable: [], TracksTable: []}
+        self.written = {model.__name__: 0 for model in self.batches}
+        self.task = None
+        self.error = None
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self._consume())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.queue.put(None)
+        await self.task
+        if self.error is not None and exc_info[0] is None:
+            raise self.error
+
+    async def put(self, obj):
+        if self.error is not None:
+            raise self.error
+        await self.queue.put(obj)
+
+    async def _consume(self):
+        pending = 0
+        while True:
+            obj = await self.queue.get()
+            if obj is None:
+                break
+            self.batches[type(obj)].append(obj)
+            pending += 1
+            if pending >= self.batch_size:
+                await self._flush()
+                pending = 0
+        await self._flush()
+
+    async def _flush(self):
+        batches = {model: rows for model, rows in self.batches.items() if rows}
+        self.batches = {model: [] for model in self.batches}
+        if not batches or self.error is not None:
+            return
+        try:
+            await sync_to_async(self._write)(batches)
+        except Exception as e:
+            # The queue is still drained so fetches never block on a dead writer, but nothing
+            # after the failed batch is stored (a later fetch log row would skip its measurements)
+            self.error = e
+
+    def _write(self, batches):
+        with transaction.atomic():
+            for model, rows in batches.items():
+                if model is BoxTable:
+                    BoxTable.objects.bulk_create(
+                        rows,
+                        update_conflicts=True,
+                        unique_fields=['box_id'],
+                        update_fields=['name', 'city', 'created_at', 'updated_at', 'last_measurement_at', 'coordinates'],
+                    )
+                elif model is SensorTable:
+                    SensorTable.objects.bulk_create(
+                        rows,
+                        update_conflicts=True,
+                        unique_fields=['sensor_id'],
+                        update_fields=['box_id', 'sensor_title', 'sensor_icon', 'sensor_unit', 'sensor_type', 'city', 'sensor_value'],
+                    )
+                else:
+                    model.objects.bulk_create(rows, ignore_conflicts=True)
+                self.written[model.__name__] += len(rows)
+
+
+def process_peak_memory_mb():
+    """Peak resident set size of this process in MB, over its whole lifetime so far.
+
+    Not the peak of a single fetch: when the process ran earlier stages (as the pipeline does),
+    this may be their peak.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def copy_to_backup(queryset, backup_model, field_map, archived_at):
+    """Copies the rows of ``queryset`` into ``backup_model`` with one INSERT ... SELECT statement.
+
+    ``field_map`` maps backup field names to source field names; FK source fields are copied as
+    their raw column value, so no related rows are fetched. Returns the number of copied rows.
+    """
+    source_fields = list(field_map.values())
+    select = queryset.order_by().annotate(
+        backup_archived_at=Value(archived_at, output_field=DateTimeField())
+    ).values_list(*source_fields, "backup_archived_at")
+    select_sql, params = select.query.sql_with_params()
+
+    target_columns = [backup_model._meta.get_field(name).column for name in field_map]
+    target_columns.append(backup_model._meta.get_field("archived_at").column)
+    quote = connection.ops.quote_name
+    sql = "INSERT INTO {} ({}) {}".format(
+        quote(backup_model._meta.db_table),
+        ", ".join(quote(col) for col in target_columns),
+        select_sql,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def backup_and_delete_city(city, BoxTable, SensorTable, SensorDataTable, TracksTable,
+                           BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup,
+                           MeasurementTable=MeasurementTable, MeasurementTableBackup=MeasurementTableBackup):
+    """Moves all measurements of a city into the backup tables in a single transaction.
+
+    Each table is copied with one set-based INSERT ... SELECT. Returns the copied row count
+    and rows/second per table.
+    """
+    archived_at = timezone.now()
+    stats = {}
+
+    with transaction.atomic():
+        # Subquery of the city's box ids, evaluated by the database
+        box_ids = BoxTable.objects.filter(city=city).values('box_id')
+
+        # inorder to not overload with backups
+        BoxTableBackup.objects.filter(city=city).delete()
+        SensorTableBackup.objects.filter(box_id__in=box_ids).delete()
+        SensorDataTableBackup.objects.filter(box_id__in=box_ids).delete()
+        TracksTableBackup.objects.filter(box_id__in=box_ids).delete()
+        MeasurementTableBackup.objects.filter(box_id__in=box_ids).delete()
+
+        backups = [
+            (BoxTable.objects.filter(city=city), BoxTableBackup, {
+                "box_id": "box_id", "name": "name", "city": "city", "created_at": "created_at",
+                "updated_at": "updated_at", "last_measurement_at": "last_measurement_at",
+                "coordinates": "coordinates",
+            }),
+            (SensorTable.objects.filter(box_id__in=box_ids), SensorTableBackup, {
+                "sensor_id": "sensor_id", "box_id": "box_id", "sensor_title": "sensor_title",
+                "sensor_icon": "sensor_icon", "sensor_unit": "sensor_unit", "sensor_type": "sensor_type",
+                "sensor_value": "sensor_value", "city": "city",
+            }),
+            (SensorDataTable.objects.filter(box_id__in=box_ids), SensorDataTableBackup, {
+                "sensor_id": "sensor_id", "box_id": "box_id", "sensor_title": "sensor_title",
+                "timestamp": "timestamp", "value": "value", "city": "city",
+            }),
+            (TracksTable.objects.filter(box__in=box_ids), TracksTableBackup, {
+                "box_id": "box", "timestamp": "timestamp", "tracks": "tracks", "city": "city",
+            }),
+            (MeasurementTable.objects.filter(box__in=box_ids), MeasurementTableBackup, {
+                "sensor_id": "sensor", "box_id": "box", "sensor_title": "sensor_title", "city": "city",
+                "timestamp": "timestamp", "value": "value", "lon": "lon", "lat": "lat",
+            }),
+        ]
+        for queryset, backup_model, field_map in backups:
+            start = time.perf_counter()
+            rows = copy_to_backup(queryset, backup_model, field_map, archived_at)
+            elapsed = time.perf_counter() - start
+            rate = rows / elapsed if elapsed > 0 else 0.0
+            stats[backup_model.__name__] = {"rows": rows, "rows_per_second": rate}
+            print(f"Backed up {rows} rows to {backup_model.__name__} in {elapsed:.2f}s ({rate:.0f} rows/s)")
+
+        # Delete originals, children first so the box id subquery still resolves
+        TracksTable.objects.filter(box__in=box_ids).delete()
+        MeasurementTable.objects.filter(box__in=box_ids).delete()
+        SensorDataTable.objects.filter(box_id__in=box_ids).delete()
+        SensorTable.objects.filter(box_id__in=box_ids).delete()
+        BoxTable.objects.filter(city=city).delete()
+
+    return stats
+
+
+backup_and_delete_measurements = sync_to_async(backup_and_delete_city)
 
 @sync_to_async
-def backup_and_delete_measurements(city, BoxTable, SensorTable, SensorDataTable, TracksTable,
-                                   BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup):
-    # Get box_ids to backup
-    box_ids = BoxTable.objects.filter(city=city).values_list('box_id', flat=True)
-
-    # inorder to not overload with backups
-    BoxTableBackup.objects.filter(city=city).delete()
-    SensorTableBackup.objects.filter(box_id__in=box_ids).delete()
-    SensorDataTableBackup.objects.filter(box_id__in=box_ids).delete()
-    TracksTableBackup.objects.filter(box_id__in=box_ids).delete()
-
-    # Backup boxes
-    for box in BoxTable.objects.filter(city=city):
-        BoxTableBackup.objects.create(
-            box_id=box.box_id,
-            name=box.name,
-            city=box.city,
-            created_at=box.created_at,
-            updated_at=box.updated_at,
-            last_measurement_at=box.last_measurement_at,
-            coordinates=box.coordinates,
-        )
-    # breakpoint()
-    # Backup sensors
-    for sensor in SensorTable.objects.filter(box_id__in=box_ids):
-        SensorTableBackup.objects.create(
-            sensor_id=sensor.sensor_id,
-            box_id=sensor.box_id.box_id,   # 🔑 store ID, not FK object
-            sensor_title=sensor.sensor_title,
-            sensor_icon=sensor.sensor_icon,
-            sensor_unit=sensor.sensor_unit,
-            sensor_type=sensor.sensor_type,
-            sensor_value=sensor.sensor_value,
-            city=sensor.city,
-        )
-
-    # Backup sensor data
-    for data in SensorDataTable.objects.filter(box_id__in=box_ids):
-        SensorDataTableBackup.objects.create(
-            sensor_id=data.sensor_id.sensor_id,  # 🔑 store ID
-            box_id=data.box_id.box_id,           # 🔑 store ID
-            sensor_title=data.sensor_title,
-            timestamp=data.timestamp,
-            value=data.value,
-            city=data.city,
-        )
-
-    # Backup tracks
-    for track in TracksTable.objects.filter(box__box_id__in=box_ids):
-        TracksTableBackup.objects.create(
-            box_id=track.box.box_id,   # 🔑 use FK → box.box_id
-            timestamp=track.timestamp,
-            tracks=track.tracks,
-            city=track.city,
-        )
-
-    # Delete originals
-    BoxTable.objects.filter(city=city).delete()
-    SensorTable.objects.filter(box_id__in=box_ids).delete()
-    SensorDataTable.objects.filter(box_id__in=box_ids).delete()
-    TracksTable.objects.filter(box_id__in=box_ids).delete()
-
-async def fetch_and_store_data(city):
+def get_high_water_marks(city):
+    """Returns the latest completed fetch per sensor and per box (tracks) for a city.
+
+    Sensor marks come from SensorDataTable, which only gets a row once a sensor's stream was
+    read completely, so a partially streamed sensor is fetched again from its previous mark.
+    MeasurementWriter commits that row only after all of the sensor's measurements; the newest
+    stored measurement would not do, as the API streams the newest measurements first.
+    """
+    sensor_marks = dict(
+        SensorDataTable.objects.filter(city=city).values('sensor_id')
+        .annotate(latest=Max('timestamp')).values_list('sensor_id', 'latest')
+    )
+    track_marks = dict(
+        TracksTable.objects.filter(city=city).values('box')
+        .annotate(latest=Max('timestamp')).values_list('box', 'latest')
+    )
+    return sensor_marks, track_marks
+
+
+def format_mark(mark):
+    """A high-water mark as a UTC timestamp ending in Z, which needs no escaping in a from-date parameter."""
+    return mark.astimezone(dt_timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def is_up_to_date(mark, timestamp):
+    """True if a stored high-water mark already covers ``timestamp`` (an ISO string)."""
+    if mark is None:
+        return False
+    parsed = parse_datetime(timestamp) if isinstance(timestamp, str) else timestamp
+    return parsed is not None and mark >= parsed
+
+
+async def fetch_and_store_data(city, full_refresh=False):
+    """Fetches the bike boxes of a city from openSenseMap and stores them.
+
+    By default only measurements and locations newer than the stored high-water marks are
+    fetched and appended. With ``full_refresh`` the city is backed up, deleted and fetched
+    from each box's creation date.
+    """
     base_path = '/app/tracks' if os.path.exists('/app') else './tracks'
 
     # Model and path assignment based on city
@@ -121,12 +507,15 @@ async def fetch_and_store_data(city):
     bbox_str = f"{bbox['W']},{bbox['S']},{bbox['E']},{bbox['N']}"
     # params = {"grouptag": "bike", "bbox": bbox_str}
     
-    # Call delete_all_measurements for the specified city
-    # await delete_all_measurements(city, BoxTable, SensorTable, SensorDataTable, TracksTable)
-    await backup_and_delete_measurements(city, BoxTable, SensorTable, SensorDataTable, TracksTable, BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup)
+    if full_refresh:
+        # Back up and delete the city, then fetch everything again
+        await backup_and_delete_measurements(city, BoxTable, SensorTable, SensorDataTable, TracksTable, BoxTableBackup, SensorTableBackup, SensorDataTableBackup, TracksTableBackup)
+        sensor_marks, track_marks = {}, {}
+    else:
+        sensor_marks, track_marks = await get_high_water_marks(city)
 
     base_url = f"https://api.opensensemap.org/boxes?grouptag=bike&bbox={bbox_str}"
-    async with aiohttp.ClientSession() as session:
+    async with ApiClient() as session, MeasurementWriter() as writer:
         response = await fetch(session, base_url)
         
         if response is None:
@@ -134,13 +523,6 @@ async def fetch_and_store_data(city):
             return
         
         id_list = [{"id": entry["_id"], "timestamp": entry["currentLocation"]["timestamp"]} for entry in response]
-        
-        feature_collection = {"type": "FeatureCollection", "features": []}
-
-        boxes = []
-        sensors = []
-        sensordatas = []
-        track_data= []
 
         async def fetch_measurements(entry):
             id, timestamp = entry["id"], entry["timestamp"]
@@ -151,9 +533,8 @@ async def fetch_and_store_data(city):
             measurements = await fetch(session, measurements_url)
             if measurements is None :
                 print(f"Failed to fetch measurements for box ID {id}")
-                pass
+                return
 
-            
             box_id, name, updated_at, created_at, last_measurement_at = measurements["_id"], measurements.get("name"), measurements.get("updatedAt"), measurements.get("createdAt"), measurements.get("lastMeasurementAt")
             coordinates = measurements.get("currentLocation", {}).get('coordinates')
 
@@ -167,9 +548,9 @@ async def fetch_and_store_data(city):
                 last_measurement_at=last_measurement_at,
                 coordinates=coordinates
             )
-            boxes.append(box)
-            # print(boxes)
-            for sensor in measurements["sensors"]:
+            await writer.put(box)
+            sensor_requests = []
+            for sensor in measurements.get("sensors", []):
 
                 sensor_id = sensor.get("_id")
                 sensor_icon = sensor.get("icon")
@@ -189,89 +570,84 @@ async def fetch_and_store_data(city):
                     city= city,
                     sensor_value=sensor_value
                 )
-                sensors.append(sensor_obj)
-                # print(sensors)
-                # await update_or_create_measurement(MeasurementModel, box_id, sensor_title, name, sensor_id, sensor_icon,sensor_unit,sensor_type,sensor_value,updated_at,created_at, last_measurement_at, coordinates)
+                await writer.put(sensor_obj)
                 
-                # Fetch track measurements for each sensor
+                # Fetch track measurements for each sensor, only newer than its high-water mark
                 # sensor_values = requests.get(f'https://api.opensensemap.org/boxes/{id}/data/{sensor_id}/?to-date={timestamp}').json()
-                tracks_data_url = f'https://api.opensensemap.org/boxes/{id}/data/{sensor_id}/?from-date={created_at}to-date={timestamp}'
-                sensor_values = await fetch(session, tracks_data_url)
-                if sensor_values is None:
-                    print(f"Failed to fetch track data for sensor ID {sensor_id}")
+                sensor_mark = sensor_marks.get(sensor_id)
+                if is_up_to_date(sensor_mark, timestamp):
                     continue
-                
-                # await update_or_create_track_measurement(TrackMeasurementModel, box_id, sensor_id, sensor_values)
-                
-                sensor_data = SensorDataTable(
+                from_date = format_mark(sensor_mark) if sensor_mark else created_at
+                tracks_data_url = f'https://api.opensensemap.org/boxes/{id}/data/{sensor_id}/?from-date={from_date}&to-date={timestamp}'
+                sensor_requests.append((sensor_obj, tracks_data_url, from_date))
+
+            async def fetch_sensor_data(sensor_obj, url, from_date):
+                # Decoded incrementally and handed to the writer one measurement row at a time
+                count = 0
+                try:
+                    async for chunk in stream_array(session, url):
+                        for entry in chunk:
+                            parsed = parse_measurement(entry)
+                            if parsed is None:
+                                continue
+                            measured_at, value, lon, lat = parsed
+                            await writer.put(MeasurementTable(
+                                sensor=sensor_obj,
+                                box=box,
+                                sensor_title=sensor_obj.sensor_title,
+                                city=city,
+                                timestamp=measured_at,
+                                value=value,
+                                lon=lon,
+                                lat=lat
+                            ))
+                            count += 1
+                except FetchError as e:
+                    # Rows written so far are kept; the missing fetch log row makes the next run retry
+                    print(f"Failed to fetch track data for sensor ID {sensor_obj.sensor_id}: {e}")
+                    return
+                await writer.put(SensorDataTable(
                     sensor_id=sensor_obj,
                     box_id=box,
-                    sensor_title= sensor_title,
+                    sensor_title= sensor_obj.sensor_title,
                     timestamp=timestamp,
                     city= city,
-                    value=sensor_values
-                )
-                sensordatas.append(sensor_data)
-                # print(sensordatas)
+                    value={"measurements": count, "from_date": from_date}
+                ))
+
+            # Fetch the sensors of this box concurrently
+            await asyncio.gather(*(fetch_sensor_data(*request) for request in sensor_requests))
           
             # Fetch and save bike tracks
             # track = requests.get(f"https://api.opensensemap.org/boxes/{id}/locations?format=geojson&to-date={timestamp}").json()
-            route_url = f"https://api.opensensemap.org/boxes/{id}/locations?format=geojson&from-date={created_at}&to-date={timestamp}"
+            track_mark = track_marks.get(box_id)
+            if is_up_to_date(track_mark, timestamp):
+                return
+            from_date = format_mark(track_mark) if track_mark else created_at
+            route_url = f"https://api.opensensemap.org/boxes/{id}/locations?format=geojson&from-date={from_date}&to-date={timestamp}"
             
             track = await fetch(session, route_url)
-            
+            if track is None:
+                print(f"Failed to fetch locations for box ID {id}")
+                return
 
             # await update_or_create_tracks(TrackModel, box_id, timestamp, track)
-
-            # # Prepare TrackModel instance
-            tracks= TracksTable(
+            await writer.put(TracksTable(
                     box_id=box_id,
                     tracks=track,
                     city= city,
                     timestamp=timestamp
-                )
-            track_data.append(tracks)
-           
-            # Collect feature for GeoJSON file
-            feature = create_feature(track, id, timestamp)
-            if feature:
-                feature_collection['features'].append(feature)
-
-        await asyncio.gather(*(fetch_measurements(entry) for entry in id_list))
-        print('Measurement fetch complete.')
-        
-        # Bulk create Box and Sensor instances asynchronously
-        if boxes:
-            await sync_to_async(BoxTable.objects.bulk_create)(
-                [obj for obj in boxes if isinstance(obj, BoxTable)],
-                ignore_conflicts=True
-            )
+                ))
 
-        if sensors:
-            await sync_to_async(SensorTable.objects.bulk_create)(
-                [obj for obj in sensors if isinstance(obj, SensorTable)],
-                ignore_conflicts=True
-            )
-
-        # Bulk create SensorData instances asynchronously
-        if sensordatas:
-            await sync_to_async(SensorDataTable.objects.bulk_create)(
-                sensordatas,
-                ignore_conflicts=True
-            )
-
-        # Bulk create LocationData instances asynchronously
-        if track_data:
-            await sync_to_async(TracksTable.objects.bulk_create)(
-                track_data,
-                ignore_conflicts=True
-            )
-        # Allow DB to "cool down" before further operations
-        # await asyncio.sleep(10)
-        # connection.close()
+        # A failing box is logged and skipped instead of aborting the whole city
+        results = await asyncio.gather(*(fetch_measurements(entry) for entry in id_list), return_exceptions=True)
+        for entry, result in zip(id_list, results):
+            if isinstance(result, Exception):
+                print(f"Failed to process box ID {entry['id']}: {result!r}")
+        print('Measurement fetch complete.')
 
-    # # Write feature collection to GeoJSON file
-    # with open(tracks_path, 'w') as geojson_file:
-    #     json.dump(feature_collection, geojson_file, indent=2)
+    print(f"Rows written: {writer.written}")
+    peak_mb = process_peak_memory_mb()
+    print(f"Process peak memory (max RSS since start) after fetching {city}: {peak_mb:.1f} MB")
 
-    return {"status": "Data collection successfull check the admin page for the data"}
+    return {"status": "Data collection successfull check the admin page for the data", "process_peak_memory_mb": round(peak_mb, 1)}
@@ -1,8 +1,19 @@
 from django.shortcuts import render, HttpResponse
 from django.http import JsonResponse
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from .utils import fetch_and_store_data
-from sensebox.models import BoxTable, SensorTable, SensorDataTable, TracksTable
+from .routing import get_router_pool, RoutingError
+from .score_store import (DETAILS, bikeability_geojson, data_version, detail_for_zoom, normalized_path,
+                          stored_normalized_path, write_data_version, write_detail_levels)
+from .storage import DatasetWriter, dataset_exists, read_dataset, write_dataset
+from .sensor_data import load_sensor_files
+from .tracks import parse_timestamps, split_track_by_day, track_segments
+from .track_store import (TrackStoreWriter, load_track_index, read_track_segments, read_track_source,
+                          write_track_scores)
+from .tiles import bikeability_tile, valid_tile
+from .response_cache import TILE_CACHE, cached_response, normalize_weights, response_etag
+from sensebox.models import BoxTable, SensorTable, SensorDataTable, TracksTable, MeasurementTable
 import json
 import asyncio
 from datetime import datetime, timedelta
@@ -11,14 +22,15 @@ import os
 import geopandas as gpd
 import pandas as pd
 import plotly.express as px
+import shapely
 from shapely.geometry import Point, LineString
 from shapely.ops import nearest_points
 from shapely.strtree import STRtree
 import multiprocessing as mp
 import numpy as np
 import subprocess
-import urllib.request
 import time
+from itertools import islice
 
 def homepage(request):
     return render(request, 'homepage.html')  # Render an HTML template
@@ -35,7 +47,10 @@ def preprocessing_sensors_view(request, city):
 
 def bikeability_trackwise_view(request, city):
     if request.method == 'GET':
-        response_data =  bikeability_trackwise(city)
+        try:
+            response_data =  bikeability_trackwise(city)
+        except ValueError as err:
+            response_data = JsonResponse({"status": str(err)})
     return response_data
 
 
@@ -44,7 +59,8 @@ def bikeability_trackwise_view(request, city):
 def fetch_bike_data(request, city):
     if request.method == 'GET':
         try:
-            response_data = asyncio.run(fetch_and_store_data(city))
+            full_refresh = request.GET.get('full_refresh', '').lower() in ('1', 'true', 'yes')
+            response_data = asyncio.run(fetch_and_store_data(city, full_refresh=full_refresh))
             return JsonResponse(response_data, safe=False, json_dumps_params={'indent': 4})
         except ValueError as err:
             return HttpResponse(str(err), status=400)
@@ -75,125 +91,121 @@ def create_feature(track_data, box_id):
     except (KeyError, ValueError, TypeError):
         return None
 
+
 def split_linestring_by_day(features,id):
-    # Prepare a collection for the split features
-    # split_features = []
-    
-    # for feature in features:
+    """Splits a track Feature into daily LineString Features (see track_segments)."""
     coordinates = features["geometry"]["coordinates"]
     timestamps = features["properties"]["timestamps"]
-    
-    # Define the time gap threshold
-    time_gap_threshold = timedelta(minutes=5)  # Example: 1 hour
-
-    # Initialize grouping variables
-    daily_segments = defaultdict(list)
-    current_segment = {"coordinates": [], "timestamps": []}
-    last_time = None
-
-    # Process each coordinate and timestamp
-    for coord, timestamp in zip(coordinates, timestamps):
-        current_time = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-        if last_time is None:
-            last_time = current_time
-
-        # Check for time gap or date change
-        if (
-            current_time.date() != last_time.date()
-            or current_time - last_time > time_gap_threshold
-        ):
-            # Save the current segment
-            if len(current_segment["coordinates"]) > 2:
-                daily_segments[last_time.date()].append(current_segment)
-                current_segment = {"coordinates": [], "timestamps": []}
-
-        # Add the current point to the segment
-        current_segment["coordinates"].append(coord)
-        current_segment["timestamps"].append(timestamp)
-
-        # Update the last_time
-        last_time = current_time
-    
-    # Save the last segment
-    if len(current_segment["coordinates"]) > 2:
-        daily_segments[last_time.date()].append(current_segment)
+    count = min(len(coordinates), len(timestamps))
+    starts, ends, dates = track_segments(timestamps[:count])
 
     feature_collection = {
         "type": "FeatureCollection",
         "features": []
     }
-    for date, segments in daily_segments.items():
-        for segment in segments:
-            feature = {
-                "type": "Feature",
-                "geometry": {
-                    "type": "LineString",
-                    "coordinates": segment["coordinates"]
-                },
-                "properties": {
-                    "timestamps": segment["timestamps"],
-                    "date": str(date),
-                    "box_id": id
-                }
+    for start, end, date in zip(starts.tolist(), ends.tolist(), dates.astype(str)):
+        feature = {
+            "type": "Feature",
+            "geometry": {
+                "type": "LineString",
+                "coordinates": coordinates[start:end]
+            },
+            "properties": {
+                "timestamps": timestamps[start:end],
+                "date": str(date),
+                "box_id": id
             }
-            feature_collection["features"].append(feature)
+        }
+        feature_collection["features"].append(feature)
 
-    
     # Create a new FeatureCollection
     return feature_collection
 
 
-def preprocessing_tracks(city):
-    # if request.method == 'GET': 
-    data = TracksTable.objects.filter(city = city)
-    count = data.count()
-    print(f"Number of tracks for {city}: {count}")
-    
-    # Create a single FeatureCollection with features grouped by day
-    feature_collection = {
-        "type": "FeatureCollection",
-        "name": "Processed_feature_collection",
-        "features": []
-    }
+# Track rows (each the whole history of one box) read from the database per chunk in preprocessing_tracks
+TRACK_CHUNK_SIZE = 50
+
 
-    for items in data:
-        track = items.tracks
-        id =  items.box
-        feature = split_linestring_by_day(track,id.box_id)
+def write_processed_tracks(city, path):
+    """Writes the segments in the track store as the Processed_tracks dataset, a day at a time.
 
-        # Add each feature to the main feature collection
-        feature_collection["features"].extend(feature['features'])
+    One row per segment with its box_id, date ("YYYY-MM-DD") and timestamps (a list of UTC times
+    ending in Z, with milliseconds), in the order of the store: by date, then as fetched.
+    """
+    dates = np.unique(load_track_index(city).keys["date"].to_numpy())
+    with DatasetWriter(path) as writer:
+        for date in dates:
+            day = read_track_segments(city, dates=[date], timestamps=True)
+            day["timestamps"] = [list(np.char.add(np.datetime_as_string(t, unit="ms"), "Z")) for t in day["timestamps"]]
+            day["date"] = day["date"].dt.strftime("%Y-%m-%d")
+            writer.write(day[["geometry", "timestamps", "date", "box_id"]])
 
+def preprocessing_tracks(city):
+    # if request.method == 'GET': 
     # Define box_ids to remove based on the city
     if city == "ms":
         ids_to_remove = {"65451cd043923100076b517c","67828c858e3d6100086a9aa1", "657b28637db43500079d749d", "66aca2c7f5b1680007e89843", "661d00531a903a0008052b78", "67226c2549d0900007c78c78"}
     elif city == "os":
         ids_to_remove = {"67529ed438b76600076d6f18"}
 
-    # Convert the feature collection into a GeoDataFrame
-    gdf = gpd.GeoDataFrame.from_features(feature_collection["features"])
-
-    # Ensure 'box_id' exists before filtering
-    if "box_id" in gdf.columns:
-        filtered_gdf = gdf[~gdf["box_id"].isin(ids_to_remove)]
-    else:
-        raise ValueError("box_id column not found in GeoJSON data.")
+    data = TracksTable.objects.filter(city = city).exclude(box_id__in=ids_to_remove).order_by("id")
+    count = data.count()
+    print(f"Number of tracks for {city}: {count}")
      
-    base_path = '/app/tracks/tracks' if os.path.exists('/app') else './tracks/tracks'
-    # Create the directory if it doesn't exist
-    os.makedirs(base_path, exist_ok=True)
-
-    tracks_path = os.path.join(base_path, f'Processed_tracks_{city}.geojson')
-
     # with open(tracks_path, 'w') as geojson_file:
     #     json.dump(feature_collection, geojson_file, indent=2)
 
-    filtered_gdf.to_file(tracks_path, driver="GeoJSON")
+    # Every fetch adds new track rows (ids only grow), so while all rows the track store was built
+    # from are still there, only the newer rows are split and appended to the store. Otherwise
+    # (after a full refresh, say) the store is rebuilt from all rows
+    source = read_track_source(city)
+    append = (source is not None and source.get("excluded") == sorted(ids_to_remove)
+              and data.filter(id__lte=source["last_id"]).count() == source["rows"])
+    if append:
+        data = data.filter(id__gt=source["last_id"])
+    source = {"excluded": sorted(ids_to_remove), "last_id": source["last_id"] if append else 0,
+              "rows": source["rows"] if append else 0}
+
+    # Daily segments of a chunk of tracks at a time, added to the track store as they are split
+    rows = data.values_list("id", "box_id", "tracks").iterator(chunk_size=TRACK_CHUNK_SIZE)
+    new_rows = 0
+    with TrackStoreWriter(city, append=append, source=source) as store:
+        while chunk := list(islice(rows, TRACK_CHUNK_SIZE)):
+            columns = {"geometry": [], "timestamps": [], "date": [], "box_id": []}
+            for row_id, box_id, tracks in chunk:
+                for name, values in split_track_by_day(tracks, box_id).items():
+                    columns[name].extend(values)
+            store.add(columns)
+            source["last_id"] = chunk[-1][0]
+            source["rows"] += len(chunk)
+            new_rows += len(chunk)
+
+        # Without any segments there is nothing to rebuild from; the previous store is kept
+        if store.segments == 0 and not append:
+            raise ValueError(f"No tracks for {city}")
+    if append:
+        print(f"Appended {store.segments} segments of {new_rows} new track rows to the track store, "
+              f"{len(store.rewritten)} days rewritten")
+    else:
+        print(f"Track store rebuilt, {len(store.rewritten)} days rewritten")
+
+    if getattr(settings, "TRACK_EXPORTS", True):
+        base_path = '/app/tracks/tracks' if os.path.exists('/app') else './tracks/tracks'
+        tracks_path = os.path.join(base_path, f'Processed_tracks_{city}.geojson')
+        if store.changed or not dataset_exists(tracks_path):
+            write_processed_tracks(city, tracks_path)
     print ("Data processed successfully. Check the tracks folder for the processed data.")
     return JsonResponse({"status": "Data processed successfully. Check the tracks folder for the processed data."})
 
 
-def preprocessing_sensors():
+# Measurement rows read from the database per chunk in preprocessing_sensors
+SENSOR_CHUNK_SIZE = 50000
+
+def preprocessing_sensors(city=None):
+    """Writes the measurements of each city and sensor type to tracks/sensor_data/<city>_<sensor>.
+
+    ``city`` is a city code or a list of them; by default every city is processed in one scan.
+    """
     SENSOR_TITLE_MAPPING = {
         "PM1": "Finedust PM1",
         "PM10": "Finedust PM10",
@@ -217,93 +229,64 @@ def preprocessing_sensors():
         "os": {"W": 7.85, "S": 52.19, "E": 8.17, "N": 52.37},
     }
     
+    if city is None:
+        cities = list(BBOX)
+    else:
+        cities = [city] if isinstance(city, str) else list(city)
+        unknown = [c for c in cities if c not in BBOX]
+        if unknown:
+            raise ValueError(f"Unknown cities: {', '.join(unknown)}")
+    
     base_path = '/app/tracks/sensor_data' if os.path.exists('/app') else './tracks/sensor_data'
     os.makedirs(base_path, exist_ok=True)
 
-    # Prepare containers: {city: {sensor_title: FeatureCollection}}
-    collections = {city: {} for city in BBOX.keys()}
-    seen_features = {city: set() for city in BBOX.keys()}
-
-    # Process all mapped sensor titles
-    for sensor_title in set(SENSOR_TITLE_MAPPING.values()):
-        mapped_titles = [t for t, mapped in SENSOR_TITLE_MAPPING.items() if mapped == sensor_title]
-        sensor_data = SensorDataTable.objects.filter(sensor_title__in=mapped_titles)
-
-        print(f"Processing '{sensor_title}', total records: {sensor_data.count()}")
-
-        for items in sensor_data:
-            value = items.value
-            s_id = items.sensor_id
-            box = items.box_id
-
-            if not value:
-                continue
-
-            for entry in value:
-                lon, lat = entry["location"]
-                timestamp = entry["createdAt"]
-                raw_value = float(entry["value"])
-
-                # Detect the original sensor title
-                original_title = items.sensor_title
-
-                # Convert Geschwindigkeit km/h → m/s
-                if original_title == "Geschwindigkeit":
-                    feature_value = raw_value / 3.6
-                else:
-                    feature_value = raw_value
-
-                # Assign city by bounding box
-                city_detected = None
-                for city, bbox in BBOX.items():
-                    if bbox["W"] <= lon <= bbox["E"] and bbox["S"] <= lat <= bbox["N"]:
-                        city_detected = city
-                        break
-
-                if not city_detected:
-                    continue  # skip points outside both cities
-
-                feature_id = (lon, lat, feature_value, timestamp, s_id.sensor_id, box.box_id)
-                if feature_id in seen_features[city_detected]:
-                    continue
-
-                feature = {
-                    "type": "Feature",
-                    "geometry": {"type": "Point", "coordinates": (lon, lat)},
-                    "properties": {
-                        "value": feature_value,
-                        "timestamp": timestamp,
-                        "sensor_id": s_id.sensor_id,
-                        "box_id": box.box_id,
-                    },
-                }
-
-                # Initialize per-sensor collections if missing
-                if sensor_title not in collections[city_detected]:
-                    collections[city_detected][sensor_title] = {
-                        "type": "FeatureCollection",
-                        "features": [],
-                    }
-
-                collections[city_detected][sensor_title]["features"].append(feature)
-                seen_features[city_detected].add(feature_id)
+    # Only the measurements fetched for the requested cities (measurement_city_title_idx), the same
+    # rows the pipeline fingerprints to decide whether this stage has to run again
+    columns = ["lon", "lat", "timestamp", "value", "sensor_title", "sensor_id", "box_id", "city"]
+    rows = MeasurementTable.objects.filter(
+        city__in=cities, sensor_title__in=list(SENSOR_TITLE_MAPPING), lon__isnull=False, lat__isnull=False
+    ).values_list(*columns).iterator(chunk_size=SENSOR_CHUNK_SIZE)
+
+    chunks = []
+    while True:
+        chunk = pd.DataFrame.from_records(list(islice(rows, SENSOR_CHUNK_SIZE)), columns=columns)
+        if chunk.empty:
+            break
+        lon, lat = chunk["lon"].to_numpy(dtype=float), chunk["lat"].to_numpy(dtype=float)
+
+        # Skip points outside the bounding box of their city
+        inside = np.zeros(len(chunk), dtype=bool)
+        for name in cities:
+            bbox = BBOX[name]
+            inside |= ((chunk["city"] == name).to_numpy() & (bbox["W"] <= lon) & (lon <= bbox["E"])
+                       & (bbox["S"] <= lat) & (lat <= bbox["N"]))
+        chunks.append(chunk[inside])
+
+    data = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+    print(f"Processing sensor data, total records: {len(data)}")
+
+    # Convert Geschwindigkeit km/h → m/s
+    data["value"] = np.where(data["sensor_title"] == "Geschwindigkeit", data["value"] / 3.6, data["value"])
+    data["sensor_title"] = data["sensor_title"].map(SENSOR_TITLE_MAPPING)
+    # Same format as the openSenseMap createdAt strings
+    data["timestamp"] = pd.to_datetime(data["timestamp"], utc=True).dt.strftime("%Y-%m-%dT%H:%M:%S.%f").str[:-3] + "Z"
+
+    data = data.drop_duplicates(subset=["city", "lon", "lat", "value", "timestamp", "sensor_id", "box_id"])
 
     # Save files per city & sensor
-    for city, sensors in collections.items():
-        for sensor_title, feature_collection in sensors.items():
-            if not feature_collection["features"]:
-                print(f"No valid data for '{sensor_title}' in '{city}'. Skipping.")
-                continue
-
-            gdf = gpd.GeoDataFrame.from_features(feature_collection["features"])
-            gdf = gdf[gdf.is_valid & ~gdf.geometry.is_empty].dropna(subset=["geometry"])
+    for (name, sensor_title), group in data.groupby(["city", "sensor_title"], sort=False):
+        gdf = gpd.GeoDataFrame(
+            group[["value", "timestamp", "sensor_id", "box_id"]].reset_index(drop=True),
+            geometry=gpd.points_from_xy(group["lon"], group["lat"]),
+            crs="EPSG:4326",
+        )
 
-            safe_sensor_title = sensor_title.replace(" ", "_").replace(".", "_").replace("/", "_")
-            geojson_filename = f"{city}_{safe_sensor_title}.geojson"
-            tracks_path = os.path.join(base_path, geojson_filename)
+        safe_sensor_title = sensor_title.replace(" ", "_").replace(".", "_").replace("/", "_")
+        geojson_filename = f"{name}_{safe_sensor_title}.geojson"
+        tracks_path = os.path.join(base_path, geojson_filename)
 
-            gdf.to_file(tracks_path, driver="GeoJSON")
-            print(f"Saved {tracks_path} with {len(gdf)} features")
+        write_dataset(gdf, tracks_path)
+        print(f"Saved {tracks_path} with {len(gdf)} features")
 
     print("Sensor data processed successfully. Check the sensor_data folder.")
     return JsonResponse({"status": "Sensor data processed successfully. Check the sensor_data folder."})
@@ -364,40 +347,51 @@ city_data = {
     }
 }
 
+def normalize_per_group(values, groups):
+    """Min-max normalizes ``values`` within each group of ``groups`` (a SeriesGroupBy over them).
+
+    Values of single-row groups are kept as they are; rows without a group become NaN.
+    """
+    low, high, size = groups.transform("min"), groups.transform("max"), groups.transform("size")
+    normalized = (values - low) / (high - low)
+    return normalized.mask(size == 1, values)
+
+
 def bikeability_trackwise(city):
     # if request.method != 'GET':
     #     return {"status": "Invalid request method"}
     
-    # Get city-specific sensor data, weights, and route file
+    # Get city-specific sensor data, weights, and route file.
+    # Errors are raised, so a pipeline run does not record the stage as done
     city_info = city_data.get(city)
     if not city_info:
-        return {"status": f"City '{city}' not found in dataset"}
+        raise ValueError(f"City '{city}' not found in dataset")
 
     sensor_files = city_info["sensor_files"]
     weights = city_info["weights"]
-    routes_file = city_info["routes_file"]
 
-    # Initialize an empty DataFrame to store normalized values for each pollutant
-    normalized_sensor_data = pd.DataFrame()
+    # Weighted normalized values of each pollutant, concatenated once all files are read
+    frames = []
+
+    # Read all sensor files at once (shared with the street snapping within a pipeline run)
+    sensor_frames = load_sensor_files(sensor_files, geometry=False)
 
     # Process each sensor file
     for file in sensor_files:
-        try:
-            data = gpd.read_file(file)
-        except Exception as e:
-            return  JsonResponse({"status": f"Error reading {file}: {e}"})
+        data = sensor_frames[file]
+        if isinstance(data, Exception):
+            raise ValueError(f"Error reading {file}: {data}") from data
+        data = pd.DataFrame(data[["value", "timestamp", "box_id"]])
 
-        # Extract date from timestamp
-        data["date"] = pd.to_datetime(data["timestamp"]).dt.date
-        data["month"] = pd.to_datetime(data["timestamp"]).dt.month
+        # Extract the day from the timestamp, kept as datetime64 for fast grouping
+        wall, _ = parse_timestamps(data["timestamp"].to_numpy())
+        data["date"] = wall.astype("datetime64[D]")
 
         # Filter for October, November, and December
         # data = data[data["month"].isin([10, 11, 12])]
         
         # Normalize the 'value' column within each date and box_id group
-        data["value_normalized"] = data.groupby(["box_id", "date"])["value"].transform(
-            lambda x: (x - x.min()) / (x.max() - x.min()) if len(x) > 1 else x
-        )
+        data["value_normalized"] = normalize_per_group(data["value"], data.groupby(["box_id", "date"])["value"])
 
         # Extract pollutant name from filename
         pollutant_name = file.split("/")[-1].replace(".geojson", "")
@@ -406,10 +400,11 @@ def bikeability_trackwise(city):
         if pollutant_name in weights:
             data["weighted_value"] = data["value_normalized"] * weights[pollutant_name]
         else:
-            return JsonResponse ({"status": f"Weight not found for {pollutant_name}"})
+            raise ValueError(f"Weight not found for {pollutant_name}")
+
+        frames.append(data[["box_id", "date", "weighted_value"]])
 
-        # Append to the normalized_sensor_data DataFrame
-        normalized_sensor_data = pd.concat([normalized_sensor_data, data], ignore_index=True)
+    normalized_sensor_data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["box_id", "date", "weighted_value"])
     
     # Group sensor data by box_id and date to aggregate weighted values
     aggregated_data = normalized_sensor_data.groupby(["box_id", "date"]).agg({
@@ -425,41 +420,40 @@ def bikeability_trackwise(city):
     aggregated_data["factor_score"] = normalize(aggregated_data["weighted_value"])
     
     # Load the routes GeoJSON file
+    # Load the (box_id, date) keys of the track segments from the track store
     try:
-        routes = gpd.read_file(routes_file)
+        keys = load_track_index(city).keys[["box_id", "date"]]
     except Exception as e:
-        return JsonResponse ({"status": f"Error reading routes file: {e}"})
-
-    # Convert route timestamps to datetime and extract date
-    routes["date"] = pd.to_datetime(routes["date"]).dt.date
-    routes["month"] = pd.to_datetime(routes["date"]).dt.month
+        raise ValueError(f"Error reading the track store: {e}") from e
 
     # Filter routes data for October, November, and December
-    # routes = routes[routes["month"].isin([10, 11, 12])]
+    # keys = keys[keys["date"].dt.month.isin([10, 11, 12])]
 
-    # Merge the bikeability factor score with routes based on box_id and date
-    routes = routes.merge(
+    # Merge the bikeability factor score with the routes' keys; the segments themselves are not rewritten
+    scores = keys.merge(
         aggregated_data,
         on=["box_id", "date"],
         how="left"
     )
     # Assign a unique number to each box_id
-    box_id_mapping = {box: idx + 1 for idx, box in enumerate(routes["box_id"].unique())}
-    routes["box_id_number"] = routes["box_id"].map(box_id_mapping)
-    
-    base_path = '/app/tracks/BI/' if os.path.exists('/app') else './tracks/BI/'
-    os.makedirs(base_path, exist_ok=True)
-    # Save updated routes to a new GeoJSON file
-    output_file = f"routes_with_bikeability_{city}.geojson"
-    output_path = os.path.join(base_path, output_file)
+    box_id_mapping = {box: idx + 1 for idx, box in enumerate(scores["box_id"].unique())}
+    scores["box_id_number"] = scores["box_id"].map(box_id_mapping)
+    scores_path = write_track_scores(city, scores)
 
-    routes.to_file(output_path, driver="GeoJSON")
-    
-    routes["date"] = routes["date"].astype(str)
+    # The routes with their scores as GeoJSON (routes_with_bikeability_<city>.geojson); the pipeline
+    # reads the scores from the track store, so this can be switched off with TRACK_EXPORTS
+    if getattr(settings, "TRACK_EXPORTS", True):
+        routes = read_track_segments(city).merge(scores, on=["box_id", "date"], how="left")
+        routes["month"] = routes["date"].dt.month
+        routes["date"] = routes["date"].dt.strftime("%Y-%m-%d")
+
+        base_path = '/app/tracks/BI/' if os.path.exists('/app') else './tracks/BI/'
+        os.makedirs(base_path, exist_ok=True)
+        routes.to_file(os.path.join(base_path, f"routes_with_bikeability_{city}.geojson"), driver="GeoJSON")
 
     # return JsonResponse (routes_json_dict, safe=False)
-    print(f"BI Analysis successful, check for {output_file} in the BI folder in tracks directory")
-    return JsonResponse ({"status": f"BI Analysis successful, check for {output_file} in the BI folder in tracks directory"})
+    print(f"BI Analysis successful, check for {scores_path} in the tracks directory")
+    return JsonResponse ({"status": f"BI Analysis successful, check for {scores_path} in the tracks directory"})
 
 
 def expand_weights(category_weights):
@@ -519,17 +513,60 @@ def osm_segements_bikeability_index_view(request, city):
             # weights = expand_weights(weights)
             # print(weights)
             
-            # Calculate bikeability index using the provided or default weights
-            response_data = calculate_bikeability(city, weights)
         except json.JSONDecodeError:
             return JsonResponse({"error": "Invalid JSON in request body"}, status=400)
     else:  # For GET requests, use default weights
-        weight = default_weights
+        weights = default_weights
         # weights = expand_weights(weight)
-        response_data = calculate_bikeability(city, weights)
-    
-    # Return the final response
-    return response_data
+
+    # Geometry detail, either by name (?detail=medium) or for a map zoom level (?zoom=12)
+    detail = request.GET.get("detail")
+    if detail is None and "zoom" in request.GET:
+        try:
+            detail = detail_for_zoom(float(request.GET["zoom"]))
+        except ValueError:
+            return JsonResponse({"error": "zoom must be a number"}, status=400)
+    detail = detail or "full"
+    if detail not in DETAILS:
+        return JsonResponse({"error": f"detail must be one of {', '.join(DETAILS)}"}, status=400)
+
+    # Calculate bikeability index using the provided or default weights. Responses are cached per
+    # (city, weights, detail, data version); clients holding the current ETag get a 304.
+    try:
+        key_weights = normalize_weights(weights)
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({"error": "Weights for safety, infrastructure_quality and environment_quality are required"}, status=400)
+    if not dataset_exists(normalized_path(city)):
+        return JsonResponse({"error": f"No bikeability data for {city}"}, status=404)
+    version = data_version(city)
+    etag = response_etag("bikeability", city, key_weights, detail, version)
+    cache_key = f"bikeability:{city}:{version}:{etag[3:-1]}"
+    return cached_response(request, cache_key, etag, lambda: bikeability_geojson(city, dict(key_weights), detail))
+
+
+def bikeability_tile_view(request, city, z, x, y):
+    """Mapbox vector tile of the street segments with their bikeability index.
+
+    Weights are taken from the query string (?safety=0.4&infrastructure_quality=0.5&environment_quality=0.1)
+    and default to the same profile as the bikeability index view.
+    """
+    if not valid_tile(z, x, y):
+        return JsonResponse({"error": "Invalid tile coordinates"}, status=400)
+    if not dataset_exists(normalized_path(city)):
+        return JsonResponse({"error": f"No bikeability data for {city}"}, status=404)
+
+    weights = {"safety": 0.4, "infrastructure_quality": 0.5, "environment_quality": 0.1}
+    weights.update({name: value for name, value in request.GET.items() if name in weights})
+    try:
+        key_weights = normalize_weights(weights)
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "Weights must be numbers"}, status=400)
+
+    version = data_version(city)
+    etag = response_etag("tile", city, key_weights, version, z, x, y)
+    cache_key = f"tile:{city}:{version}:{etag[3:-1]}"
+    return cached_response(request, cache_key, etag, lambda: bikeability_tile(city, z, x, y, dict(key_weights)),
+                           content_type="application/vnd.mapbox-vector-tile", cache_alias=TILE_CACHE)
 
 
 def normalize(series, invert=False):
@@ -597,9 +634,9 @@ def merge_cqi(city, id_column='id', columns_to_add=None, column_rename_map=None,
     if column_rename_map is None:
         column_rename_map = {'index': f'avg_{city}_cqi_index'}
     
-    # Load both files
-    gdf_index = gpd.read_file(f"./tracks/{city}_cycling_quality_index.geojson")
-    gdf_sensor = gpd.read_file(f"./tracks/BI/osm_streets_{city}_winter.geojson")
+    # Load both files; only the merged columns of the index are needed
+    gdf_index = read_dataset(f"./tracks/{city}_cycling_quality_index.geojson", geometry=False)
+    gdf_sensor = read_dataset(f"./tracks/BI/osm_streets_{city}_winter.geojson")
 
     # Ensure ID columns are string for comparison
     gdf_index[id_column] = gdf_index[id_column].astype(str)
@@ -616,7 +653,7 @@ def merge_cqi(city, id_column='id', columns_to_add=None, column_rename_map=None,
     merged = gdf_sensor.merge(index_subset, on=id_column, how='left')
    
     # Save merged result
-    merged.to_file(f"./tracks/BI/osm_streets_{city}.geojson", driver='GeoJSON')
+    write_dataset(merged, f"./tracks/BI/osm_streets_{city}.geojson")
 
 
 # def calculate_bikeability(city,  weights=None):
@@ -721,7 +758,7 @@ def merge_cqi(city, id_column='id', columns_to_add=None, column_rename_map=None,
 
 def precompute_normalized_data(city):
     process_file = f"./tracks/BI/osm_streets_{city}.geojson"
-    streets = gpd.read_file(process_file)
+    streets = read_dataset(process_file)
 
     # Clean missing sensor values
     for col in streets.columns:
@@ -758,86 +795,94 @@ def precompute_normalized_data(city):
     keep_cols = [c for c in streets.columns if c.endswith("_score")] + ["id", "geometry"]
     streets = streets[keep_cols]
 
-    # Save as Parquet (much faster than GeoJSON)
-    output_path = f"./tracks/BI/osm_normalized_{city}.geojson"
-    streets.to_file(output_path, index=False)
-    print(f"Normalized data saved: {output_path}")
+    # Save in the columnar format of the storage layer (much faster than GeoJSON)
+    output_path = write_dataset(streets, normalized_path(city))
+    # Simplified copies for overview maps, selected with ?detail= / ?zoom= on the index endpoint
+    write_detail_levels(streets, city)
+    # A new data version invalidates cached bikeability responses and routing profiles
+    version = write_data_version(city)
+    print(f"Normalized data saved: {output_path} (version {version})")
 
 def calculate_bikeability(city, weights):
-    start_time = time.time()
-    # weights = {k.lower(): v for k, v in weights.items()}
-    path = f"./tracks/BI/osm_normalized_{city}.geojson"
-    streets = gpd.read_file(path)
-    # print(weights)
-    
-    # Compute weighted sum directly
-    # bikeability_sum = np.zeros(len(streets))
-    # for sensor, weight in weights.items():
-    #     col = f"{sensor}_normalized"
-    #     if col in streets:
-    #         bikeability_sum += streets[col].fillna(0) * weight
-
-    # streets["bikeability_index"] = bikeability_sum
-
-    streets["bikeability_index"] = (
-        streets["safety_score"] * weights["safety"] +
-        streets["infrastructure_score"] * weights["infrastructure_quality"] +
-        streets["environment_score"] * weights["environment_quality"]
-    )
- 
-    # Keep minimal columns
-    output = streets[["id", "bikeability_index", "geometry"]].to_crs(epsg=4326)
-
-    geojson_str = output.to_json()
-    geojson_dict = json.loads(geojson_str)
-
-    # base_path = '/app/tracks/BI/' if os.path.exists('/app') else './tracks/BI/'
-    # os.makedirs(base_path, exist_ok=True)
-    # # Save updated routes to a new GeoJSON file
-    # output_file = f"osm_BI_{city}.geojson"
-    # output_path = os.path.join(base_path, output_file)
-    # if os.path.exists(output_path):
-    #     os.remove(output_path)
-    # output.to_file(output_path, driver="GeoJSON")
-    
-    # elapsed = time.time() - start_time
-    # print(f"calculate_bikeability took {elapsed:.2f} seconds")
-
-    return JsonResponse(geojson_dict, safe=False)
+    # The street scores and their EPSG:4326 features are loaded once per process (and reloaded when
+    # precompute_normalized_data rewrites them); per request only the weighted sum is computed and
+    # spliced into the pre-serialized features.
+    geojson_bytes = bikeability_geojson(city, weights)
+    return HttpResponse(geojson_bytes, content_type="application/json")
 
 # This method creates a traffic.csv file in the work folder of the routing engine to customize it
 # based on bikeability weights.
-def calculate_traffic(city, weights):
-    path = f"./tracks/BI/osm_normalized_{city}.geojson"
-    streets = gpd.read_file(path)
-
-    # Calculate bikeability score for each street segment
-    streets["bikeability_index"] = (
-        streets["safety_score"] * weights["safety"] +
-        streets["infrastructure_score"] * weights["infrastructure_quality"] +
-        streets["environment_score"] * weights["environment_quality"]
-    )
-    
-    # We have to rename and adapt the column containing the way id to match the data we have in ways.csv and cast
-    # way_id column to integer to merge against integer id column in ways csv
-    streets["way_id"]= streets["id"].str.replace('way/', '')
-    streets["way_id"]= streets["way_id"].astype(int)
-    
-    # Drop duplicate street segments (there should be only one bikeability score per street segment)
-    streets = streets.drop_duplicates(subset=['way_id'])
-    
-    # Read "ways.csv", a file that matches each way with start and end nodes, as this is the information the routing
-    # engine requires. Then merge the data with the bikeability index, so that we have a list of [start_node_id, end_node_id, bikeability_index]
-    ways_df = pd.read_csv('./sensebox/osrm/ways.csv')
-    merged_df = ways_df.merge(streets, on='way_id')
+# ways.csv matches each OSM way with its start and end nodes, as this is the information the routing engine requires
+OSRM_WAYS_PATH = './sensebox/osrm/ways.csv'
+TRAFFIC_SCORE_COLUMNS = ["safety_score", "infrastructure_score", "environment_score"]
+TRAFFIC_WEIGHT_NAMES = ["safety", "infrastructure_quality", "environment_quality"]
+
+# {city: (source mtimes, edge table)}, kept for the lifetime of the process
+_traffic_tables = {}
+
+def load_traffic_table(city):
+    """Edges of ways.csv joined with the category scores of their street, as aligned arrays.
 
-    # Adapt the speed of edges to the bikeability index (0..100) by multiplying it with 25.
+    Returns a dict with ``way_id``, ``first_node_id``, ``second_node_id``, ``scores`` (one row per edge,
+    one column per TRAFFIC_SCORE_COLUMNS entry) and ``prefix`` (the "first_node_id,second_node_id," text
+    of each edge). The table is built once and rebuilt only when one of the source files changes.
+    """
+    path = stored_normalized_path(city)
+    key = (path, os.path.getmtime(path), os.path.getmtime(OSRM_WAYS_PATH))
+    cached = _traffic_tables.get(city)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    streets = read_dataset(path, columns=["id"] + TRAFFIC_SCORE_COLUMNS, geometry=False)
+
+    # The way id is the numeric part of the OSM id ("way/123"); there should be only one score per way
+    streets = streets[streets["id"].str.startswith("way/")]
+    streets = streets.assign(way_id=streets["id"].str.slice(4).astype(np.int64)).drop_duplicates(subset=["way_id"])
+
+    ways_df = pd.read_csv(OSRM_WAYS_PATH, usecols=["way_id", "first_node_id", "second_node_id"], dtype=np.int64)
+    edges = ways_df.merge(streets[["way_id"] + TRAFFIC_SCORE_COLUMNS], on="way_id")
+
+    first = edges["first_node_id"].to_numpy()
+    second = edges["second_node_id"].to_numpy()
+    table = {
+        "way_id": edges["way_id"].to_numpy(),
+        "first_node_id": first,
+        "second_node_id": second,
+        "scores": edges[TRAFFIC_SCORE_COLUMNS].to_numpy(dtype=np.float64),
+        "prefix": np.strings.add(np.strings.add(first.astype("S"), b","), np.strings.add(second.astype("S"), b",")),
+    }
+    _traffic_tables[city] = (key, table)
+    return table
+
+def write_segment_speeds(output_filename, prefix, speed):
+    """Writes "first_node_id,second_node_id,speed" lines; speeds are rounded to 1/1000 km/h."""
+    lines = np.strings.add(prefix, np.round(speed, 3).astype("S"))
+    with open(output_filename, "wb") as f:
+        if len(lines):
+            f.write(b"\n".join(lines.tolist()))
+            f.write(b"\n")
+
+def calculate_traffic(city, weights, output_filename='./sensebox/osrm/work/traffic.csv'):
+    table = load_traffic_table(city)
+
+    # Bikeability score of each edge's street segment as one dot product with the weight vector
+    weight_vector = np.array([weights[name] for name in TRAFFIC_WEIGHT_NAMES], dtype=np.float64)
+    bikeability_index = table["scores"] @ weight_vector
+
+    # Adapt the speed of edges to the bikeability index (0..100) by multiplying it with 0.25.
     # For a street segment with bikeability 80 this returns a speed of 20km/h.
-    merged_df["speed"] = merged_df["bikeability_index"]*0.25
+    speed = bikeability_index * 0.25
 
-    # Save the traffic.csv file
-    output_filename = './sensebox/osrm/work/traffic.csv'
-    output = merged_df[["first_node_id", "second_node_id", "speed"]].to_csv(output_filename, index=False, header=False)
+    # Edges without a score would be written without a speed, which OSRM cannot parse
+    valid = ~np.isnan(speed)
+    write_segment_speeds(output_filename, table["prefix"][valid], speed[valid])
+
+def routing_data_version():
+    """Version of the street scores routes are customized from."""
+    return data_version('ms')
+
+def routing_pool():
+    return get_router_pool(lambda profile, path: calculate_traffic('ms', profile, path), routing_data_version)
 
 def route(request, coords):
     # Step 1: Parse Input
@@ -860,28 +905,21 @@ def route(request, coords):
         "environment_quality": environmental_score # Corresponds to Environment
     }
 
-    # Step 2: The following method computes and saves a traffic.csv file in the work folder
-    calculate_traffic('ms', weights)
-    
-    # Step 3: Customize OSRM so that the routing network incorporates the bikeability-infused edge speeds
-    subprocess.call(['./sensebox/osrm/osrm-customize','sensebox/osrm/work/smol.osrm', '--segment-speed-file=sensebox/osrm/work/traffic.csv'])
-
-    # Step 4: Run the routing engine as a running process
-    process = subprocess.Popen(['./sensebox/osrm/osrm-routed', '--algorithm=mld','sensebox/osrm/work/smol.osrm'])
-    url = f"http://localhost:5000/route/v1/driving/{str(start_lon)},{start_lat};{end_lon},{end_lat}?overview=full&steps=true"
-    # The two second timeout makes sure that the router will have loaded and is ready. TODO: Read stdout of the routing process
-    # and act immediately after it has loaded. Don't wait for a fixed time.
-    time.sleep(2)
-
-    # Step 5: Request the route from the routing engine by http request
-    contents = urllib.request.urlopen(url).read()
+    # Step 2: Get the long-lived router of this weight profile. The weights are quantized onto a grid; on first
+    #         use of a profile (and not already cached on disk for the current scores) the pool writes its
+    #         traffic.csv and customizes its own copy of the network with the bikeability-infused edge speeds,
+    #         then starts osrm-routed, waiting until it reports that it is ready.
+    pool = routing_pool()
+    path = f"/route/v1/driving/{str(start_lon)},{start_lat};{end_lon},{end_lat}?overview=full&steps=true"
+
+    # Step 3: Request the route from the routing engine by http request (queued while the router is busy)
+    try:
+        status, contents = pool.route(weights, path)
+    except (RoutingError, subprocess.CalledProcessError, OSError) as err:
+        return JsonResponse({"code": "NoRouter", "message": str(err)}, status=503)
     # Decode the response from OSRM (we expect a utf-8 encoded string containing json data)
     output = contents.decode('utf-8')
 
-    # Step 6: Terminate the routing engine - this is important so that we can start a "clean" router with a differently
-    #         customized routing network on the next request.
-    process.terminate()
-
-    # Step 7: Return the response from the routing engine to the frontend. Note that we have to parse the string to a dict
+    # Step 4: Return the response from the routing engine to the frontend. Note that we have to parse the string to a dict
     #         to re-serialize it because JsonResponse expects a dict and not a string. TODO: This should be fixed.
-    return JsonResponse(json.loads(output), safe=False)
+    return JsonResponse(json.loads(output), safe=False, status=status)